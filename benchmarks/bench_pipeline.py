@@ -0,0 +1,179 @@
+""" Benchmark of the data pipeline from the end of a block to the upload request, without a window.
+
+Synthetic sessions go through the same steps as in the app:
+
+- collect: Scale, round and hash a block's trials like ScreenCircleTask.data_collection, then DataManager.add_data
+  for trials, trajectories and the session table.
+- serialize: Render all data sets as CSV (DataManager._data2csv).
+- write: Write all data sets to files in a temporary directory (DataManager._write_data_sets).
+- post: Build the JSON body for the dash server (DataManager._get_dash_post), or the streamed body in stream mode.
+
+For each step it reports latency percentiles, throughput, bytes and peak memory, per serializer.
+
+Usage::
+
+    python benchmarks/bench_pipeline.py --trials 30 --blocks 3 --trajectory-rate 60 --repeat 50 --serializers csv npy
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+import sys
+import tempfile
+import time
+import tracemalloc
+from hashlib import md5
+
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+os.environ.setdefault('KIVY_NO_CONSOLELOG', '1')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np
+from kivy.app import App
+
+from headless import HeadlessApp
+from src.datamanager import DataManager
+from src.serializers import SERIALIZERS
+
+TRIAL_COLUMNS = ['df1', 'df2', 'df1_grab', 'df1_release', 'df2_grab', 'df2_release', 'onset_latency', 'onset_jitter',
+                 'cue_latency']
+TRAJECTORY_COLUMNS = ['trial', 'time', 'df1', 'df2']
+
+
+def make_block(rng, n_trials, trial_duration, trajectory_rate):
+    """ Random trials and trajectories of a block, shaped like the circle task's. """
+    trials = rng.random((n_trials, len(TRIAL_COLUMNS)))
+    n_samples = max(1, int(trial_duration * trajectory_rate))
+    trajectories = np.empty((n_trials * n_samples, len(TRAJECTORY_COLUMNS)))
+    trajectories[:, 0] = np.repeat(np.arange(1, n_trials + 1), n_samples)
+    trajectories[:, 1] = np.tile(np.linspace(0, trial_duration, n_samples), n_trials)
+    trajectories[:, 2:] = rng.random((len(trajectories), 2)) * 100
+    return trials, trajectories
+
+
+def collect(data_mgr, blocks, trial_duration):
+    """ Add a session's blocks to the data manager like ScreenCircleTask does. """
+    session = list()
+    for block, (trials, trajectories) in enumerate(blocks, start=1):
+        data = trials.copy()
+        data[:, :2] *= 100
+        data = np.around(data, decimals=5)
+        meta_data = {'table': 'trials', 'device': 'benchmark', 'user': 'benchmark', 'task': 'Circle Task',
+                     'block': block, 'treatment': '', 'time_iso': f'2020_01_01_00_00_{block:02d}', 'time': time.time(),
+                     'hash': md5(data).hexdigest(), 'rating': 2, 'warm_up': 1.0, 'trial_duration': trial_duration,
+                     'cool_down': 0.5, 'columns': TRIAL_COLUMNS}
+        data_mgr.add_data(TRIAL_COLUMNS, data, meta_data.copy())
+        trajectories = np.around(trajectories, decimals=5)
+        trajectory_meta = dict(meta_data, table='trajectories', trials_hash=meta_data['hash'],
+                               hash=md5(trajectories).hexdigest(), columns=TRAJECTORY_COLUMNS)
+        data_mgr.add_data(TRAJECTORY_COLUMNS, trajectories, trajectory_meta, fmt='%.5f')
+        session.append([meta_data[c] for c in data_mgr.session_columns])
+    session_meta = {'table': 'session', 'time': time.time(), 'time_iso': '2020_01_01_00_00_00',
+                    'task': 'Circle Task', 'user': 'benchmark'}
+    data_mgr.add_data(data_mgr.session_columns, np.array(session), session_meta)
+
+
+def measure(func, repeat):
+    """ Run func repeatedly.
+
+    :return: Latencies in seconds, peak memory in bytes of one extra run, and func's last result.
+    :rtype: tuple[numpy.ndarray, int, object]
+    """
+    latencies = np.empty(repeat)
+    result = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        latencies[i] = time.perf_counter() - start
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return latencies, peak, result
+
+
+def run(serializer, args):
+    """ Benchmark all steps with one serializer.
+
+    :return: Results per step.
+    :rtype: dict
+    """
+    rng = np.random.default_rng(args.seed)
+    blocks = [make_block(rng, args.trials, args.trial_duration, args.trajectory_rate) for _ in range(args.blocks)]
+    results = dict()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        App._running_app = HeadlessApp(tmp_dir, user='benchmark')
+        data_mgr = DataManager(serializer=serializer)
+        data_mgr.upload_mode = args.upload_mode
+        # Journaling is part of collecting in the app, so it stays in.
+        data_mgr.journal.start()
+
+        def step_collect():
+            data_mgr._data.clear()
+            collect(data_mgr, blocks, args.trial_duration)
+            return sum(len(d['data']) for d in data_mgr._data)
+
+        def step_serialize():
+            return sum(len(data_mgr._data2csv(d)) for d in data_mgr._data)
+
+        storage = Path(tmp_dir) / 'files'
+
+        def step_write():
+            data_mgr._write_data_sets(data_mgr._data, storage, binary=args.binary_files)
+            return sum(f.stat().st_size for f in storage.rglob('*') if f.is_file())
+
+        def step_post():
+            body = data_mgr._get_upload_body(data_mgr._data)
+            if callable(body):
+                return sum(len(chunk) for chunk in body())
+            return len(json.dumps(body).encode('utf-8'))
+
+        for name, step in [('collect', step_collect), ('serialize', step_serialize), ('write', step_write),
+                           ('post', step_post)]:
+            latencies, peak, n_bytes = measure(step, args.repeat)
+            results[name] = {'p50_ms': np.percentile(latencies, 50) * 1e3,
+                             'p90_ms': np.percentile(latencies, 90) * 1e3,
+                             'p99_ms': np.percentile(latencies, 99) * 1e3,
+                             'max_ms': latencies.max() * 1e3,
+                             'sessions_per_s': 1 / latencies.mean(),
+                             'mb_per_s': n_bytes / latencies.mean() / 1e6,
+                             'bytes': n_bytes,
+                             'peak_kib': peak / 1024,
+                             }
+        data_mgr.journal.clear()
+        App._running_app = None
+    return results
+
+
+def print_table(all_results):
+    columns = ['p50_ms', 'p90_ms', 'p99_ms', 'max_ms', 'sessions_per_s', 'mb_per_s', 'bytes', 'peak_kib']
+    print(f"{'serializer':<10} {'step':<10} " + ' '.join(f'{c:>14}' for c in columns))
+    for serializer, results in all_results.items():
+        for step, res in results.items():
+            print(f"{serializer:<10} {step:<10} " + ' '.join(f'{res[c]:>14.2f}' for c in columns))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark collecting, serializing, writing and posting data.")
+    parser.add_argument('--trials', type=int, default=30, help="Trials per block.")
+    parser.add_argument('--blocks', type=int, default=3, help="Blocks per session.")
+    parser.add_argument('--trial-duration', type=float, default=2.0, help="Seconds per trial.")
+    parser.add_argument('--trajectory-rate', type=int, default=60, help="Trajectory samples per second.")
+    parser.add_argument('--repeat', type=int, default=30, help="Runs per step.")
+    parser.add_argument('--serializers', nargs='+', default=list(SERIALIZERS), choices=list(SERIALIZERS))
+    parser.add_argument('--upload-mode', default='json', choices=['json', 'stream'])
+    parser.add_argument('--binary-files', action='store_true', help="Write binary instead of CSV files.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="Also write results to this JSON file.")
+    args = parser.parse_args(argv)
+
+    all_results = {serializer: run(serializer, args) for serializer in args.serializers}
+    print_table(all_results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': all_results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
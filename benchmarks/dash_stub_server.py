@@ -0,0 +1,210 @@
+""" Local stand-in for the dash server that receives uploads, for load and latency testing.
+
+Accepts the payload DataManager posts to /<app>/_dash-update-component, plain or gzip/deflate compressed, with or
+without chunked transfer encoding, and answers in the structure DataManager._parse_response expects. Latency, errors
+and cold starts of a sleeping server can be simulated. It also answers which block hashes it has received on
+/known-hashes, see DataManager.hash_query_path.
+
+Usage::
+
+    python benchmarks/dash_stub_server.py --port 8050 --latency 0.2 --error-rate 0.05 --cold-start 10
+
+Then point the app's upload server setting, or the load generator, to http://localhost:8050.
+"""
+import argparse
+import base64
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import random
+import sys
+import threading
+import time
+import zlib
+
+import numpy as np
+
+
+class StubState:
+    """ Behaviour and statistics shared by all request handlers. """
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=500, cold_start=0.0, idle_timeout=1800,
+                 accept_encoding='gzip, deflate'):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.cold_start = cold_start
+        self.idle_timeout = idle_timeout
+        self.accept_encoding = accept_encoding
+        self.lock = threading.Lock()
+        self.last_request = None
+        self.known_hashes = set()
+        self.n_requests = 0
+        self.n_errors = 0
+        self.n_files = 0
+        self.n_bytes = 0
+
+    def get_delay(self):
+        """ Seconds to wait before answering, including a cold start when the server was idle. """
+        now = time.monotonic()
+        with self.lock:
+            is_asleep = self.last_request is None or now - self.last_request > self.idle_timeout
+            self.last_request = now
+        delay = self.latency + random.uniform(0, self.jitter)
+        if is_asleep:
+            delay += self.cold_start
+        return delay
+
+
+def _read_chunked(rfile):
+    """ Read a body sent with chunked transfer encoding. """
+    body = io.BytesIO()
+    while True:
+        size = int(rfile.readline().split(b';')[0].strip(), 16)
+        if size == 0:
+            # Skip trailers.
+            while rfile.readline().strip():
+                pass
+            break
+        body.write(rfile.read(size))
+        rfile.readline()
+    return body.getvalue()
+
+
+def _hash_file(name, content):
+    """ md5 of a block's values the way the app computes it, or None for other tables. """
+    if not (name.startswith('trials-') or name.startswith('trajectories-')):
+        return None
+    try:
+        data = np.loadtxt(io.BytesIO(content), delimiter=',', skiprows=1, ndmin=2)
+    except ValueError:
+        return None
+    return md5(data).hexdigest()
+
+
+def make_handler(state):
+    class DashStubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # Keep connections alive like a real server.
+
+        def log_message(self, fmt, *args):
+            pass
+
+        def _read_body(self):
+            if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                body = _read_chunked(self.rfile)
+            else:
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            encoding = self.headers.get('Content-Encoding', '').lower()
+            if encoding == 'gzip':
+                body = zlib.decompress(body, wbits=31)
+            elif encoding == 'deflate':
+                body = zlib.decompress(body)
+            elif encoding:
+                raise ValueError(f"Unsupported content encoding {encoding}.")
+            return body
+
+        def _send_json(self, status, obj):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            if state.accept_encoding:
+                self.send_header('Accept-Encoding', state.accept_encoding)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_message(self, msg):
+            self._send_json(200, {'response': {'output-data-upload': {'children': [{'props': {'children': msg}}]}}})
+
+        def do_POST(self):
+            with state.lock:
+                state.n_requests += 1
+            try:
+                body = self._read_body()
+            except (ValueError, zlib.error):
+                self.send_response(415)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            time.sleep(state.get_delay())
+            if self.path.rstrip('/').endswith('/known-hashes'):
+                hashes = json.loads(body)['hashes']
+                with state.lock:
+                    known = [h for h in hashes if h in state.known_hashes]
+                self._send_json(200, {'known': known})
+                return
+            if not self.path.endswith('_dash-update-component'):
+                self._send_json(404, {'error': 'Not found.'})
+                return
+            if random.random() < state.error_rate:
+                with state.lock:
+                    state.n_errors += 1
+                if state.error_status == 200:
+                    self._send_message("ERROR: Simulated failure.")
+                else:
+                    self._send_json(state.error_status, {'error': 'Simulated failure.'})
+                return
+            try:
+                post = json.loads(body)
+                contents = post['inputs'][0]['value']
+                file_names = post['state'][0]['value']
+            except (ValueError, KeyError, IndexError):
+                self._send_message("ERROR: Unexpected payload.")
+                return
+            hashes = list()
+            for name, content in zip(file_names, contents):
+                content = base64.b64decode(content.split(',', 1)[1])
+                hashes.append(_hash_file(name, content))
+            with state.lock:
+                state.n_files += len(file_names)
+                state.n_bytes += len(body)
+                state.known_hashes.update(h for h in hashes if h)
+            self._send_message(f"Upload successful. Received {len(file_names)} files.")
+
+    return DashStubHandler
+
+
+def serve(host='localhost', port=8050, **kwargs):
+    """ Create a server running in a background thread.
+
+    :return: Server and its state. Call server.shutdown() to stop it.
+    :rtype: tuple[http.server.ThreadingHTTPServer, StubState]
+    """
+    state = StubState(**kwargs)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stand-in for the dash server that receives uploads.")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to each response.")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Up to this many seconds added randomly.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of uploads that fail.")
+    parser.add_argument('--error-status', type=int, default=500,
+                        help="HTTP status of failures. 200 answers with an error message like dash does.")
+    parser.add_argument('--cold-start', type=float, default=0.0, help="Seconds of delay after being idle.")
+    parser.add_argument('--idle-timeout', type=float, default=1800, help="Seconds without requests until asleep.")
+    parser.add_argument('--accept-encoding', default='gzip, deflate',
+                        help="Request content codings to advertise. Empty for none.")
+    args = parser.parse_args(argv)
+    server, state = serve(args.host, args.port, latency=args.latency, jitter=args.jitter,
+                          error_rate=args.error_rate, error_status=args.error_status, cold_start=args.cold_start,
+                          idle_timeout=args.idle_timeout, accept_encoding=args.accept_encoding)
+    print(f"Serving on http://{args.host}:{args.port}. Press Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+    print(f"Requests: {state.n_requests}, simulated errors: {state.n_errors}, files: {state.n_files}, "
+          f"bytes: {state.n_bytes}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,38 @@
+""" Stand-ins for the running app, so the DataManager can be used without a window.
+
+Shared by the benchmarks and the tests.
+"""
+from kivy.event import EventDispatcher
+
+
+class HeadlessSettings(EventDispatcher):
+    """ The part of SettingsContainer the DataManager uses. """
+    local_storage_format = 'csv'
+    is_local_storage_enabled = 1
+    upload_mode = 'json'
+    upload_compression = 'auto'
+    upload_trajectories = 0
+    current_task = 'Circle Task'
+    current_user = 'headless'
+
+    def __init__(self, **kwargs):
+        self.register_event_type('on_user_removed')
+        super(HeadlessSettings, self).__init__(**kwargs)
+
+    def on_user_removed(self, *args):
+        pass
+
+
+class HeadlessApp:
+    """ Stands in for the running app, which the DataManager asks for its settings and data directory. """
+    def __init__(self, user_data_dir, user=None):
+        """
+        :param user_data_dir: Directory for the app's data.
+        :type user_data_dir: Union[str,pathlib.Path]
+        :param user: Current user, if not the default one.
+        :type user: str
+        """
+        self.user_data_dir = str(user_data_dir)
+        self.settings = HeadlessSettings()
+        if user is not None:
+            self.settings.current_user = user
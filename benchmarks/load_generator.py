@@ -0,0 +1,191 @@
+""" Load generator replaying many concurrent app clients against an upload server.
+
+Each client is a DataManager with its own data directory that uploads synthetic sessions through the same code path
+as the app (DataManager._upload), including compression negotiation, skipping of known blocks and storing failed
+uploads in the outbox. In outbox mode, clients first queue all sessions offline and then drain their outbox in batches
+like after regaining connectivity.
+
+Usage with the local stand-in server (see dash_stub_server.py)::
+
+    python benchmarks/load_generator.py --serve --latency 0.1 --error-rate 0.1 --clients 20 --sessions 5
+
+Or against a running server::
+
+    python benchmarks/load_generator.py --url http://localhost:8050/circletask/_dash-update-component
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+os.environ.setdefault('KIVY_NO_CONSOLELOG', '1')
+
+import numpy as np
+from kivy.app import App
+
+from bench_pipeline import collect, make_block
+from dash_stub_server import serve
+from headless import HeadlessApp
+from src.datamanager import DataManager
+from src.workers import Job
+
+ROUTE = '/circletask/_dash-update-component'
+
+
+def make_client(tmp_dir, i, args):
+    """ A DataManager with its own storage, configured like the app's. """
+    app = HeadlessApp(Path(tmp_dir) / f'client_{i}', user=f'client_{i}')
+    Path(app.user_data_dir).mkdir()
+    App._running_app = app
+    data_mgr = DataManager()
+    data_mgr.upload_mode = args.upload_mode
+    data_mgr.upload_compression = args.compression
+    data_mgr.upload_timeout = (args.connect_timeout, args.read_timeout)
+    data_mgr.outbox_batch_sessions = args.batch_sessions
+    if args.hash_query_path:
+        data_mgr.hash_query_path = args.hash_query_path
+    return data_mgr
+
+
+def make_sessions(data_mgr, rng, args):
+    """ Data collections of synthetic sessions. """
+    sessions = list()
+    for _ in range(args.sessions):
+        blocks = [make_block(rng, args.trials, args.trial_duration, args.trajectory_rate) for _ in range(args.blocks)]
+        data_mgr._data.clear()
+        collect(data_mgr, blocks, args.trial_duration)
+        sessions.append(list(data_mgr._data))
+    data_mgr._data.clear()
+    return sessions
+
+
+def run_client(data_mgr, sessions, url, args, results):
+    """ Upload sessions one after another, either directly or through the outbox. """
+    latencies = list()
+    n_failed = 0
+    start = time.perf_counter()
+    if args.mode == 'direct':
+        for data_sets in sessions:
+            t = time.perf_counter()
+            status, msg = data_mgr._upload(Job(None), url, data_sets)
+            latencies.append(time.perf_counter() - t)
+            n_failed += not status
+    else:
+        for data_sets in sessions:
+            data_mgr.outbox.put_session(url, data_sets)
+        for _ in range(args.max_attempts):
+            if data_mgr.outbox.is_empty():
+                break
+            t = time.perf_counter()
+            status = data_mgr._upload_outbox_batch(Job(None))
+            latencies.append(time.perf_counter() - t)
+            n_failed += not status
+            if not status:
+                time.sleep(args.retry_delay)
+    results.append({'latencies': latencies,
+                    'failed': n_failed,
+                    'pending_data_sets': len(data_mgr.outbox),
+                    'pending_sessions': data_mgr.outbox.count_sessions(),
+                    'duration': time.perf_counter() - start})
+
+
+def run(args):
+    """ Run all clients concurrently.
+
+    :return: Summary of the run.
+    :rtype: dict
+    """
+    server = None
+    url = args.url
+    if args.serve:
+        server, state = serve('localhost', 0, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                              error_status=args.error_status, cold_start=args.cold_start)
+        url = f'http://localhost:{server.server_address[1]}{ROUTE}'
+        if args.hash_query_path is None:
+            args.hash_query_path = '/known-hashes'
+    rng = np.random.default_rng(args.seed)
+    results = list()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        clients = list()
+        for i in range(args.clients):
+            data_mgr = make_client(tmp_dir, i, args)
+            clients.append((data_mgr, make_sessions(data_mgr, rng, args)))
+        threads = [threading.Thread(target=run_client, args=(data_mgr, sessions, url, args, results))
+                   for data_mgr, sessions in clients]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        duration = time.perf_counter() - start
+        App._running_app = None
+    if server:
+        server.shutdown()
+    latencies = np.array([x for r in results for x in r['latencies']]) if results else np.empty(0)
+    n_uploads = len(latencies)
+    summary = {'clients': args.clients,
+               'sessions': args.clients * args.sessions,
+               'uploads': n_uploads,
+               'failed': sum(r['failed'] for r in results),
+               'pending_sessions': sum(r['pending_sessions'] for r in results),
+               'pending_data_sets': sum(r['pending_data_sets'] for r in results),
+               'duration_s': duration,
+               'uploads_per_s': n_uploads / duration if duration else 0.0,
+               }
+    if n_uploads:
+        summary.update({'p50_ms': np.percentile(latencies, 50) * 1e3,
+                        'p90_ms': np.percentile(latencies, 90) * 1e3,
+                        'p99_ms': np.percentile(latencies, 99) * 1e3,
+                        'max_ms': latencies.max() * 1e3,
+                        })
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Upload synthetic sessions from many concurrent clients.")
+    parser.add_argument('--url', help="Upload route of a running server.")
+    parser.add_argument('--serve', action='store_true', help="Start the stand-in server in this process.")
+    parser.add_argument('--clients', type=int, default=10, help="Concurrent clients.")
+    parser.add_argument('--sessions', type=int, default=3, help="Sessions per client.")
+    parser.add_argument('--mode', default='direct', choices=['direct', 'outbox'],
+                        help="Upload each session, or queue all offline and drain the outbox.")
+    parser.add_argument('--max-attempts', type=int, default=20, help="Outbox batches per client at most.")
+    parser.add_argument('--retry-delay', type=float, default=0.5, help="Seconds before retrying a failed batch.")
+    parser.add_argument('--batch-sessions', type=int, default=DataManager.outbox_batch_sessions)
+    parser.add_argument('--upload-mode', default='json', choices=['json', 'stream'])
+    parser.add_argument('--compression', default=DataManager.upload_compression, choices=['auto', 'always', 'never'])
+    parser.add_argument('--connect-timeout', type=float, default=DataManager.upload_timeout[0])
+    parser.add_argument('--read-timeout', type=float, default=DataManager.upload_timeout[1])
+    parser.add_argument('--hash-query-path', help="Path to ask the server for known blocks, e.g. /known-hashes.")
+    parser.add_argument('--trials', type=int, default=30, help="Trials per block.")
+    parser.add_argument('--blocks', type=int, default=3, help="Blocks per session.")
+    parser.add_argument('--trial-duration', type=float, default=2.0, help="Seconds per trial.")
+    parser.add_argument('--trajectory-rate', type=int, default=60, help="Trajectory samples per second.")
+    parser.add_argument('--seed', type=int, default=0)
+    # Behaviour of the stand-in server.
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--cold-start', type=float, default=0.0)
+    parser.add_argument('--json', help="Also write the summary to this JSON file.")
+    args = parser.parse_args(argv)
+    if not args.url and not args.serve:
+        parser.error("Either --url or --serve is required.")
+
+    summary = run(args)
+    for key, value in summary.items():
+        print(f"{key:<18} {value:>12.2f}" if isinstance(value, float) else f"{key:<18} {value:>12}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'summary': summary}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
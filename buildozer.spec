@@ -13,7 +13,7 @@ package.domain = com.olafhaag
 source.dir = .
 
 # (list) Source files to include (let empty to include all the files)
-source.include_exts = py,png,jpg,kv,atlas,ogg,mo,txt
+source.include_exts = py,png,jpg,kv,atlas,ogg,mo,txt,json
 
 # (list) List of inclusions using pattern matching
 #source.include_patterns = assets/*,images/*.png
@@ -22,7 +22,7 @@ source.include_exts = py,png,jpg,kv,atlas,ogg,mo,txt
 #source.exclude_exts = spec
 
 # (list) List of directory to exclude (let empty to not exclude anything)
-source.exclude_dirs = tests, bin, .idea, .git
+source.exclude_dirs = tests, bin, benchmarks, .idea, .git
 
 # (list) List of exclusions using pattern matching
 #source.exclude_patterns = license,images/*/*.jpg
@@ -36,7 +36,7 @@ version.filename = %(source.dir)s/src/version.py
 
 # (list) Application requirements
 # comma separated e.g. requirements = sqlite3,kivy
-requirements = hostpython3==3.7.8, python3==3.7.8, kivy==1.11.1, kivymd==0.104.1, plyer, numpy, requests, urllib3, chardet, idna
+requirements = hostpython3==3.7.8, python3==3.7.8, kivy==1.11.1, kivymd==0.104.1, plyer, numpy, requests, urllib3, chardet, idna, sqlite3
 
 # (str) Custom source folders for requirements
 # Sets custom source for any requirements with recipes
@@ -1,2 +1,9 @@
 from .version import __version__
-from .app import NeuroPsyResearchApp as App
+
+
+def __getattr__(name):
+    # Import the app only when it's asked for, so headless tools like src.batch don't need a window.
+    if name == 'App':
+        from .app import NeuroPsyResearchApp
+        return NeuroPsyResearchApp
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
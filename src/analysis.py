@@ -0,0 +1,193 @@
+""" Uncontrolled manifold (UCM) analysis of the circle task's final slider values.
+
+The task is solved by any combination of df1 and df2 that satisfies df1 + df2 = const. Trial-to-trial variance of
+the final values is decomposed into variance along that solution space, the UCM with direction [1, -1]/√2, and
+variance orthogonal to it, direction [1, 1]/√2, which changes the task's result.
+
+The synergy index ΔV = (V_ucm - V_ort) / (V_total / 2) is normalized by the variance per degree of freedom and ranges
+from -2 to 2. Because its distribution is bounded it's Fisher-z transformed for comparisons:
+ΔVz = 0.5 * ln((2 + ΔV) / (2 - ΔV)).
+"""
+import math
+
+import numpy as np
+
+UCM_DIRECTION = np.array([1.0, -1.0]) / math.sqrt(2)
+ORTHOGONAL_DIRECTION = np.array([1.0, 1.0]) / math.sqrt(2)
+
+
+def synergy_index(v_ucm, v_ort):
+    """ Synergy index ΔV and its Fisher-z transform for variances within and orthogonal to the UCM.
+    Works element-wise on arrays.
+
+    :return: ΔV and ΔVz. NaN where total variance is zero.
+    :rtype: tuple
+    """
+    v_ucm = np.asarray(v_ucm, dtype=float)
+    v_ort = np.asarray(v_ort, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Each subspace has one dimension, so total variance per degree of freedom is their mean.
+        dv = (v_ucm - v_ort) / ((v_ucm + v_ort) / 2)
+        dvz = 0.5 * np.log((2 + dv) / (2 - dv))
+    return dv, dvz
+
+
+def ucm_decomposition(values):
+    """ Decompose variance of final slider values of a block.
+
+    :param values: 2D array with df1 and df2 in the first two columns, one row per trial. Rows with NaN are ignored.
+    :type values: numpy.ndarray
+    :return: Number of trials, V_ucm, V_ort, V_total, ΔV and ΔVz.
+    :rtype: dict
+    """
+    acc = UCMAccumulator()
+    acc.add_many(values)
+    return acc.get_results()
+
+
+class UCMAccumulator:
+    """ Running mean and covariance of df1 and df2, updated as trials arrive.
+    Uses Welford's algorithm, so the variance stays exact without keeping all trials.
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean = np.zeros(2)
+        self._m2 = np.zeros((2, 2))  # Sum of outer products of deviations from the mean.
+
+    def add(self, df1, df2):
+        """ Add the final values of a trial. Ignored if any of them is NaN. """
+        x = np.array([df1, df2], dtype=float)
+        if np.isnan(x).any():
+            return
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self._m2 += np.outer(delta, x - self.mean)
+
+    def add_many(self, values):
+        """ Add several trials at once.
+
+        :param values: 2D array with df1 and df2 in the first two columns. Rows with NaN are ignored.
+        :type values: numpy.ndarray
+        """
+        x = np.asarray(values, dtype=float)[:, :2]
+        x = x[~np.isnan(x).any(axis=1)]
+        n_b = len(x)
+        if not n_b:
+            return
+        mean_b = x.mean(axis=0)
+        deviations = x - mean_b
+        m2_b = deviations.T @ deviations
+        # Merge both sets of statistics (Chan et al.).
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self._m2 += m2_b + np.outer(delta, delta) * self.n * n_b / n
+        self.mean += delta * n_b / n
+        self.n = n
+
+    @property
+    def covariance(self):
+        """ Sample covariance matrix of df1 and df2. NaN for less than 2 trials. """
+        if self.n < 2:
+            return np.full((2, 2), np.nan)
+        return self._m2 / (self.n - 1)
+
+    def get_results(self):
+        """ Variance components and synergy index of the trials so far.
+
+        :rtype: dict
+        """
+        cov = self.covariance
+        v_ucm = UCM_DIRECTION @ cov @ UCM_DIRECTION
+        v_ort = ORTHOGONAL_DIRECTION @ cov @ ORTHOGONAL_DIRECTION
+        dv, dvz = synergy_index(v_ucm, v_ort)
+        return {'n_trials': self.n,
+                'mean_df1': float(self.mean[0]) if self.n else np.nan,
+                'mean_df2': float(self.mean[1]) if self.n else np.nan,
+                'v_ucm': float(v_ucm),
+                'v_ort': float(v_ort),
+                'v_total': float(v_ucm + v_ort),
+                'dv': float(dv),
+                'dvz': float(dvz),
+                }
+
+
+class SessionAnalysis:
+    """ UCM analysis of all blocks of a session, grouped by treatment. """
+    def __init__(self):
+        self._blocks = dict()  # Block number -> (treatment, UCMAccumulator)
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def clear(self):
+        self._blocks.clear()
+
+    def _get_accumulator(self, block, treatment):
+        try:
+            return self._blocks[block][1]
+        except KeyError:
+            acc = UCMAccumulator()
+            self._blocks[block] = (treatment, acc)
+            return acc
+
+    def add_trial(self, block, treatment, df1, df2):
+        """ Add final values of a trial as soon as it's finished.
+
+        :param block: Number of block.
+        :type block: int
+        :param treatment: Constrained degrees of freedom in block, empty for none.
+        :type treatment: str
+        """
+        self._get_accumulator(block, treatment).add(df1, df2)
+
+    def add_block(self, block, treatment, values):
+        """ Add all trials of a block, e.g. when loading stored data.
+
+        :param values: 2D array with df1 and df2 in the first two columns.
+        :type values: numpy.ndarray
+        """
+        self._get_accumulator(block, treatment).add_many(values)
+
+    def discard_block(self, block):
+        """ Forget the trials of a block, e.g. when it was interrupted or turned out to be invalid.
+
+        :param block: Number of block.
+        :type block: int
+        """
+        self._blocks.pop(block, None)
+
+    def get_block_results(self):
+        """ Results for each block in order of block number.
+
+        :rtype: list[dict]
+        """
+        results = list()
+        for block in sorted(self._blocks):
+            treatment, acc = self._blocks[block]
+            res = acc.get_results()
+            res['block'] = block
+            res['treatment'] = treatment
+            results.append(res)
+        return results
+
+    def get_treatment_results(self):
+        """ Compare treatments by the mean ΔVz of their blocks, relative to the unconstrained condition.
+
+        :return: Treatment -> number of blocks, mean ΔVz of blocks with a finite ΔVz, and the difference to the
+            unconstrained treatment's mean ΔVz. NaN if there's no block to compare.
+        :rtype: dict
+        """
+        dvz = dict()
+        for res in self.get_block_results():
+            dvz.setdefault(res['treatment'], list()).append(res['dvz'])
+        results = dict()
+        for treatment, values in dvz.items():
+            values = np.array(values)
+            # ΔVz is infinite without variance orthogonal to the UCM, and NaN with too few trials.
+            valid = values[np.isfinite(values)]
+            results[treatment] = {'n_blocks': len(values), 'dvz': float(valid.mean()) if len(valid) else np.nan}
+        reference = results.get('', {}).get('dvz', np.nan)
+        for res in results.values():
+            res['dvz_diff'] = res['dvz'] - reference
+        return results
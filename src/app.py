@@ -2,10 +2,12 @@
 
 from kivymd.app import MDApp
 from kivy.clock import Clock
+from kivy.core.window import Window
 from kivy.lang import global_idmap, Builder
 from kivy.properties import ObjectProperty
 from kivy.utils import platform
 
+from .audio import AudioCues
 from .utility import create_user_identifier, switch_language, get_app_details
 from .datamanager import DataManager
 from .i18n import _, DEFAULT_LANGUAGE
@@ -35,6 +37,10 @@ class NeuroPsyResearchApp(MDApp):
         # Settings.
         self.settings = SettingsContainer()
         self.update_language_from_config()
+        # Decode sound cues once and keep them for all blocks and sessions.
+        self.audio_cues = AudioCues()
+        Clock.schedule_once(lambda dt: self.preload_audio_cues(), 1)
+        Window.bind(on_memorywarning=lambda *args: self.audio_cues.release())
         self.data_mgr = DataManager()
         self.data_mgr.bind(on_data_processing_failed=lambda instance, msg: self.manager.dispatch('on_error', msg),
                            on_data_upload=lambda instance, status, msg: self.manager.dispatch('on_upload_response',
@@ -47,6 +53,11 @@ class NeuroPsyResearchApp(MDApp):
         self.set_orientation_from_config()
         return root
     
+    def preload_audio_cues(self):
+        """ Load sound cues into memory, if sounds are enabled. """
+        if self.settings.is_sound_enabled:
+            self.audio_cues.load()
+    
     def set_orientation_from_config(self):
         """ Set screen orientation from saved config value. """
         orientation = self.config.get('General', 'orientation')
@@ -75,8 +86,12 @@ class NeuroPsyResearchApp(MDApp):
         config.setdefaults('DataCollection',
                            {
                                'is_local_storage_enabled': 0,
+                               'local_storage_format': 'csv',
                                'is_upload_enabled': 1,
                                'webserver': app_details['webserver'],
+                               'upload_mode': 'json',
+                               'upload_compression': 'auto',
+                               'upload_trajectories': 0,
                                'is_email_enabled': 0,
                            })
         config.setdefaults('CircleTask',
@@ -87,8 +102,10 @@ class NeuroPsyResearchApp(MDApp):
                                'warm_up_time': 1.0,
                                'trial_duration': 2.0,
                                'cool_down_time': 0.5,
+                               'trajectory_rate': 0,
                                'email_recipient': app_details['contact'],
                                'researcher': app_details['author'],
+                               'frame_trace': 'off',
                            })
         # To set aliases for user ids we need to schedule it next frame, we can't retrieve current_user yet.
         Clock.schedule_once(lambda dt: self.set_configdefaults_user(config), 1)
@@ -134,6 +151,10 @@ class NeuroPsyResearchApp(MDApp):
                 self.manager.remove_widget(s)
                 self.destroy_settings()
                 self.open_settings()
+        elif section == 'DataCollection' and key in ('upload_mode', 'upload_compression'):
+            setattr(self.data_mgr, key, value)
+        elif section == 'DataCollection' and key == 'upload_trajectories':
+            self.data_mgr.upload_trajectories = bool(int(value))
 
     def update_language_from_config(self):
         """Set the current language of the application from the configuration.
@@ -159,8 +180,10 @@ class NeuroPsyResearchApp(MDApp):
     # ToDo pause App.on_pause(), App.on_resume()
     def on_pause(self):
         # Here you can save data if needed
+        # Free memory while in background. Sound cues get loaded again when needed.
+        self.audio_cues.release()
         return True
     
     def on_resume(self):
         # Here you can check if any data needs replacing (usually nothing)
-        pass
+        Clock.schedule_once(lambda dt: self.preload_audio_cues(), 1)
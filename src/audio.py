@@ -0,0 +1,69 @@
+""" Sound cues that are loaded once and kept in memory, so playing them doesn't wait for disk I/O or decoding. """
+from kivy.core.audio import SoundLoader
+from kivy.logger import Logger
+
+from .timing import TrialClock
+
+
+class AudioCues:
+    """ App-wide cache of decoded sound cues. """
+    sources = {'start': 'res/start.ogg',
+               'stop': 'res/stop.ogg',
+               }
+
+    def __init__(self, clock=None):
+        """
+        :param clock: Clock used for measuring when cues were played.
+        :type clock: TrialClock
+        """
+        self.clock = clock or TrialClock()
+        self._sounds = dict()
+
+    def load(self):
+        """ Load all cues that aren't in memory yet. """
+        for name in self.sources:
+            self.get(name)
+
+    def get(self, name):
+        """ Return sound of cue, load it if necessary.
+
+        :rtype: kivy.core.audio.Sound
+        """
+        try:
+            return self._sounds[name]
+        except KeyError:
+            pass
+        # FixMe: Not loading sound files on Windows. (Unable to find a loader)
+        sound = SoundLoader.load(self.sources[name])
+        if sound:
+            self._sounds[name] = sound
+        else:
+            Logger.warning(f"AudioCues: Unable to load cue '{name}'.")
+        return sound
+
+    def play(self, name):
+        """ Play a cue from the start.
+
+        :return: Time on the clock just before playback was started, or None if the cue isn't available.
+        :rtype: float
+        """
+        sound = self.get(name)
+        if not sound:
+            return None
+        if sound.state == 'play':
+            sound.stop()
+        t = self.clock.now()
+        sound.play()
+        return t
+
+    def stop(self):
+        """ Stop playback of all cues, but keep them in memory. """
+        for sound in self._sounds.values():
+            sound.stop()
+
+    def release(self):
+        """ Unload all cues from memory, e.g. when the app is paused or memory runs low. """
+        for sound in self._sounds.values():
+            sound.stop()
+            sound.unload()
+        self._sounds.clear()
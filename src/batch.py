@@ -0,0 +1,286 @@
+""" Analyze locally stored sessions of many users at once.
+
+Reads what the DataManager stores in any of the local storage formats, i.e. <task>/<user>/trials-<time>-Block_<n>.csv
+and session-<time>.csv, the same as binary .npsy files, or a single data.sqlite store per user, and writes a
+consolidated dataset:
+
+- trials.csv: All trials with task, user, session time and block.
+- blocks.csv: UCM analysis of each block with its treatment and difficulty rating.
+- users.csv: Per user and treatment, number of blocks and trials and mean synergy index.
+
+Usage::
+
+    python -m src.batch <storage path> -o <output directory> [-j <number of processes>]
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import io
+import logging
+import os
+from pathlib import Path
+import re
+import sqlite3
+import sys
+
+import numpy as np
+
+from .analysis import ucm_decomposition
+from .datastore import DataStore
+from .reader import FILE_SUFFIX, MappedDataSet
+from .serializers import get_serializer
+
+logger = logging.getLogger(__name__)
+
+TRIALS_PATTERN = re.compile(r'^trials-(?P<time_iso>.+)-Block_(?P<block>\d+)\.(?:csv|npsy)$')
+SESSION_PATTERN = re.compile(r'^session-(?P<time_iso>.+)\.(?:csv|npsy)$')
+BLOCK_COLUMNS = ['task', 'user', 'time_iso', 'block', 'treatment', 'rating', 'n_trials', 'mean_df1', 'mean_df2',
+                 'v_ucm', 'v_ort', 'v_total', 'dv', 'dvz']
+USER_COLUMNS = ['task', 'user', 'treatment', 'n_sessions', 'n_blocks', 'n_trials', 'mean_dvz']
+
+
+def find_files(root):
+    """ Collect trial and session files and stores of each user in a single walk over the directory tree.
+
+    :param root: Storage path containing one folder per task.
+    :type root: Union[str,pathlib.Path]
+    :return: (task folder, user) -> {'trials': [(path, time_iso, block)], 'sessions': [path], 'stores': [path]}
+    :rtype: dict
+    """
+    root = Path(root)
+    users = dict()
+    for dir_path, _, file_names in os.walk(root):
+        rel = Path(dir_path).relative_to(root)
+        if len(rel.parts) != 2:
+            continue
+        folder, user = rel.parts
+        for name in file_names:
+            match = TRIALS_PATTERN.match(name)
+            if match:
+                entry = users.setdefault((folder, user), {'trials': list(), 'sessions': list(), 'stores': list()})
+                entry['trials'].append((os.path.join(dir_path, name), match['time_iso'], int(match['block'])))
+            elif SESSION_PATTERN.match(name):
+                entry = users.setdefault((folder, user), {'trials': list(), 'sessions': list(), 'stores': list()})
+                entry['sessions'].append(os.path.join(dir_path, name))
+            elif name == DataStore.file_name:
+                entry = users.setdefault((folder, user), {'trials': list(), 'sessions': list(), 'stores': list()})
+                entry['stores'].append(os.path.join(dir_path, name))
+    return users
+
+
+def read_trials(path):
+    """ Read a trials file, either CSV or binary.
+
+    :return: Column names and 2D array of values.
+    :rtype: tuple[list[str], numpy.ndarray]
+    """
+    if path.endswith(FILE_SUFFIX):
+        data_set = MappedDataSet(path)
+        return data_set.columns, np.array(data_set.data, dtype=float).reshape((-1, len(data_set.columns)))
+    with open(path, 'r', encoding='utf-8') as f:
+        columns = f.readline().strip().split(',')
+        data = np.loadtxt(f, delimiter=',', ndmin=2)
+    return columns, data.reshape((-1, len(columns)))
+
+
+def _add_session_rows(blocks, rows):
+    """ Index rows of a session table by session time and block. """
+    for row in rows:
+        try:
+            blocks[(row['time_iso'], int(row['block']))] = row
+        except (KeyError, ValueError):
+            continue
+
+
+def read_sessions(paths):
+    """ Read session files of a user, either CSV or binary.
+
+    :return: (time_iso, block) -> row of session table.
+    :rtype: dict
+    """
+    blocks = dict()
+    for path in paths:
+        if path.endswith(FILE_SUFFIX):
+            data_set = MappedDataSet(path)
+            _add_session_rows(blocks, (dict(zip(data_set.columns, row)) for row in data_set.data.tolist()))
+            continue
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            _add_session_rows(blocks, csv.DictReader(f))
+    return blocks
+
+
+def read_store(path):
+    """ Read the trials and sessions in a user's single-file store.
+
+    :return: Trials as (time_iso, block) -> (columns, data), and (time_iso, block) -> row of session table.
+    :rtype: tuple[dict, dict]
+    """
+    trials = dict()
+    sessions = dict()
+    with DataStore(path) as store:
+        for data_set in store.iter_data_sets():
+            if data_set['table'] not in ('trials', 'session'):
+                continue
+            serializer = get_serializer(data_set.get('format', 'csv'))
+            if hasattr(serializer, 'loads'):
+                columns, data, fmt = serializer.loads(data_set['data'])
+                rows = data.tolist()
+            else:
+                reader = csv.reader(io.StringIO(data_set['data'].decode('utf-8')))
+                columns = next(reader)
+                rows = list(reader)
+            if data_set['table'] == 'session':
+                _add_session_rows(sessions, (dict(zip(columns, row)) for row in rows))
+            else:
+                data = np.array(rows, dtype=float).reshape((-1, len(columns)))
+                trials[(data_set['time_iso'], int(data_set['block']))] = (columns, data)
+    return trials, sessions
+
+
+def process_user(folder, user, files):
+    """ Load all files of a user and analyze each block. Runs in a worker process.
+    A block that was stored in more than one format is only analyzed once.
+
+    :param folder: Name of the task's folder.
+    :type folder: str
+    :return: Task as stored in the session files or None if there are none, trials as (time_iso, block, columns, data)
+        and a row of results per block.
+    :rtype: tuple[str, list[tuple], list[dict]]
+    """
+    sessions = read_sessions(files['sessions'])
+    block_data = dict()  # (time_iso, block) -> (columns, data)
+    for path, time_iso, block in files['trials']:
+        if (time_iso, block) in block_data:
+            continue
+        try:
+            block_data[(time_iso, block)] = read_trials(path)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Skipping {path}: {e}")
+    for path in files['stores']:
+        try:
+            store_trials, store_sessions = read_store(path)
+        except (OSError, ValueError, KeyError, sqlite3.Error) as e:
+            logger.warning(f"Skipping {path}: {e}")
+            continue
+        for key, value in store_trials.items():
+            block_data.setdefault(key, value)
+        for key, value in store_sessions.items():
+            sessions.setdefault(key, value)
+    task = next((row['task'] for row in sessions.values() if row.get('task')), None)
+    trials = list()
+    blocks = list()
+    for (time_iso, block), (columns, data) in sorted(block_data.items()):
+        trials.append((time_iso, block, columns, data))
+        session = sessions.get((time_iso, block), dict())
+        res = ucm_decomposition(data)
+        res.update(user=user, time_iso=time_iso, block=block,
+                   treatment=session.get('treatment', ''), rating=session.get('rating', ''))
+        blocks.append(res)
+    return task, trials, blocks
+
+
+def _process_user(args):
+    return process_user(*args)
+
+
+def aggregate_users(blocks):
+    """ Aggregate block results per user and treatment.
+
+    :type blocks: list[dict]
+    :rtype: list[dict]
+    """
+    groups = dict()
+    for res in blocks:
+        groups.setdefault((res['task'], res['user'], res['treatment']), list()).append(res)
+    rows = list()
+    for (task, user, treatment), group in sorted(groups.items()):
+        dvz = np.array([res['dvz'] for res in group])
+        valid = dvz[~np.isnan(dvz)]
+        rows.append({'task': task,
+                     'user': user,
+                     'treatment': treatment,
+                     'n_sessions': len({res['time_iso'] for res in group}),
+                     'n_blocks': len(group),
+                     'n_trials': sum(res['n_trials'] for res in group),
+                     'mean_dvz': valid.mean() if len(valid) else np.nan,
+                     })
+    return rows
+
+
+def write_rows(path, columns, rows):
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def write_trials(path, trials):
+    """ Write all trials to one file. Files of older app versions may lack columns, which are left empty.
+
+    :param trials: (task, user, time_iso, block, columns, data) for each block.
+    :type trials: list[tuple]
+    """
+    columns = list()
+    for *_, block_columns, _ in trials:
+        columns.extend(c for c in block_columns if c not in columns)
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['task', 'user', 'time_iso', 'block', 'trial'] + columns)
+        for task, user, time_iso, block, block_columns, data in trials:
+            # Arrange the block's columns in the common order at once, instead of looking them up per value.
+            arranged = np.full((len(data), len(columns)), np.nan)
+            arranged[:, [columns.index(c) for c in block_columns]] = data
+            values = np.char.mod('%.5f', arranged).tolist()
+            writer.writerows([task, user, time_iso, block, i + 1] + [v if v != 'nan' else '' for v in row]
+                             for i, row in enumerate(values))
+
+
+def run(root, output, n_workers=None):
+    """ Analyze all sessions in root and write the consolidated dataset to output.
+
+    :param root: Storage path containing one folder per task.
+    :type root: Union[str,pathlib.Path]
+    :param output: Directory for the resulting files.
+    :type output: Union[str,pathlib.Path]
+    :param n_workers: Number of processes. Defaults to the number of CPUs.
+    :type n_workers: int
+    :return: Number of users and blocks processed.
+    :rtype: tuple[int, int]
+    """
+    users = find_files(root)
+    jobs = [(folder, user, files) for (folder, user), files in sorted(users.items())]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(_process_user, jobs, chunksize=8))
+    # Folder names can't tell spaces from underscores in task names, so tasks are taken from the session files.
+    # Users without any, e.g. after an interrupted session, get the task of other users in the same folder.
+    folder_tasks = {folder: task for (folder, _, _), (task, _, _) in zip(jobs, results) if task}
+    all_trials = list()
+    all_blocks = list()
+    for (folder, user, _), (task, trials, blocks) in zip(jobs, results):
+        task = task or folder_tasks.get(folder, folder)
+        all_trials.extend((task, user) + t for t in trials)
+        for res in blocks:
+            res['task'] = task
+        all_blocks.extend(blocks)
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    write_trials(output / 'trials.csv', all_trials)
+    write_rows(output / 'blocks.csv', BLOCK_COLUMNS, all_blocks)
+    write_rows(output / 'users.csv', USER_COLUMNS, aggregate_users(all_blocks))
+    return len(users), len(all_blocks)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m src.batch', description=__doc__.splitlines()[0])
+    parser.add_argument('root', help="Storage path of the app, containing one folder per task.")
+    parser.add_argument('-o', '--output', default='analysis', help="Directory to write results to.")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="Number of processes. Default: number of CPUs.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    n_users, n_blocks = run(args.root, args.output, args.jobs)
+    logger.info(f"Analyzed {n_blocks} blocks of {n_users} users. Results are in {args.output}.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
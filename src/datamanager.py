@@ -1,16 +1,21 @@
 # Built-in imports
 import base64
 from datetime import datetime
-import io
+from hashlib import md5
 import json
+import os
 from pathlib import Path
-import pickle
 import shutil
+import sqlite3
 import time
 from typing import List
+from urllib.parse import urlsplit, urlunsplit
+import zlib
 
 # Third party imports
 from kivy.app import App
+from kivy.clock import Clock, mainthread
+from kivy.logger import Logger
 from kivy.metrics import Metrics
 from kivy.properties import BooleanProperty
 from kivy.uix.widget import Widget
@@ -18,9 +23,19 @@ from kivy.utils import platform
 import numpy as np
 import plyer
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Own module imports
+from .analysis import SessionAnalysis
+from .datastore import DataStore
+from . import emailcodec
 from .i18n import _
+from .outbox import Outbox, UploadIndex, data_set_key
+from .recovery import SessionJournal
+from .reader import FILE_SUFFIX
+from .serializers import NpySerializer, get_serializer
+from .workers import BackgroundWorker, Job
 from .utility import (time_fmt,
                       create_device_identifier,
                       get_screensize,
@@ -32,41 +47,150 @@ if platform == 'android':
     from jnius import autoclass
 
 
+def _iter_base64(chunks):
+    """ Base64 encode a stream of byte chunks. Keeps chunk borders at multiples of 3 bytes, so no padding is
+    inserted in the middle of the output.
+    """
+    rest = b''
+    for chunk in chunks:
+        chunk = rest + chunk
+        n = len(chunk) - len(chunk) % 3
+        rest = chunk[n:]
+        if n:
+            yield base64.b64encode(chunk[:n])
+    if rest:
+        yield base64.b64encode(rest)
+
+
+def _iter_compressed(chunks, encoding):
+    """ Compress a stream of byte chunks with 'gzip' or 'deflate' content coding. """
+    # wbits of 31 writes a gzip header and trailer, 15 a zlib one.
+    compressor = zlib.compressobj(wbits=31 if encoding == 'gzip' else 15)
+    for chunk in chunks:
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+
 class DataManager(Widget):  # Inherit from Widget so we can dispatch events.
     """ Manager for data collection and saving or sending them. """
     is_data_saved = BooleanProperty(False)  # Did we save the current data?
     is_data_sent = BooleanProperty(False)  # Did we sent the current data?
+    # Retry delays in seconds for uploading data from the outbox. Doubles with each failed attempt.
+    outbox_retry_delay = 30
+    outbox_max_retry_delay = 60 * 60
+    outbox_batch_sessions = 5  # How many pending sessions to combine into one upload.
+    # Seconds to wait for a connection and for the response. A sleeping server can take a while to wake up.
+    upload_timeout = (10, 60)
+    # Compression of request bodies: 'auto' only compresses for servers that advertised support for it,
+    # 'always' tries gzip first and falls back to uncompressed, 'never' sends plain JSON.
+    # Set from the settings, this is the default.
+    upload_compression = 'auto'
+    # 'json' builds the whole request in memory. 'stream' sends it in chunks, one data set at a time,
+    # which keeps memory usage low for large sessions. The server needs to accept chunked transfer encoding.
+    # Set from the settings, this is the default.
+    upload_mode = 'json'
+    # Slider trajectories are only stored locally, unless the server is known to accept them.
+    # Set from the settings, this is the default.
+    upload_trajectories = False
+    # Path on the upload server that tells which of the block hashes posted as {"hashes": [...]} it already has,
+    # answering {"known": [...]}. Leave empty if the server doesn't support this.
+    hash_query_path = ''
+    # Columns of the session table that describes each block.
+    session_columns = ['task', 'time', 'time_iso', 'block', 'treatment', 'hash', 'warm_up', 'trial_duration',
+                       'cool_down', 'rating']
     
     def __init__(self, **kwargs):
+        # How data sets are kept in memory. CSV is only rendered when needed for files or upload.
+        self.serializer = get_serializer(kwargs.pop('serializer', 'npy'))
         super(DataManager, self).__init__(**kwargs)
         self.app = App.get_running_app()
         # Containers for data.
         self._data = list()  # type: List[dict]
+        self._n_collections = 0  # Tells results of background jobs for a cleared collection from the current one's.
         self.is_invalid = False
+        # Analysis of the blocks collected so far, updated with each trial.
+        self.analysis = SessionAnalysis()
         # For which user to collect data. Set after given consent.
         self._user_id = ''
+        # Network requests run in their own thread, so they don't block the UI.
+        self._upload_worker = BackgroundWorker(name='upload')
+        self.upload_job = None
+        # Local files are written in their own thread, so screen transitions don't stall.
+        self._io_worker = BackgroundWorker(name='io')
+        self.save_job = None
+        # Reuse connections for all uploads. Only used from the upload thread.
+        self._http_session = None
+        self._request_encodings = dict()  # Host -> content coding the server accepts for requests, '' for none.
+        # How to send requests. The app updates these when the settings change.
+        self.upload_mode = self.app.settings.upload_mode
+        self.upload_compression = self.app.settings.upload_compression
+        self.upload_trajectories = bool(self.app.settings.upload_trajectories)
+        # Data of failed uploads survive in the outbox until they're delivered.
+        self.outbox = Outbox(self.get_storage_path() / 'outbox.journal')
+        # Blocks the server has acknowledged aren't uploaded again.
+        self.upload_index = UploadIndex(self.get_storage_path() / 'uploaded.index')
+        self._outbox_retries = 0
+        self._outbox_event = None
+        # The running session is journaled, so it can be recovered when the app gets killed.
+        self.journal = SessionJournal(self.get_storage_path() / 'recovery')
+        self.recovered_session = self._load_interrupted_session()  # type: List[dict]
         # Events to listen to.
         self.app.settings.bind(on_user_removed=lambda instance, user_id: self._remove_user_folders(user_id))
+        # Deliver what's left over from previous sessions once the app is up and running.
+        if not self.outbox.is_empty():
+            self._schedule_outbox_drain(self.outbox_retry_delay)
         # Events to fire.
         self.register_event_type('on_data_processing_failed')
+        self.register_event_type('on_data_saved')
         self.register_event_type('on_data_upload')
+        self.register_event_type('on_upload_progress')
 
-    def _data2bytes(self, data, header=None, fmt="%.5f"):
-        """ Takes numpy array and returns it as bytes. """
-        with io.BytesIO() as bio:
-            if header:
-                # header = header.encode('utf-8')
-                np.savetxt(bio, data, delimiter=',', fmt=fmt, encoding='utf-8', header=header, comments='')
-            else:
-                np.savetxt(bio, data, delimiter=',', fmt=fmt, encoding='utf-8')
+    def _data2csv(self, data_set):
+        """ Returns the data of a data set as CSV bytes.
         
-            b = bio.getvalue()
-        return b
+        :param data_set: Entry of data collection.
+        :type data_set: dict
+        :rtype: bytes
+        """
+        # Data sets without format information, e.g. loaded from older e-mails, are CSV.
+        serializer = get_serializer(data_set.get('format', 'csv'))
+        return serializer.to_csv(data_set['data'])
+
+    def _data2binary(self, data_set):
+        """ Returns data set as binary container with its descriptors in the header, for memory-mapped reading.
+        
+        :param data_set: Entry of data collection.
+        :type data_set: dict
+        :return: Container bytes or None, if the data set's format can't be converted.
+        :rtype: bytes
+        """
+        serializer = get_serializer(data_set.get('format', 'csv'))
+        if not isinstance(serializer, NpySerializer):
+            return None
+        columns, data, fmt = serializer.loads(data_set['data'])
+        meta = {k: v for k, v in data_set.items() if k not in ('data', 'format')}
+        return serializer.dumps(columns, data, fmt=fmt, meta=meta)
+
+    @mainthread
+    def _dispatch_on_main(self, event_type, *args):
+        """ Dispatch event from the main thread, regardless of the thread this is called from. """
+        self.dispatch(event_type, *args)
 
     # ## Data Collection ## #
     def clear_data_collection(self):
         """ Clear data. """
+        # Keep an interrupted session on disk until it's either restored or discarded.
+        if self.recovered_session is None:
+            self._update_journal(self.journal.clear)
+        if self.save_job:
+            # Let the files of the old collection be written, but its result mustn't change the new collection's state.
+            self.save_job.detach()
+            self.save_job = None
         self._data.clear()
+        self._n_collections += 1
+        self.analysis.clear()
         self.is_invalid = False
         self.is_data_sent = False
         self.is_data_saved = False
@@ -74,6 +198,9 @@ class DataManager(Widget):  # Inherit from Widget so we can dispatch events.
     def new_data_collection(self, user_id):
         """ Start new collection. """
         self._user_id = user_id
+        self.analysis.clear()
+        self.recovered_session = None
+        self._update_journal(self.journal.start)
         # Start new data collection with device information.
         self._collect_device_data()
     
@@ -139,16 +266,137 @@ class DataManager(Widget):  # Inherit from Widget so we can dispatch events.
         :param data: numpy.ndarray
         :param meta_data: Descriptors of data, e.g. table, time.
         :type meta_data: dict
-        :param fmt: Format to use for data.
+        :param fmt: Format to use for data when rendered as text.
         :type fmt: str
         :return: None
         """
-        header = ','.join(columns)
-        meta_data['data'] = self._data2bytes(data, header=header, fmt=fmt)
+        meta_data['data'] = self.serializer.dumps(columns, data, fmt=fmt)
+        meta_data['format'] = self.serializer.name
         self._data.append(meta_data)
+        self._journal_data_set(meta_data)
+
+    # ## Recovery ## #
+    def _update_journal(self, method, *args):
+        """ Change the session journal in the I/O thread, in order with all other changes and file writes, so that
+        syncing to disk doesn't block the UI. Failing to do so mustn't interrupt the session.
+        
+        :param method: Method of the SessionJournal.
+        :param args: Arguments to call it with. They mustn't be changed afterwards.
+        :rtype: Job
+        """
+        def update(job):
+            try:
+                method(*args)
+            except OSError as e:
+                Logger.warning(f"DataManager: Unable to update session journal: {e}")
+        return self._io_worker.submit(Job(update))
+
+    def _journal_data_set(self, data_set):
+        """ Write data set to the session journal. """
+        self._update_journal(self.journal.add, dict(data_set))
+
+    def open_trial_log(self, meta_data):
+        """ Start logging the trials of a block to disk as they finish.
+        
+        :param meta_data: Descriptors of the block, like for add_data. Must contain 'block' and 'columns'.
+        :type meta_data: dict
+        """
+        self._update_journal(self.journal.open_trial_log, dict(meta_data))
+
+    def log_trial(self, trial, values):
+        """ Durably write the values of a finished trial.
+        
+        :param trial: Number of trial.
+        :type trial: int
+        :param values: One value for each of the block's columns, as they're going to be stored.
+        :type values: Iterable[float]
+        """
+        self._update_journal(self.journal.log_trial, trial, tuple(values))
+
+    def close_trial_log(self):
+        """ Stop logging trials, either because the block was added in full or because it was cancelled. """
+        self._update_journal(self.journal.close_trial_log)
+
+    def _load_interrupted_session(self):
+        """ Rebuild the data collection of a session that was interrupted.
+        
+        :return: Data sets of the session or None, if there's no block of trials to recover.
+        :rtype: list[dict]
+        """
+        try:
+            data_sets, blocks = self.journal.load()
+        except OSError as e:
+            Logger.warning(f"DataManager: Unable to read session journal: {e}")
+            return None
+        # A block's log may still exist when the app was killed right after the block was added in full.
+        finished_blocks = [d.get('block') for d in data_sets if d.get('table') == 'trials']
+        for meta_data, trials, values in blocks:
+            if meta_data.get('block') not in finished_blocks:
+                data_sets.append(self._get_recovered_block(meta_data, values))
+        if not any(d.get('table') == 'trials' for d in data_sets):
+            return None
+        if not any(d.get('table') == 'session' for d in data_sets):
+            data_sets.append(self._get_recovered_session(data_sets))
+        Logger.info(f"DataManager: Found interrupted session with {len(data_sets)} data sets.")
+        return data_sets
+
+    def _get_recovered_block(self, meta_data, values):
+        """ Data set of the trials that were logged before the block was interrupted. """
+        data_set = dict(meta_data)
+        data_set['hash'] = md5(values).hexdigest()
+        data_set['recovered'] = True  # Block is incomplete.
+        data_set['data'] = self.serializer.dumps(meta_data['columns'], values)
+        data_set['format'] = self.serializer.name
+        return data_set
+
+    def _get_recovered_session(self, data_sets):
+        """ Data set of the session table, describing each recovered block of trials. """
+        blocks = sorted((d for d in data_sets if d.get('table') == 'trials'), key=lambda d: d.get('block', 0))
+        data = np.array([[d.get(column, '') for column in self.session_columns] for d in blocks])
+        meta_data = dict()
+        meta_data['table'] = 'session'
+        meta_data['time'] = time.time()
+        meta_data['time_iso'] = datetime.now().strftime(time_fmt)
+        meta_data['task'] = blocks[-1].get('task', '')
+        meta_data['user'] = blocks[-1].get('user', '')
+        meta_data['recovered'] = True
+        meta_data['data'] = self.serializer.dumps(self.session_columns, data)
+        meta_data['format'] = self.serializer.name
+        return meta_data
+
+    def restore_recovered_session(self):
+        """ Make the interrupted session the current data collection, so it can be stored and uploaded.
+        
+        :return: Task of the restored session.
+        :rtype: str
+        """
+        data_sets = self.recovered_session or list()
+        self.recovered_session = None
+        self.clear_data_collection()
+        self._update_journal(self.journal.start)
+        for d in data_sets:
+            self._data.append(d)
+            self._journal_data_set(d)
+            if d.get('table') == 'trials':
+                self._user_id = d.get('user', self._user_id)
+                self._analyze_data_set(d)
+        return next((d['task'] for d in data_sets if d.get('task')), None)
+
+    def _analyze_data_set(self, data_set):
+        """ Add a block of trials to the analysis. Only binary data sets can be read back. """
+        serializer = get_serializer(data_set.get('format', 'csv'))
+        if not hasattr(serializer, 'loads'):
+            return
+        columns, data, fmt = serializer.loads(data_set['data'])
+        self.analysis.add_block(data_set.get('block', 0), data_set.get('treatment', ''), data)
+
+    def discard_recovered_session(self):
+        """ Remove the interrupted session from disk. """
+        self.recovered_session = None
+        self._update_journal(self.journal.clear)
 
-    def load_email_data(self, data):
-        """ After receiving an e-mail, parse the received text after ### Data ###.
+    def load_email_data(self, *texts):
+        """ After receiving one or more e-mails, parse the data encoded in them.
         There's no UI yet implemented for this. So use as follows:
         
         - Run in debug mode.
@@ -167,15 +415,19 @@ class DataManager(Widget):  # Inherit from Widget so we can dispatch events.
             
             > mgr = app.data_mgr
             
-            > mgr.load_email_data(b'...')  # Paste the copied data.
+            > mgr.load_email_data('''...''')  # Paste the copied e-mail text, one argument per e-mail.
             
             > mgr.upload_data(app.get_upload_route() + '/circletask/_dash-update-component')
             
          
-        :param data: E-mail content following ### Data ###. Don't encapsulate in quotes, it's a pickled bytes object.
-        :type data: bytes
+        :param texts: Content of the e-mails. Each may contain the whole mail, text outside the data is ignored.
+        :type texts: str
+        :raises emailcodec.DecodeError: if the data are incomplete or corrupt.
         """
-        self._data = pickle.loads(data)
+        decoder = emailcodec.Decoder()
+        for text in texts:
+            decoder.feed(text)
+        self._data = decoder.get_data_sets()
         
     # ## Data Local Storage ## #
     def get_storage_path(self):
@@ -215,6 +467,9 @@ class DataManager(Widget):  # Inherit from Widget so we can dispatch events.
         user_folders = storage_path.rglob(user_id)
         for folder in user_folders:
             shutil.rmtree(folder, ignore_errors=True)
+        self.outbox.discard_user(user_id)
+        if self.recovered_session and any(d.get('user') == user_id for d in self.recovered_session):
+            self.discard_recovered_session()
 
     def compile_filename(self, meta_data):
         """ Returns file name based on provided meta data.
@@ -230,6 +485,8 @@ class DataManager(Widget):  # Inherit from Widget so we can dispatch events.
                 file_name = f"session-{meta_data['time_iso']}.csv"
             elif meta_data['table'] == 'trials':
                 file_name = f"trials-{meta_data['time_iso']}-Block_{meta_data['block']}.csv"
+            elif meta_data['table'] == 'trajectories':
+                file_name = f"trajectories-{meta_data['time_iso']}-Block_{meta_data['block']}.csv"
             else:
                 # Fall back to current time when table unknown.
                 file_name = f'{datetime.now().strftime(time_fmt)}.csv'
@@ -239,7 +496,7 @@ class DataManager(Widget):  # Inherit from Widget so we can dispatch events.
         return file_name
 
     def write_file(self, path, content):
-        """ Save content to path.
+        """ Save content to path atomically.
 
         :param path: Path to file.
         :type path: pathlib.Path
@@ -249,64 +506,240 @@ class DataManager(Widget):  # Inherit from Widget so we can dispatch events.
         :return: Whether writing to file was successful.
         :rtype: bool
         """
-        if isinstance(content, bytes):
-            path.write_bytes(content)
-            return True
-        elif isinstance(content, str):
-            path.write_text(content)
-            return True
-        else:
-            self.dispatch('on_data_processing_failed',
-                          _("Unable to write to file:\n{}\nUnknown data format.").format(path.name))
-        return False
+        if not isinstance(content, (bytes, str)):
+            self._dispatch_on_main('on_data_processing_failed',
+                                   _("Unable to write to file:\n{}\nUnknown data format.").format(path.name))
+            return False
+        return self._write_files([(path, content)])
 
-    def write_data_to_files(self):
-        """ Writes content of data to disk. """
-        success = True
+    def _write_files(self, files):
+        """ Write several files atomically and durably. Each file is written to a temporary file first, which
+        replaces the destination once all files are synced to disk. Safe to call from any thread.
+
+        :param files: Pairs of destination path and content.
+        :type files: list[tuple[pathlib.Path,Union[bytes,str]]]
+        :return: Whether all files were written.
+        :rtype: bool
+        """
+        tmp_files = list()
+        try:
+            try:
+                for path, content in files:
+                    if isinstance(content, str):
+                        content = content.encode('utf-8')
+                    tmp_path = path.with_name(f'.{path.name}.tmp')
+                    f = open(tmp_path, 'wb')
+                    tmp_files.append((f, tmp_path, path))
+                    f.write(content)
+                # Sync all files once at the end, so the storage can batch the writes.
+                for f, tmp_path, path in tmp_files:
+                    f.flush()
+                    os.fsync(f.fileno())
+            finally:
+                for f, tmp_path, path in tmp_files:
+                    f.close()
+            for f, tmp_path, path in tmp_files:
+                os.replace(tmp_path, path)
+        except OSError as e:
+            Logger.error(f"DataManager: Unable to write files: {e}")
+            for f, tmp_path, path in tmp_files:
+                try:
+                    tmp_path.unlink()
+                except OSError:
+                    pass
+            self._dispatch_on_main('on_data_processing_failed',
+                                   _("Unable to write to file:\n{}").format(getattr(e, 'filename', '') or ''))
+            return False
+        # Make the renames durable as well.
+        for directory in {path.parent for f, tmp_path, path in tmp_files}:
+            self._fsync_dir(directory)
+        return True
+
+    @staticmethod
+    def _fsync_dir(path):
+        """ Sync a directory's entries to disk, where the platform supports it. """
+        try:
+            fd = os.open(str(path), os.O_RDONLY)
+        except OSError:
+            return  # Directories can't be opened on Windows.
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def save_data(self):
+        """ Store current data collection locally in the configured format. Runs in the background.
+        is_data_saved only becomes True once all data are durably stored, then on_data_saved is dispatched.
+        
+        :rtype: Job
+        """
+        if self.save_job and not self.save_job.is_finished:
+            return self.save_job
+        # Work on a snapshot. The storage path is determined here, because on Android that needs the main thread.
+        self.save_job = Job(self._save, self.app.settings.local_storage_format, list(self._data),
+                            self.get_storage_path(),
+                            on_done=self._on_data_saved,
+                            on_error=lambda e: self._on_data_saved(False))
+        return self._io_worker.submit(self.save_job)
+
+    def _save(self, job, storage_format, data_sets, storage):
+        """ Store data sets in the given format. Runs in the I/O thread.
+        
+        :return: Whether all data sets were stored.
+        :rtype: bool
+        """
+        if storage_format == 'sqlite':
+            return self._write_data_to_store(data_sets, storage)
+        return self._write_data_sets(data_sets, storage, binary=storage_format == 'npy')
+
+    def _on_data_saved(self, success):
+        """ Handle result of save job on the main thread. """
+        self.save_job = None
+        self.is_data_saved = success
+        self.dispatch('on_data_saved', success)
+
+    def save_trace(self, trace, meta_data):
+        """ Store a block's frame trace as Chrome trace event JSON next to the user's data. Runs in the background.
+        Like the data, traces are only stored when local storage is enabled.
+
+        :param trace: Trace as returned by FrameTrace.to_chrome_trace().
+        :type trace: dict
+        :param meta_data: Meta data of the block the trace was recorded in.
+        :type meta_data: dict
+        :return: The job writing the file, or None if local storage is disabled.
+        :rtype: Job
+        """
+        if not self.app.settings.is_local_storage_enabled:
+            return None
         storage = self.get_storage_path()
-        for d in self._data:
+        file_name = f"trace-{meta_data['time_iso']}-Block_{meta_data['block']}.json"
+        path = storage / self._get_user_folder(meta_data) / file_name
+
+        def write_trace(job):
+            path.parent.mkdir(parents=True, exist_ok=True)
+            return self._write_files([(path, json.dumps(trace))])
+        return self._io_worker.submit(Job(write_trace))
+
+    def _get_user_folder(self, data_set):
+        """ Path relative to storage path where data of data set's user and task go. """
+        return Path(data_set['task'].replace(" ", "_")) / data_set['user']
+
+    def get_store_path(self, data_sets=None, storage=None):
+        """ Path to the single-file store of the user the data sets belong to.
+        
+        :param data_sets: Data sets to store. Defaults to the current data collection.
+        :type data_sets: list[dict]
+        :param storage: Storage path. Defaults to get_storage_path().
+        :type storage: pathlib.Path
+        :rtype: pathlib.Path
+        """
+        if data_sets is None:
+            data_sets = self._data
+        if storage is None:
+            storage = self.get_storage_path()
+        for d in data_sets:
+            if 'task' in d and 'user' in d:
+                return storage / self._get_user_folder(d) / DataStore.file_name
+        raise KeyError("No data set with task and user.")
+
+    def _write_data_to_store(self, data_sets, storage):
+        """ Append data sets to the user's single-file store in one transaction. Safe to call from any thread.
+        
+        :rtype: bool
+        """
+        try:
+            path = self.get_store_path(data_sets, storage)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with DataStore(path) as store:
+                store.add(data_sets)
+        except KeyError:
+            self._dispatch_on_main('on_data_processing_failed', _("KeyError in Meta Data."))
+            return False
+        except sqlite3.Error as e:
+            Logger.error(f"DataManager: Unable to write to store: {e}")
+            self._dispatch_on_main('on_data_processing_failed',
+                                   _("Unable to write to file:\n{}").format(DataStore.file_name))
+            return False
+        return True
+
+    def write_data_to_files(self, data_sets=None, binary=False):
+        """ Writes content of data to disk.
+        
+        :param data_sets: Data sets to write. Defaults to the current data collection.
+        :type data_sets: list[dict]
+        :param binary: Write binary container files that can be memory-mapped with reader.DataCollection.
+            Data sets that can't be converted are written as CSV.
+        :type binary: bool
+        """
+        if data_sets is None:
+            data_sets = self._data
+        self.is_data_saved = self._write_data_sets(data_sets, self.get_storage_path(), binary=binary)
+
+    def _write_data_sets(self, data_sets, storage, binary=False):
+        """ Write a file for each data set. Safe to call from any thread.
+        
+        :return: Whether all files were written.
+        :rtype: bool
+        """
+        success = True
+        created_folders = set()
+        files = list()
+        for d in data_sets:
             try:
-                if d['table'] in ['session', 'trials', 'user']:
-                    sub_folder = Path(d['task'].replace(" ", "_")) / d['user']
-                    self._create_subfolder(sub_folder)
-                    dir_path = storage / sub_folder
+                if d['table'] in ['session', 'trials', 'trajectories', 'user']:
+                    dir_path = storage / self._get_user_folder(d)
                 else:
                     dir_path = storage
+                if dir_path not in created_folders:
+                    dir_path.mkdir(parents=True, exist_ok=True)  # Assume this works and we have permissions.
+                    created_folders.add(dir_path)
             except KeyError:
                 success = False
-                self.dispatch('on_data_processing_failed', _("KeyError in Meta Data."))
+                self._dispatch_on_main('on_data_processing_failed', _("KeyError in Meta Data."))
                 continue
         
             file_name = self.compile_filename(d)
             file_path = dir_path / file_name
-            # Because external storage resides on a physical volume that the user might be able to remove,
-            # verify that the volume is accessible before trying to write app-specific data to external storage.
             try:
-                success = self.write_file(file_path, d['data'])
+                content = self._data2binary(d) if binary else None
+                if content is None:
+                    content = self._data2csv(d)
+                else:
+                    file_path = file_path.with_suffix(FILE_SUFFIX)
+                files.append((file_path, content))
             except KeyError:
                 success = False
-                self.dispatch('on_data_processing_failed', _("Data missing.\nFailed to write\n{}.").format(file_name))
-        self.is_data_saved = success
+                self._dispatch_on_main('on_data_processing_failed',
+                                       _("Data missing.\nFailed to write\n{}.").format(file_name))
+        # Because external storage resides on a physical volume that the user might be able to remove,
+        # failing to write is reported instead of raised.
+        return self._write_files(files) and success
 
     # ## Data Upload ## #
-    def _get_dash_post(self):
+    def _get_dash_post(self, data_sets=None):
         """ Build a json string from collected data to post to a dash update component.
 
+        :param data_sets: Data sets to include. Defaults to the current data collection.
+        :type data_sets: list[dict]
         :return: post request json string.
         """
+        if data_sets is None:
+            data_sets = self._data
         file_names = list()
         last_modified = list()
         data = list()
     
-        for d in self._data:
+        for d in data_sets:
             # Build fake file name.
             name = self.compile_filename(d)
             file_names.append(name)
             try:
                 last_modified.append(d['time'])
-                data_b64 = base64.b64encode(d['data'])
+                data_b64 = base64.b64encode(self._data2csv(d))
             except KeyError:
-                self.dispatch('on_data_processing_failed', _("KeyError in Meta Data."))
+                self._dispatch_on_main('on_data_processing_failed', _("KeyError in Meta Data."))
                 continue
         
             data.append(data_b64)
@@ -324,14 +757,124 @@ class DataManager(Widget):  # Inherit from Widget so we can dispatch events.
                                 'value': last_modified}]}
     
         return post_data
+
+    def _iter_dash_post(self, data_sets=None):
+        """ Generate the same JSON as _get_dash_post piece by piece.
+        Only a chunk of one data set is held in memory at a time.
+
+        :param data_sets: Data sets to include. Defaults to the current data collection.
+        :type data_sets: list[dict]
+        :return: Generator of bytes.
+        """
+        if data_sets is None:
+            data_sets = self._data
+        valid_sets = list()
+        for d in data_sets:
+            if 'time' in d and 'data' in d:
+                valid_sets.append(d)
+            else:
+                self._dispatch_on_main('on_data_processing_failed', _("KeyError in Meta Data."))
+        
+        yield b'{"output": "output-data-upload.children", "changedPropIds": ["upload-data.contents"], ' \
+              b'"inputs": [{"id": "upload-data", "property": "contents", "value": ['
+        for i, d in enumerate(valid_sets):
+            yield (b', ' if i else b'') + b'"data:application/octet-stream;base64,'
+            serializer = get_serializer(d.get('format', 'csv'))
+            yield from _iter_base64(serializer.iter_csv(d['data']))
+            yield b'"'
+        file_names = [self.compile_filename(d) for d in valid_sets]
+        last_modified = [d['time'] for d in valid_sets]
+        yield (']}], "state": [{"id": "upload-data", "property": "filename", "value": '
+               + json.dumps(file_names)
+               + '}, {"id": "upload-data", "property": "last_modified", "value": '
+               + json.dumps(last_modified)
+               + '}]}').encode('utf-8')
+
+    def _get_upload_body(self, data_sets):
+        """ Return what _get_response needs to post data_sets according to upload_mode. """
+        if self.upload_mode == 'stream':
+            # Callable, because the body may have to be generated again when falling back to uncompressed.
+            return lambda: self._iter_dash_post(data_sets)
+        return self._get_dash_post(data_sets)
     
+    def _get_http_session(self):
+        """ Return the long-lived HTTP session with a connection pool. """
+        if self._http_session is None:
+            session = requests.Session()
+            # Only retry establishing connections, a POST that reached the server must not be sent twice.
+            retries = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.5)
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=2, max_retries=retries)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._http_session = session
+        return self._http_session
+
+    def _get_request_encoding(self, server):
+        """ Which content coding to use for the request body sent to server.
+        
+        :return: 'gzip', 'deflate' or '' for uncompressed.
+        :rtype: str
+        """
+        if self.upload_compression == 'never':
+            return ''
+        host = urlsplit(server).netloc
+        try:
+            return self._request_encodings[host]
+        except KeyError:
+            return 'gzip' if self.upload_compression == 'always' else ''
+
+    def _learn_request_encoding(self, server, response):
+        """ Remember which request content codings a server advertises in its Accept-Encoding header (RFC 7694). """
+        accepted = response.headers.get('Accept-Encoding')
+        if accepted is None:
+            return
+        accepted = [coding.split(';')[0].strip().lower() for coding in accepted.split(',')]
+        for coding in ('gzip', 'deflate'):
+            if coding in accepted:
+                break
+        else:
+            coding = ''
+        self._request_encodings[urlsplit(server).netloc] = coding
+
+    def _post(self, server, body, encoding=''):
+        """ Post JSON body to server, compressed with the given content coding.
+        
+        :param body: Complete body or an iterable of chunks, which is sent with chunked transfer encoding.
+        :type body: Union[bytes,Iterable[bytes]]
+        :rtype: requests.Response
+        """
+        headers = {'Content-Type': 'application/json'}
+        if encoding:
+            headers['Content-Encoding'] = encoding
+            if isinstance(body, bytes):
+                body = b''.join(_iter_compressed([body], encoding))
+            else:
+                body = _iter_compressed(body, encoding)
+        return self._get_http_session().post(server, data=body, headers=headers, timeout=self.upload_timeout)
+
     def _get_response(self, server, data):
-        """ Upload collected data to server. """
+        """ Upload collected data to server.
+        
+        :param data: JSON serializable post data, or a callable returning an iterable of JSON chunks.
+        """
         try:
-            response = requests.post(server, json=data)
+            if callable(data):
+                get_body = data
+            else:
+                body = json.dumps(data).encode('utf-8')
+                get_body = lambda: body
+            encoding = self._get_request_encoding(server)
+            response = self._post(server, get_body(), encoding)
+            if encoding and response.status_code in (400, 415):
+                # Server doesn't understand the compressed body. Don't try again with this server.
+                self._request_encodings[urlsplit(server).netloc] = ''
+                response = self._post(server, get_body())
+            self._learn_request_encoding(server, response)
             returned_txt = response.text
         except (requests.exceptions.InvalidSchema, requests.exceptions.ConnectionError):
             returned_txt = _("ERROR: Server not reachable:") + f"\n{server}"
+        except requests.exceptions.Timeout:
+            returned_txt = _("ERROR: Server did not respond in time:") + f"\n{server}"
         except Exception:
             returned_txt = _("ERROR: There was an error processing the upload.")
         return returned_txt
@@ -382,18 +925,196 @@ class DataManager(Widget):  # Inherit from Widget so we can dispatch events.
         return True
     
     def upload_data(self, route):
-        """ Upload collected data to server. """
+        """ Upload collected data to server in a background thread.
+        The result is dispatched with the on_data_upload event on the main thread.
+        
+        :return: The running upload, if we have permission to access the Internet.
+        :rtype: Job
+        """
         # Since ask_permission first checks for permission and, if present, doesn't trigger the callback, this does
         # not result in an endless loop.
         permission = ask_permission(Permission.INTERNET, callback=self._on_internet_permission_request)
         if permission:
-            res = self._get_response(route, self._get_dash_post())
-            res_msg = self._parse_response(res)
-            status = self._get_uploaded_status(res_msg)
+            # Don't send the same data twice in parallel.
+            if self.upload_job and not self.upload_job.is_finished:
+                return self.upload_job
+            # Work on a snapshot, the collection may change while we're uploading.
+            data_sets = [d for d in self._data if self.upload_trajectories or d.get('table') != 'trajectories']
+            self.upload_job = Job(self._upload, route, data_sets, self._n_collections,
+                                  on_done=self._on_upload_done,
+                                  on_progress=lambda fraction, msg: self.dispatch('on_upload_progress', fraction, msg),
+                                  on_error=lambda e: self._on_upload_done(
+                                      (False, _("ERROR: There was an error processing the upload."))),
+                                  )
+            return self._upload_worker.submit(self.upload_job)
+
+    def _get_block_hashes(self, data_sets):
+        """ Hashes of the blocks among data sets. """
+        return [d['hash'] for d in data_sets if 'hash' in d]
+
+    def _query_known_hashes(self, route, hashes):
+        """ Ask the server which of the block hashes it already has. Runs in the upload thread.
+        
+        :return: Hashes known to the server. Empty if the server doesn't support the query or didn't answer.
+        :rtype: set[str]
+        """
+        if not self.hash_query_path or not hashes:
+            return set()
+        parts = urlsplit(route)
+        url = urlunsplit((parts.scheme, parts.netloc, self.hash_query_path, '', ''))
+        try:
+            response = self._get_http_session().post(url, json={'hashes': hashes}, timeout=self.upload_timeout)
+            response.raise_for_status()
+            known = set(response.json()['known'])
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+            return set()
+        return known.intersection(hashes)
+
+    def _remove_uploaded(self, route, data_sets):
+        """ Leave out blocks that were already uploaded. Runs in the upload thread.
+        
+        :return: Data sets to upload. Empty if all blocks were uploaded before.
+        :rtype: list[dict]
+        """
+        hashes = self._get_block_hashes(data_sets)
+        unseen = [h for h in hashes if h not in self.upload_index]
+        known = self._query_known_hashes(route, unseen)
+        if known:
+            self.upload_index.add(known)
+        unseen = set(unseen) - known
+        if hashes and not unseen:
+            return list()
+        return [d for d in data_sets if 'hash' not in d or d['hash'] in unseen]
+
+    def _upload(self, job, route, data_sets, collection):
+        """ Upload data sets and record the result. Runs in the upload thread.
+        
+        :type job: Job
+        :param collection: Number of the data collection the data sets belong to.
+        :type collection: int
+        :return: Upload status and message.
+        :rtype: tuple[bool, str]
+        """
+        status, res_msg = self._post_data_sets(job, route, data_sets)
+        # The job's callbacks are dropped when the upload gets cancelled. But once the request was sent the server may
+        # have the data, so the result is recorded regardless.
+        self._on_upload_sent(status, collection)
+        return status, res_msg
+
+    def _post_data_sets(self, job, route, data_sets):
+        """ Serialize and post data sets. Runs in the upload thread.
+        
+        :type job: Job
+        :return: Upload status and message.
+        :rtype: tuple[bool, str]
+        """
+        job.report_progress(0.0, _("Preparing data..."))
+        unseen_sets = self._remove_uploaded(route, data_sets)
+        job.check_cancelled()
+        if not unseen_sets:
+            self.outbox.ack([data_set_key(d) for d in data_sets])
+            return True, _("These data were already uploaded.")
+        post_data = self._get_upload_body(unseen_sets)
+        job.check_cancelled()
+        job.report_progress(0.2, _("Waking up server.\nPlease be patient."))
+        # Once the request is sent, the server may accept it. So from here on the response is always recorded,
+        # even when the upload gets cancelled, or the same blocks would be sent again.
+        res = self._get_response(route, post_data)
+        job.report_progress(1.0, _("Processing response..."))
+        res_msg = self._parse_response(res)
+        status = self._get_uploaded_status(res_msg)
+        if status:
+            self.upload_index.add(self._get_block_hashes(unseen_sets))
+            # These data may have been stored in the outbox by an earlier attempt.
+            self.outbox.ack([data_set_key(d) for d in data_sets])
+        else:
+            self.outbox.put_session(route, data_sets)
+            res_msg += "\n" + _("The data were stored and will be uploaded automatically later.")
+        return status, res_msg
+
+    @mainthread
+    def _on_upload_sent(self, status, collection):
+        """ Record the result of an upload on the main thread, even if nobody is waiting for it anymore. """
+        # Results for a collection that was cleared meanwhile don't apply to the current one.
+        if collection == self._n_collections:
             self.is_data_sent = status
-            # Inform any listeners about the result.
-            self.dispatch('on_data_upload', status, res_msg)
-            return status, res_msg
+            if status:
+                # The server has the session now, no need to recover it.
+                self._update_journal(self.journal.clear)
+        # Either we're online now, or there's something new to retry.
+        if not self.outbox.is_empty():
+            self._schedule_outbox_drain(0 if status else self._get_outbox_retry_delay())
+
+    def _on_upload_done(self, result):
+        """ Report the result of the upload job on the main thread. """
+        status, res_msg = result
+        self.upload_job = None
+        # Inform any listeners about the result.
+        self.dispatch('on_data_upload', status, res_msg)
+
+    # ## Outbox ## #
+    def _get_outbox_retry_delay(self):
+        """ Exponential backoff for retrying uploads from the outbox. """
+        delay = min(self.outbox_retry_delay * 2 ** self._outbox_retries, self.outbox_max_retry_delay)
+        self._outbox_retries += 1
+        return delay
+
+    def _schedule_outbox_drain(self, delay):
+        """ Schedule the next attempt to upload data from the outbox, replacing any scheduled attempt. """
+        if self._outbox_event:
+            self._outbox_event.cancel()
+        self._outbox_event = Clock.schedule_once(lambda dt: self.drain_outbox(), delay)
+
+    def drain_outbox(self):
+        """ Upload a batch of data sets stored in the outbox in the background. """
+        self._outbox_event = None
+        if self.outbox.is_empty() or not ask_permission(Permission.INTERNET):
+            return
+        self._upload_worker.submit(Job(self._upload_outbox_batch,
+                                       on_done=self._on_outbox_batch_done,
+                                       on_error=lambda e: self._on_outbox_batch_done(False),
+                                       ))
+
+    def _upload_outbox_batch(self, job):
+        """ Combine several pending sessions into one upload. Runs in the upload thread.
+        
+        :return: Whether the batch was delivered.
+        :rtype: bool
+        """
+        route, keys, data_sets = self.outbox.next_batch(max_sessions=self.outbox_batch_sessions)
+        if not data_sets:
+            return True
+        unseen_sets = self._remove_uploaded(route, data_sets)
+        if not unseen_sets:
+            self.outbox.ack(keys)
+            return True
+        res_msg = self._parse_response(self._get_response(route, self._get_upload_body(unseen_sets)))
+        status = self._get_uploaded_status(res_msg)
+        if status:
+            self.upload_index.add(self._get_block_hashes(unseen_sets))
+            self.outbox.ack(keys)
+            Logger.info(f"DataManager: Uploaded {len(keys)} data sets from outbox.")
+        else:
+            Logger.warning(f"DataManager: Upload from outbox failed: {res_msg}")
+        return status
+
+    def _on_outbox_batch_done(self, status):
+        """ Continue with the next batch or retry later. """
+        if status:
+            self._outbox_retries = 0
+            if not self.outbox.is_empty():
+                self._schedule_outbox_drain(0)
+        else:
+            self._schedule_outbox_drain(self._get_outbox_retry_delay())
+
+    def cancel_upload(self):
+        """ Stop waiting for the current upload. An upload that hasn't sent its request yet is dropped.
+        A request that's already sent can't be taken back. When its response arrives it's still recorded, e.g. that
+        the data were sent, but not reported.
+        """
+        if self.upload_job:
+            self.upload_job.cancel()
+            self.upload_job = None
 
     def _on_internet_permission_request(self, permissions, grant_results):
         """ Callback receiving results of permission request.
@@ -429,12 +1150,14 @@ class DataManager(Widget):  # Inherit from Widget so we can dispatch events.
                        "for the purpose of anonymization. The research data itself does not contain personal "
                        "or sensitive information that could be used to identify you.\n")
     
-        text = "\n\n### Data ###\n\n"
-        # Dump everything as 1 big chunk.
-        text += str(pickle.dumps(self._data))
-    
+        # Large sessions are split across several e-mails.
+        parts = emailcodec.encode(self._data)
         create_chooser = True
-        plyer.email.send(recipient=recipient, subject=subject, text=disclaimer + text, create_chooser=create_chooser)
+        for i, part in enumerate(parts, start=1):
+            part_subject = subject if len(parts) == 1 else f"{subject} ({i}/{len(parts)})"
+            text = "\n\n### Data ###\n\n" + part
+            plyer.email.send(recipient=recipient, subject=part_subject, text=disclaimer + text,
+                             create_chooser=create_chooser)
 
     # ## Events ## #
     def on_is_data_saved(self, instance, value):
@@ -446,5 +1169,11 @@ class DataManager(Widget):  # Inherit from Widget so we can dispatch events.
     def on_data_processing_failed(self, *args):
         pass
 
+    def on_data_saved(self, *args):
+        pass
+
     def on_data_upload(self, *args):
         pass
+
+    def on_upload_progress(self, *args):
+        pass
@@ -0,0 +1,112 @@
+""" Single-file local store of a user's data sets.
+
+Instead of a CSV file per table and block, all data sets of a user are kept in one SQLite database in WAL mode.
+A session's data sets are added in one transaction, so the store never contains half a session. The batch analysis
+(see batch.py) reads the stores directly.
+"""
+import json
+from pathlib import Path
+import sqlite3
+
+from .outbox import data_set_key
+
+
+class DataStore:
+    """ SQLite database of data sets, keyed like the outbox, so the same data set is never stored twice. """
+    file_name = 'data.sqlite'
+
+    def __init__(self, path):
+        """
+        :param path: Database file. Created if it doesn't exist.
+        :type path: Union[str,pathlib.Path]
+        """
+        self.path = Path(path)
+        self._connection = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self.open().execute("SELECT COUNT(*) FROM data_sets").fetchone()[0]
+
+    def open(self):
+        """ Connect to the database and create its schema if necessary.
+
+        :rtype: sqlite3.Connection
+        """
+        if self._connection is None:
+            connection = sqlite3.connect(str(self.path))
+            # Appending doesn't rewrite the database, and readers don't block the writer.
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS data_sets ("
+                                   "key TEXT PRIMARY KEY, "
+                                   "table_name TEXT NOT NULL, "
+                                   "task TEXT, "
+                                   "user TEXT, "
+                                   "block INTEGER, "
+                                   "time REAL, "
+                                   "time_iso TEXT, "
+                                   "hash TEXT, "
+                                   "format TEXT NOT NULL, "
+                                   "meta TEXT NOT NULL, "
+                                   "data BLOB NOT NULL)")
+                connection.execute("CREATE INDEX IF NOT EXISTS data_sets_table ON data_sets (table_name, block)")
+            self._connection = connection
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def add(self, data_sets):
+        """ Append data sets in a single transaction. Data sets that are already stored are skipped.
+
+        :param data_sets: Entries of the DataManager's data collection.
+        :type data_sets: list[dict]
+        :return: Number of data sets that were added.
+        :rtype: int
+        """
+        rows = list()
+        for d in data_sets:
+            meta = {k: v for k, v in d.items() if k not in ('data', 'format')}
+            rows.append((data_set_key(d),
+                         d['table'],
+                         d.get('task'),
+                         d.get('user'),
+                         d.get('block'),
+                         d.get('time'),
+                         d.get('time_iso'),
+                         d.get('hash'),
+                         d.get('format', 'csv'),
+                         json.dumps(meta),
+                         d['data']))
+        connection = self.open()
+        with connection:
+            n_before = connection.total_changes
+            connection.executemany("INSERT OR IGNORE INTO data_sets VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            return connection.total_changes - n_before
+
+    def iter_data_sets(self, table=None):
+        """ Yield stored data sets in the order they were added, optionally only those of a table.
+
+        :param table: Name of table, e.g. 'trials'.
+        :type table: str
+        :return: Generator of data sets like the DataManager's.
+        """
+        query = "SELECT format, meta, data FROM data_sets"
+        params = ()
+        if table:
+            query += " WHERE table_name = ?"
+            params = (table,)
+        for fmt, meta, data in self.open().execute(query + " ORDER BY rowid", params):
+            data_set = json.loads(meta)
+            data_set['format'] = fmt
+            data_set['data'] = bytes(data)
+            yield data_set
@@ -0,0 +1,252 @@
+""" Text encoding of data collections for sending them by e-mail.
+
+The data sets are packed into a versioned binary container, compressed, base85 encoded and wrapped into lines of fixed
+width. Large collections are split into several parts, each of which fits into one e-mail:
+
+    -----BEGIN NPSY DATA <id> <part>/<total> <crc32 of container>-----
+    <base85 lines>
+    -----END NPSY DATA-----
+
+Container layout (little-endian): 4 bytes magic b'NPEM', 1 byte version, 1 byte compression, then the compressed
+sequence of data sets. Each data set is a 4 byte unsigned length and JSON of its descriptors, followed by a 4 byte
+unsigned length and the data set's bytes.
+
+Decoding never executes anything from the received text, unlike unpickling.
+"""
+import base64
+import json
+import re
+import struct
+import uuid
+import zlib
+
+try:
+    import lzma
+except ImportError:  # Not necessarily available on mobile builds.
+    lzma = None
+
+MAGIC = b'NPEM'
+VERSION = 1
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZMA = 2
+COMPRESSIONS = {'none': COMPRESSION_NONE, 'zlib': COMPRESSION_ZLIB, 'lzma': COMPRESSION_LZMA}
+LINE_WIDTH = 80  # Multiple of 5, so each line decodes on its own.
+MAX_PART_CHARS = 400 * 1024  # Keep e-mails well below what intents and mail servers accept.
+MAX_DATA_SIZE = 512 * 1024 * 1024  # Refuse to decompress more than this.
+
+_prefix = struct.Struct('<4sBB')
+_length = struct.Struct('<I')
+_begin = re.compile(r'^-----BEGIN NPSY DATA (?P<id>[0-9a-f]+) (?P<part>\d+)/(?P<total>\d+) (?P<crc>[0-9a-f]{8})-----$')
+_end = '-----END NPSY DATA-----'
+
+
+def _pack(data_sets):
+    """ Generate the uncompressed sequence of data sets. """
+    for d in data_sets:
+        meta = {k: v for k, v in d.items() if k != 'data'}
+        meta = json.dumps(meta).encode('utf-8')
+        data = d['data']
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        yield _length.pack(len(meta)) + meta
+        yield _length.pack(len(data))
+        yield data
+
+
+def dumps(data_sets, compression='zlib'):
+    """ Pack data sets into a compressed binary container.
+
+    :param data_sets: Entries of the DataManager's data collection.
+    :type data_sets: list[dict]
+    :param compression: 'zlib', 'lzma' or 'none'. Falls back to zlib if lzma isn't available.
+    :type compression: str
+    :rtype: bytes
+    """
+    if compression == 'lzma' and lzma is None:
+        compression = 'zlib'
+    method = COMPRESSIONS[compression]
+    if method == COMPRESSION_ZLIB:
+        compressor = zlib.compressobj(level=9)
+    elif method == COMPRESSION_LZMA:
+        compressor = lzma.LZMACompressor()
+    else:
+        compressor = None
+    chunks = [_prefix.pack(MAGIC, VERSION, method)]
+    for chunk in _pack(data_sets):
+        chunks.append(compressor.compress(chunk) if compressor else chunk)
+    if compressor:
+        chunks.append(compressor.flush())
+    return b''.join(chunks)
+
+
+def encode(data_sets, compression='zlib', max_part_chars=MAX_PART_CHARS):
+    """ Encode data sets as text, split into parts that are to be sent as separate e-mails.
+
+    :param data_sets: Entries of the DataManager's data collection.
+    :type data_sets: list[dict]
+    :param compression: 'zlib', 'lzma' or 'none'.
+    :type compression: str
+    :param max_part_chars: Approximate maximum size of a part's text.
+    :type max_part_chars: int
+    :return: Text of each part.
+    :rtype: list[str]
+    """
+    container = dumps(data_sets, compression=compression)
+    crc = zlib.crc32(container)
+    text = base64.b85encode(container).decode('ascii')
+    lines = [text[i:i + LINE_WIDTH] for i in range(0, len(text), LINE_WIDTH)]
+    lines_per_part = max(1, max_part_chars // (LINE_WIDTH + 1))
+    parts = [lines[i:i + lines_per_part] for i in range(0, len(lines), lines_per_part)] or [[]]
+    collection_id = uuid.uuid4().hex[:12]
+    return [f"-----BEGIN NPSY DATA {collection_id} {i}/{len(parts)} {crc:08x}-----\n"
+            + ''.join(line + '\n' for line in part)
+            + _end + '\n'
+            for i, part in enumerate(parts, start=1)]
+
+
+class DecodeError(ValueError):
+    """ Raised when received text isn't a complete and intact encoded data collection. """
+
+
+class Decoder:
+    """ Reassembles data collections from the text of one or more e-mails, fed in any order and in any chunks.
+
+    Usage::
+
+        decoder = Decoder()
+        for text in mails:
+            decoder.feed(text)
+        data_sets = decoder.get_data_sets()
+    """
+    def __init__(self, max_size=MAX_DATA_SIZE):
+        """
+        :param max_size: Maximum number of bytes a collection may decompress to.
+        :type max_size: int
+        """
+        self.max_size = max_size
+        self._collections = dict()  # id -> {'total': int, 'crc': int, 'parts': {part: bytes}}
+        self._current = None  # (id, part number, list of decoded lines) while inside a part.
+        self._rest = ''  # Incomplete last line of the previous chunk.
+
+    def feed(self, text):
+        """ Process a chunk of received text. Anything outside of the markers, e.g. the disclaimer, is ignored.
+
+        :type text: str
+        """
+        lines = (self._rest + text).split('\n')
+        self._rest = lines.pop()
+        for line in lines:
+            self._feed_line(line.strip())
+
+    def _feed_line(self, line):
+        begin = _begin.match(line)
+        if begin:
+            self._collections.setdefault(begin['id'], {'total': int(begin['total']),
+                                                        'crc': int(begin['crc'], 16),
+                                                        'parts': dict()})
+            self._current = (begin['id'], int(begin['part']), list())
+        elif self._current is None:
+            return
+        elif line == _end:
+            collection_id, part, chunks = self._current
+            self._collections[collection_id]['parts'][part] = b''.join(chunks)
+            self._current = None
+        elif line:
+            try:
+                self._current[2].append(base64.b85decode(line))
+            except ValueError:
+                raise DecodeError("Corrupt line in encoded data. The e-mail may have been altered.")
+
+    def is_complete(self):
+        """ Whether all parts of all collections seen so far have been received. """
+        return bool(self._collections) and all(len(c['parts']) == c['total'] for c in self._collections.values())
+
+    def get_missing_parts(self):
+        """ Numbers of parts that are still missing for each collection.
+
+        :rtype: dict
+        """
+        return {collection_id: sorted(set(range(1, c['total'] + 1)) - set(c['parts']))
+                for collection_id, c in self._collections.items()}
+
+    def get_data_sets(self):
+        """ Data sets of all complete collections.
+
+        :rtype: list[dict]
+        :raises DecodeError: if parts are missing or data are corrupt.
+        """
+        self.feed('\n')  # Process a last line without line break.
+        if not self._collections:
+            raise DecodeError("No encoded data found.")
+        missing = {k: v for k, v in self.get_missing_parts().items() if v}
+        if missing:
+            raise DecodeError(f"Missing parts: {missing}")
+        data_sets = list()
+        for c in self._collections.values():
+            container = b''.join(c['parts'][i] for i in range(1, c['total'] + 1))
+            if zlib.crc32(container) != c['crc']:
+                raise DecodeError("Checksum mismatch. The e-mail may have been altered.")
+            data_sets.extend(loads(container, max_size=self.max_size))
+        return data_sets
+
+
+def _decompress(payload, method, max_size):
+    if method == COMPRESSION_NONE:
+        data = payload
+    elif method == COMPRESSION_ZLIB:
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(payload, max_size)
+        if decompressor.unconsumed_tail:
+            raise DecodeError("Data exceed the maximum size.")
+    elif method == COMPRESSION_LZMA:
+        if lzma is None:
+            raise DecodeError("LZMA compression isn't supported on this system.")
+        decompressor = lzma.LZMADecompressor()
+        data = decompressor.decompress(payload, max_length=max_size)
+        if not decompressor.eof:
+            raise DecodeError("Data exceed the maximum size or are incomplete.")
+    else:
+        raise DecodeError(f"Unknown compression {method}.")
+    return data
+
+
+def loads(container, max_size=MAX_DATA_SIZE):
+    """ Unpack data sets from a binary container.
+
+    :type container: bytes
+    :rtype: list[dict]
+    :raises DecodeError: if the container is corrupt or of an unsupported version.
+    """
+    try:
+        magic, version, method = _prefix.unpack_from(container)
+    except struct.error:
+        raise DecodeError("Incomplete data.")
+    if magic != MAGIC:
+        raise DecodeError("Not an encoded data collection.")
+    if version > VERSION:
+        raise DecodeError(f"Unsupported version {version}. Please update the app.")
+    errors = (zlib.error, lzma.LZMAError) if lzma else (zlib.error,)
+    try:
+        data = _decompress(container[_prefix.size:], method, max_size)
+    except errors as e:
+        raise DecodeError(f"Unable to decompress data: {e}")
+    data_sets = list()
+    view = memoryview(data)
+    offset = 0
+    try:
+        while offset < len(data):
+            size, = _length.unpack_from(view, offset)
+            offset += _length.size
+            meta = json.loads(bytes(view[offset:offset + size]).decode('utf-8'))
+            offset += size
+            size, = _length.unpack_from(view, offset)
+            offset += _length.size
+            if offset + size > len(data):
+                raise DecodeError("Incomplete data.")
+            meta['data'] = bytes(view[offset:offset + size])
+            offset += size
+            data_sets.append(meta)
+    except (struct.error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise DecodeError(f"Corrupt data: {e}")
+    return data_sets
@@ -0,0 +1,140 @@
+""" Opt-in instrumentation of frame timing during tasks.
+
+Records the duration of each frame from Kivy's Clock together with trial events like onsets, slider grabs and sound
+cues, so frame hitches can be related to what happened in the task. All memory is allocated up front. The recording
+can be exported in Chrome's trace event format and viewed in chrome://tracing or https://ui.perfetto.dev.
+"""
+import numpy as np
+from kivy.clock import Clock
+
+from .timing import TrialClock
+from .trajectory import RingBuffer
+
+
+class FrameTrace:
+    """ Frame times and task events on the trial clock. """
+    hitch_factor = 2.0  # Frames taking longer than this many times the median are counted as hitches.
+
+    def __init__(self, max_frames=2**15, max_events=4096, clock=None):
+        """
+        :param max_frames: Number of frames to keep. Older frames get overwritten.
+        :type max_frames: int
+        :param max_events: Number of events to keep. Older events get overwritten.
+        :type max_events: int
+        :param clock: Clock the task measures its events with.
+        :type clock: TrialClock
+        """
+        self.clock = clock or TrialClock()
+        self._frames = RingBuffer(max_frames, 2)  # Start and duration of frame.
+        self._events = RingBuffer(max_events, 3)  # Time, index of name, value.
+        self.event_names = list()
+        self._last_frame = None
+        self._schedule = None
+
+    @property
+    def is_running(self):
+        return self._schedule is not None
+
+    def start(self):
+        """ Begin recording frames. """
+        if self._schedule:
+            return
+        self._last_frame = self.clock.now()
+        # An interval of 0 calls back once per frame.
+        self._schedule = Clock.schedule_interval(self._on_frame, 0)
+
+    def stop(self):
+        """ Stop recording frames. What was recorded is kept. """
+        if self._schedule:
+            self._schedule.cancel()
+            self._schedule = None
+
+    def clear(self):
+        self._frames.clear()
+        self._events.clear()
+        self._last_frame = self.clock.now()
+
+    def _on_frame(self, dt):
+        now = self.clock.now()
+        self._frames.append((self._last_frame, now - self._last_frame))
+        self._last_frame = now
+
+    def mark(self, name, value=0, t=None):
+        """ Record a task event.
+
+        :param name: Name of event, e.g. 'start_trial'.
+        :type name: str
+        :param value: Number attached to the event, e.g. the trial.
+        :type value: float
+        :param t: Time of event on the trial clock. Defaults to now.
+        :type t: float
+        """
+        try:
+            index = self.event_names.index(name)
+        except ValueError:
+            index = len(self.event_names)
+            self.event_names.append(name)
+        self._events.append((self.clock.now() if t is None else t, index, value))
+
+    def get_frames(self, last=None):
+        """ Recorded frames in chronological order.
+
+        :param last: Only return this many of the most recent frames.
+        :type last: int
+        :return: Array with start and duration of each frame in seconds.
+        :rtype: numpy.ndarray
+        """
+        return self._frames.tail(len(self._frames) if last is None else last)
+
+    def get_events(self):
+        """ Recorded events in chronological order.
+
+        :return: Array with time, index into event_names and value of each event.
+        :rtype: numpy.ndarray
+        """
+        return self._events.tail(len(self._events))
+
+    def get_stats(self, last=None):
+        """ Summary of frame timing, e.g. to attach to a block's meta data.
+
+        :param last: Only consider this many of the most recent frames.
+        :type last: int
+        :rtype: dict
+        """
+        durations = self.get_frames(last)[:, 1] * 1e3
+        if not len(durations):
+            return {'n_frames': 0}
+        median = np.median(durations)
+        return {'n_frames': len(durations),
+                'frame_rate': round(float(1e3 / durations.mean()), 2),
+                'frame_p50_ms': round(float(median), 3),
+                'frame_p99_ms': round(float(np.percentile(durations, 99)), 3),
+                'frame_max_ms': round(float(durations.max()), 3),
+                'jitter_ms': round(float(durations.std()), 3),
+                'n_hitches': int((durations > median * self.hitch_factor).sum()),
+                }
+
+    def to_chrome_trace(self, meta=None):
+        """ Recording in Chrome's trace event format. Times are relative to the first frame or event.
+
+        :param meta: Information to include in the trace, e.g. the block's meta data.
+        :type meta: dict
+        :return: JSON serializable trace.
+        :rtype: dict
+        """
+        frames = self.get_frames()
+        events = self.get_events()
+        starts = [a[0, 0] for a in (frames, events) if len(a)]
+        origin = min(starts) if starts else 0.0
+        trace_events = [{'name': 'frame', 'cat': 'frame', 'ph': 'X', 'pid': 0, 'tid': 0,
+                         'ts': round(float(start - origin) * 1e6, 1), 'dur': round(float(duration) * 1e6, 1)}
+                        for start, duration in frames]
+        trace_events.extend({'name': self.event_names[int(index)], 'cat': 'task', 'ph': 'i', 's': 'g', 'pid': 0,
+                             'tid': 1, 'ts': round(float(t - origin) * 1e6, 1), 'args': {'value': float(value)}}
+                            for t, index, value in events)
+        trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': 0, 'args': {'name': 'Frames'}})
+        trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': 1, 'args': {'name': 'Task'}})
+        return {'traceEvents': trace_events,
+                'displayTimeUnit': 'ms',
+                'metadata': dict(meta or {}, stats=self.get_stats()),
+                }
@@ -43,13 +43,15 @@ def change_language_to(new_language):
       This code must be listed in :func:`list_languages`.
     :raises ValueError: if :paramref:`new_language` is not listed by
       :func:`list_languages`
+    :return: the number of kv rules that were updated
+    :rtype: int
     """
     assert new_language in list_languages()
     global _locales, _current_language
     _locales = gettext.translation(DOMAIN, _locale_dir,
                                    languages=[new_language])
     _current_language = new_language
-    _.language_changed()
+    return _.language_changed()
 
 
 _supported_languages = []
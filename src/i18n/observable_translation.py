@@ -5,8 +5,33 @@ The functionality of this module is highly inspired by
 
 This module is taken from https://github.com/fossasia/kniteditor/tree/master/kniteditor/localization under terms of the
 LGPL-3.0, see LICENSE file in this module.
+
+Observers are kept in a registry keyed by uid, so binding and unbinding
+don't scan all observers. Kv rules reference their widgets through weak
+proxies. Observers of widgets that were garbage collected are pruned, when
+they're found during a language change and regularly while binding.
 """
+import weakref
+
 from kivy.lang import Observable
+from kivy.weakproxy import WeakProxy
+
+
+def _is_dead(args):
+    """Whether a widget referenced by the observer's arguments no longer exists.
+
+    :param args: arguments kivy passed when binding, may be nested
+    :rtype: bool
+    """
+    # isinstance() would ask the proxy for its class.
+    if type(args) in (tuple, list):
+        return any(_is_dead(arg) for arg in args)
+    if type(args) is WeakProxy:
+        try:
+            args.__class__
+        except ReferenceError:
+            return True
+    return False
 
 
 class ObservableTranslation(Observable):
@@ -21,7 +46,10 @@ class ObservableTranslation(Observable):
         """
         super().__init__()
         self._translate = translate
-        self._observers = []
+        self._observers = {}  # uid -> (key, function reference, args, kwargs)
+        self._uids = {}  # key -> uid
+        self._next_uid = 1
+        self._prune_at = 64  # Sweep for dead observers when there are this many.
 
     def __call__(self, text):
         """Call this object to translate text.
@@ -31,20 +59,88 @@ class ObservableTranslation(Observable):
         """
         return self._translate(text)
 
+    def __len__(self):
+        """The number of registered observers."""
+        return len(self._observers)
+
+    @staticmethod
+    def _get_key(name, func, args):
+        """Key of an observer in the index. Bound methods shouldn't keep their object alive."""
+        if hasattr(func, '__self__'):
+            return name, id(func.__self__), func.__func__, id(args)
+        return name, func, id(args)
+
     def fbind(self, name, func, args, **kwargs):
-        """Add an observer. This is used by kivy."""
-        self._observers.append((name, func, args, kwargs))
+        """Add an observer. This is used by kivy.
+
+        :return: the uid of the observer for :meth:`unbind_uid`
+        :rtype: int
+        """
+        if len(self._observers) >= self._prune_at:
+            self.prune()
+            self._prune_at = max(64, 2 * len(self._observers))
+        uid = self._next_uid
+        self._next_uid += 1
+        func_ref = weakref.WeakMethod(func) if hasattr(func, '__self__') else (lambda: func)
+        key = self._get_key(name, func, args)
+        self._observers[uid] = (key, func_ref, args, kwargs)
+        self._uids[key] = uid
+        return uid
+
+    def unbind_uid(self, name, uid):
+        """Remove an observer by the uid returned by :meth:`fbind`."""
+        observer = self._observers.pop(uid, None)
+        if observer is not None and self._uids.get(observer[0]) == uid:
+            del self._uids[observer[0]]
 
     def funbind(self, name, func, args, **kwargs):
         """Remove an observer. This is used by kivy."""
-        key = (name, func, args, kwargs)
-        if key in self._observers:
-            self._observers.remove(key)
+        uid = self._uids.get(self._get_key(name, func, args))
+        if uid is None:
+            # Arguments may be an equal but different object.
+            for uid, (key, func_ref, observer_args, observer_kwargs) in self._observers.items():
+                if (key[0], func_ref(), observer_args, observer_kwargs) == (name, func, args, kwargs):
+                    break
+            else:
+                return
+        self.unbind_uid(name, uid)
+
+    def prune(self):
+        """Remove observers of widgets that no longer exist.
+
+        :return: the number of removed observers
+        :rtype: int
+        """
+        dead = [uid for uid, (key, func_ref, args, kwargs) in self._observers.items()
+                if func_ref() is None or _is_dead(args)]
+        for uid in dead:
+            self.unbind_uid(None, uid)
+        return len(dead)
 
     def language_changed(self):
-        """Update all the kv rules attached to this text."""
-        for name, func, args, kwargs in self._observers:
-            func(args, None, None)
+        """Update all the kv rules attached to this text.
+
+        :return: the number of observers that were updated
+        :rtype: int
+        """
+        dead = []
+        n_updated = 0
+        # Observers may bind or unbind while being updated, so iterate over a copy.
+        for uid, (key, func_ref, args, kwargs) in list(self._observers.items()):
+            func = func_ref()
+            if func is None:
+                dead.append(uid)
+                continue
+            try:
+                func(args, None, None)
+            except ReferenceError:
+                # The widget of this rule was garbage collected.
+                dead.append(uid)
+            else:
+                n_updated += 1
+        for uid in dead:
+            self.unbind_uid(None, uid)
+        return n_updated
 
 
 __all__ = ["ObservableTranslation"]
@@ -0,0 +1,264 @@
+""" Durable storage for data that couldn't be uploaded yet.
+
+The outbox is an append-only journal of JSON lines. Each 'put' line holds one data set of a session together with the
+upload route it was meant for, each 'ack' line marks data sets as delivered. Replaying the journal yields what is still
+pending. Delivery is at-least-once: a data set is only acknowledged after the server answered successfully, so it may be
+sent again if the app dies in between.
+"""
+import base64
+from collections import OrderedDict
+from hashlib import md5
+import json
+import os
+import threading
+import uuid
+
+from kivy.logger import Logger
+
+
+def data_set_key(data_set):
+    """ Return the key that identifies a data set for delivery.
+    Blocks of trials already carry an md5 hash of their data, other tables get one from their table name and content.
+
+    :type data_set: dict
+    :rtype: str
+    """
+    try:
+        return data_set['hash']
+    except KeyError:
+        return f"{data_set.get('table', 'unknown')}-{md5(data_set['data']).hexdigest()}"
+
+
+def _json_default(obj):
+    """ Convert values that json can't handle natively, e.g. numpy scalars and bytes. """
+    if isinstance(obj, bytes):
+        return {'__bytes__': base64.b64encode(obj).decode('ascii')}
+    try:
+        return obj.item()  # numpy scalars.
+    except AttributeError:
+        return str(obj)
+
+
+def _json_object_hook(obj):
+    if '__bytes__' in obj:
+        return base64.b64decode(obj['__bytes__'])
+    return obj
+
+
+def dump_record(record):
+    """ Serialize a journal record, which may contain bytes, to a single line of JSON.
+
+    :type record: dict
+    :rtype: str
+    """
+    return json.dumps(record, default=_json_default) + '\n'
+
+
+def load_record(line):
+    """ Deserialize a journal record.
+
+    :type line: str
+    :rtype: dict
+    :raises ValueError: if line isn't valid JSON, e.g. when it was only partially written.
+    """
+    return json.loads(line, object_hook=_json_object_hook)
+
+
+class Outbox:
+    """ Journal of data sets waiting for upload. All methods are thread-safe. """
+    # Rewrite journal once it is this large and holds more delivered than pending data sets.
+    compaction_threshold = 1024 * 1024
+
+    def __init__(self, path):
+        """
+        :param path: Path to journal file.
+        :type path: pathlib.Path
+        """
+        self.path = path
+        self._lock = threading.RLock()
+        self._pending = OrderedDict()  # key -> (session id, route, data set)
+        self._n_delivered = 0  # Data sets in journal that were already acknowledged.
+        self._load()
+
+    def _load(self):
+        """ Replay the journal. """
+        self._pending.clear()
+        self._n_delivered = 0
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = load_record(line)
+                    except ValueError:
+                        # A partially written last line from a crash. Everything before it is fine.
+                        Logger.warning(f"Outbox: Skipping corrupt journal entry in {self.path.name}.")
+                        continue
+                    if record['op'] == 'put':
+                        self._pending[record['key']] = (record['session'], record['route'], record['set'])
+                    elif record['op'] == 'ack':
+                        for key in record['keys']:
+                            if self._pending.pop(key, None) is not None:
+                                self._n_delivered += 1
+        except FileNotFoundError:
+            pass
+
+    def _append(self, records):
+        """ Append records to journal and make sure they're on disk. """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(dump_record(record))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def is_empty(self):
+        return not len(self)
+
+    def count_sessions(self):
+        """ Number of sessions that still have data sets pending. """
+        with self._lock:
+            return len({session for session, route, d in self._pending.values()})
+
+    def put_session(self, route, data_sets):
+        """ Store the data sets of one session for later upload. Data sets that are already pending are skipped.
+
+        :param route: Upload destination.
+        :type route: str
+        :type data_sets: list[dict]
+        :return: Number of newly stored data sets.
+        :rtype: int
+        """
+        session = uuid.uuid4().hex
+        with self._lock:
+            records = list()
+            for d in data_sets:
+                key = data_set_key(d)
+                if key in self._pending:
+                    continue
+                records.append({'op': 'put', 'key': key, 'session': session, 'route': route, 'set': d})
+                self._pending[key] = (session, route, d)
+            if records:
+                self._append(records)
+        return len(records)
+
+    def next_batch(self, max_sessions=5):
+        """ Get pending data sets of up to max_sessions sessions that share the same route.
+
+        :return: Route, keys and data sets of the batch. Route is None when nothing is pending.
+        :rtype: tuple[str, list[str], list[dict]]
+        """
+        with self._lock:
+            route = None
+            sessions = set()
+            keys = list()
+            data_sets = list()
+            for key, (session, session_route, d) in self._pending.items():
+                if route is None:
+                    route = session_route
+                if session_route != route:
+                    continue
+                if session not in sessions:
+                    if len(sessions) == max_sessions:
+                        continue
+                    sessions.add(session)
+                keys.append(key)
+                data_sets.append(d)
+            return route, keys, data_sets
+
+    def ack(self, keys):
+        """ Mark data sets as delivered.
+
+        :type keys: list[str]
+        """
+        with self._lock:
+            keys = [k for k in keys if k in self._pending]
+            if not keys:
+                return
+            for key in keys:
+                del self._pending[key]
+            self._n_delivered += len(keys)
+            if not self._pending:
+                # Nothing left, start over with an empty journal.
+                try:
+                    self.path.unlink()
+                except FileNotFoundError:
+                    pass
+                self._n_delivered = 0
+            else:
+                self._append([{'op': 'ack', 'keys': keys}])
+                self._compact()
+
+    def _compact(self):
+        """ Rewrite the journal with only the pending data sets, if it grew too much. """
+        if self._n_delivered <= len(self._pending):
+            return
+        try:
+            if self.path.stat().st_size < self.compaction_threshold:
+                return
+        except FileNotFoundError:
+            return
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for key, (session, route, d) in self._pending.items():
+                record = {'op': 'put', 'key': key, 'session': session, 'route': route, 'set': d}
+                f.write(dump_record(record))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._n_delivered = 0
+
+    def discard_user(self, user_id):
+        """ Remove all pending data sets of a user, e.g. when the user was deleted.
+
+        :type user_id: str
+        """
+        with self._lock:
+            keys = [key for key, (session, route, d) in self._pending.items() if d.get('user') == user_id]
+        self.ack(keys)
+
+
+class UploadIndex:
+    """ Hashes of blocks the server has acknowledged, so they're not uploaded again. All methods are thread-safe.
+    The index is a text file with one hash per line that only ever gets appended to.
+    """
+    def __init__(self, path):
+        """
+        :param path: Path to index file.
+        :type path: pathlib.Path
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._hashes = set()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._hashes.update(line.strip() for line in f if line.strip())
+        except FileNotFoundError:
+            pass
+
+    def __contains__(self, block_hash):
+        with self._lock:
+            return block_hash in self._hashes
+
+    def __len__(self):
+        with self._lock:
+            return len(self._hashes)
+
+    def add(self, hashes):
+        """ Remember hashes as uploaded.
+
+        :type hashes: Iterable[str]
+        """
+        with self._lock:
+            new = [h for h in dict.fromkeys(hashes) if h and h not in self._hashes]
+            if not new:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(''.join(h + '\n' for h in new))
+                f.flush()
+                os.fsync(f.fileno())
+            self._hashes.update(new)
@@ -0,0 +1,136 @@
+""" Prebuilt BBCode of the terms and privacy policy.
+
+Converting the long policy texts from markdown on the UI thread is noticeable on low-end phones, especially on first
+run when both are shown together. This module converts them for every language ahead of time and stores them in
+one bundle file per document and language in res/policies, which is shipped with the app. Rebuild the bundles
+whenever the policies, their translations or the app details change:
+
+    python -m src.policybundle
+
+At runtime only the bundle of the current language is read, and only when it's needed. A bundle is only used if it
+was built for the same app version and app details, so it's checked without translating the document. Otherwise
+the text is converted at runtime.
+"""
+from hashlib import md5
+import json
+from pathlib import Path
+
+from . import __version__ as app_version
+from .i18n import change_language_to, current_language, list_languages
+from .utility import get_app_details, render_markdown
+
+BUNDLE_DIR = Path(__file__).resolve().parent.parent / 'res' / 'policies'
+VERSION = 2
+
+_bundles = dict()  # (name, language) -> bundle or None if there's no valid bundle file.
+
+
+def get_documents():
+    """ Getters of the markdown source of each document, by name. """
+    from privacypolicy import get_policy
+    from terms import get_terms
+    return {'terms': get_terms, 'privacypolicy': get_policy}
+
+
+def _hash_details(details):
+    used = {key: details.get(key) for key in ('appname', 'author', 'contact', 'source')}
+    return md5(json.dumps(used, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_bundle_path(name, language, directory=BUNDLE_DIR):
+    return Path(directory) / f'{name}_{language}.json'
+
+
+def build_bundle(name, content_md, language, details, directory=BUNDLE_DIR):
+    """ Convert a document and write its bundle.
+
+    :param name: Name of document, e.g. 'terms'.
+    :type name: str
+    :param content_md: Translated markdown of the document.
+    :type content_md: str
+    :param language: Language of the translation.
+    :type language: str
+    :param details: App details to fill in.
+    :type details: dict
+    :return: Path to the bundle file.
+    :rtype: pathlib.Path
+    """
+    text = render_markdown(content_md, details)
+    bundle = {'version': VERSION,
+              'name': name,
+              'language': language,
+              'app_version': app_version,
+              'details_md5': _hash_details(details),
+              'text': text,
+              }
+    path = get_bundle_path(name, language, directory)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(bundle, ensure_ascii=False), encoding='utf-8')
+    return path
+
+
+def build_all(directory=BUNDLE_DIR):
+    """ Write bundles of all documents in all languages.
+
+    :return: Paths to the bundle files.
+    :rtype: list[pathlib.Path]
+    """
+    details = get_app_details()
+    previous_language = current_language()
+    paths = list()
+    try:
+        for language in list_languages():
+            change_language_to(language)
+            for name, get_document in get_documents().items():
+                paths.append(build_bundle(name, get_document(), language, details, directory))
+    finally:
+        if previous_language:
+            change_language_to(previous_language)
+    return paths
+
+
+def load_bundle(name, language=None, directory=BUNDLE_DIR):
+    """ Read the bundle of a document on first use. Bundles of other languages aren't read.
+
+    :param name: Name of document, e.g. 'terms'.
+    :type name: str
+    :param language: Defaults to current language.
+    :type language: str
+    :return: Bundle or None if there is none for this app version and app details.
+    :rtype: dict
+    """
+    if language is None:
+        language = current_language()
+    key = (name, language)
+    if key not in _bundles:
+        try:
+            bundle = json.loads(get_bundle_path(name, language, directory).read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            bundle = None
+        if bundle and (bundle.get('version'), bundle.get('language'), bundle.get('app_version'),
+                       bundle.get('details_md5')) != (VERSION, language, app_version,
+                                                      _hash_details(get_app_details())):
+            bundle = None
+        _bundles[key] = bundle
+    return _bundles[key]
+
+
+def get_policy_text(name, get_document):
+    """ BBCode of a document in the current language with app details filled in.
+    Uses the prebuilt bundle, unless it's missing or outdated.
+
+    :param name: Name of document, e.g. 'terms'.
+    :type name: str
+    :param get_document: Getter of the translated markdown of the document, e.g. terms.get_terms.
+    :type get_document: Callable[[], str]
+    :rtype: str
+    """
+    bundle = load_bundle(name)
+    if bundle:
+        return bundle['text']
+    return render_markdown(get_document())
+
+
+if __name__ == '__main__':
+    for bundle_path in build_all():
+        print(f"Wrote {bundle_path}")
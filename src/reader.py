@@ -0,0 +1,133 @@
+""" Read binary data set files without loading them into memory.
+
+With the local storage format set to 'npy', the DataManager writes each data set as a binary container file
+(see serializers.NpySerializer) with the data set's descriptors like table, user, task, block and hash in its header.
+This module memory-maps those files, so large collections from many devices can be filtered by their descriptors
+and sliced by block and column while only the parts that are actually used are read from disk.
+
+Example::
+
+    from src.reader import DataCollection
+    collection = DataCollection('path/to/storage')
+    for data_set in collection.select(table='trials', block=2):
+        df1 = data_set.column('df1')
+"""
+import os
+from pathlib import Path
+
+import numpy as np
+
+from .serializers import NpySerializer
+
+FILE_SUFFIX = '.npsy'
+
+
+class MappedDataSet:
+    """ A data set file whose data are mapped into memory on first access. """
+    def __init__(self, path):
+        """ Read the file's header.
+
+        :param path: Path to binary data set file.
+        :type path: Union[str,pathlib.Path]
+        :raises ValueError: if file isn't a binary data set.
+        """
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            header, offset = NpySerializer().read_file_header(f)
+            f.seek(offset)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            self._offset = f.tell()
+        self._shape = shape
+        self._order = 'F' if fortran_order else 'C'
+        self._dtype = dtype
+        self.columns = header['columns']
+        self.meta = header.get('meta', dict())
+        self._data = None
+
+    def __getitem__(self, key):
+        """ Descriptor from the file's meta data, e.g. 'table' or 'block'. """
+        return self.meta[key]
+
+    def get(self, key, default=None):
+        return self.meta.get(key, default)
+
+    def __len__(self):
+        return self._shape[0] if self._shape else 0
+
+    @property
+    def data(self):
+        """ Read-only memory-mapped array of the data set.
+
+        :rtype: numpy.memmap
+        """
+        if self._data is None:
+            if not np.prod(self._shape):
+                # Empty files can't be mapped.
+                self._data = np.empty(self._shape, dtype=self._dtype)
+            else:
+                self._data = np.memmap(self.path, dtype=self._dtype, mode='r', offset=self._offset,
+                                       shape=self._shape, order=self._order)
+        return self._data
+
+    def column(self, name):
+        """ View of a single column without copying it.
+
+        :param name: Column name.
+        :type name: str
+        :rtype: numpy.ndarray
+        """
+        return self.data[:, self.columns.index(name)]
+
+    def matches(self, **descriptors):
+        """ Whether all given descriptors equal those of the data set. Descriptors that are None are ignored. """
+        return all(self.meta.get(key) == value for key, value in descriptors.items() if value is not None)
+
+
+class DataCollection:
+    """ All binary data set files below a directory. Only headers are read when the collection is created. """
+    def __init__(self, root):
+        """
+        :param root: Storage path, e.g. a copy of the app's user data directory.
+        :type root: Union[str,pathlib.Path]
+        """
+        self.root = Path(root)
+        self.data_sets = list()  # type: list[MappedDataSet]
+        for dir_path, _, file_names in os.walk(self.root):
+            for name in sorted(file_names):
+                if not name.endswith(FILE_SUFFIX):
+                    continue
+                try:
+                    self.data_sets.append(MappedDataSet(Path(dir_path) / name))
+                except (OSError, ValueError):
+                    continue
+
+    def __len__(self):
+        return len(self.data_sets)
+
+    def __iter__(self):
+        return iter(self.data_sets)
+
+    def select(self, table=None, user=None, task=None, block=None, hash=None):
+        """ Data sets whose descriptors match all given values.
+
+        :rtype: list[MappedDataSet]
+        """
+        return [d for d in self.data_sets if d.matches(table=table, user=user, task=task, block=block, hash=hash)]
+
+    def concatenate(self, table, column, **descriptors):
+        """ Values of a column of all matching data sets in one array. Only this copies data.
+
+        :param table: Name of table, e.g. 'trials'.
+        :type table: str
+        :param column: Name of column.
+        :type column: str
+        :rtype: numpy.ndarray
+        """
+        views = [d.column(column) for d in self.select(table=table, **descriptors) if column in d.columns]
+        if not views:
+            return np.empty(0)
+        return np.concatenate(views)
@@ -0,0 +1,203 @@
+""" Write-ahead logs that let an interrupted session be recovered on the next launch.
+
+Everything handed to the DataManager is appended to a session journal. While a block runs, each finished trial is
+appended to a trial log of fixed-size binary records. Both are flushed to disk immediately, so being killed by the
+OS, a crash or an empty battery loses at most the trial that was running. The DataManager makes all changes in its I/O
+thread, so syncing large data sets to disk doesn't block the UI.
+"""
+import json
+import os
+from pathlib import Path
+import struct
+
+import numpy as np
+
+from .outbox import dump_record, load_record
+
+
+class TrialLog:
+    """ Append-only binary log of one block's trials.
+
+    Layout (little-endian):
+
+    - 4 bytes magic b'NPWL', 1 byte version, 4 bytes unsigned length of the JSON header.
+    - JSON header with the block's meta data and its columns.
+    - One record per trial: 4 bytes signed trial number, then one double per column.
+    """
+    magic = b'NPWL'
+    version = 1
+    _prefix = struct.Struct('<4sBI')
+
+    def __init__(self, path, meta):
+        """ Create a new log at path. An existing log is overwritten.
+
+        :param path: File to write to.
+        :type path: pathlib.Path
+        :param meta: JSON serializable descriptors of the block. Must contain 'columns'.
+        :type meta: dict
+        """
+        self.path = Path(path)
+        self._record = self._get_record_struct(len(meta['columns']))
+        header = json.dumps(meta).encode('utf-8')
+        self._file = open(self.path, 'wb')
+        self._file.write(self._prefix.pack(self.magic, self.version, len(header)))
+        self._file.write(header)
+        self._sync()
+
+    @staticmethod
+    def _get_record_struct(n_columns):
+        return struct.Struct(f'<i{n_columns}d')
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def append(self, trial, values):
+        """ Durably write the values of a finished trial.
+
+        :param trial: Number of the trial.
+        :type trial: int
+        :param values: One value per column.
+        :type values: Iterable[float]
+        """
+        self._file.write(self._record.pack(trial, *values))
+        self._sync()
+
+    def close(self, remove=False):
+        """ Close the log and optionally delete its file. """
+        if not self._file.closed:
+            self._file.close()
+        if remove:
+            try:
+                self.path.unlink()
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def read(cls, path):
+        """ Read a log. A record that was only partially written is ignored.
+
+        :param path: File to read.
+        :type path: pathlib.Path
+        :return: Meta data of the block, trial numbers and 2D array with a row of values for each logged trial.
+        :rtype: tuple[dict, numpy.ndarray, numpy.ndarray]
+        :raises ValueError: if file isn't a trial log or its header is incomplete.
+        """
+        payload = Path(path).read_bytes()
+        try:
+            magic, version, size = cls._prefix.unpack_from(payload)
+        except struct.error:
+            raise ValueError("Incomplete trial log.")
+        if magic != cls.magic:
+            raise ValueError("Not a trial log.")
+        if version > cls.version:
+            raise ValueError(f"Unsupported trial log version {version}.")
+        start = cls._prefix.size
+        meta = json.loads(payload[start:start + size].decode('utf-8'))
+        n_columns = len(meta['columns'])
+        record = cls._get_record_struct(n_columns)
+        offset = start + size
+        n_records = (len(payload) - offset) // record.size
+        dtype = np.dtype([('trial', '<i4'), ('values', '<f8', (n_columns,))])
+        records = np.frombuffer(payload, dtype=dtype, count=n_records, offset=offset)
+        return meta, records['trial'].copy(), records['values'].copy()
+
+
+class SessionJournal:
+    """ Keeps the data of the running session on disk until it's safely stored or uploaded. """
+    journal_name = 'session.journal'
+    log_pattern = 'block_{}.wal'
+
+    def __init__(self, directory):
+        """
+        :param directory: Where to keep the journal and trial logs.
+        :type directory: pathlib.Path
+        """
+        self.directory = Path(directory)
+        self._log = None  # Trial log of the running block.
+
+    @property
+    def journal_path(self):
+        return self.directory / self.journal_name
+
+    def _get_log_paths(self):
+        if not self.directory.exists():
+            return []
+        return sorted(self.directory.glob(self.log_pattern.format('*')))
+
+    def has_session(self):
+        """ Whether there's anything left from a session. """
+        return self.journal_path.exists() or bool(self._get_log_paths())
+
+    def start(self):
+        """ Begin journaling a new session. Anything left from a previous one is removed. """
+        self.clear()
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def add(self, data_set):
+        """ Durably append a data set of the DataManager's collection to the journal.
+
+        :type data_set: dict
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(dump_record(data_set))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def open_trial_log(self, meta):
+        """ Start logging trials of a block.
+
+        :param meta: JSON serializable descriptors of the block. Must contain 'block' and 'columns'.
+        :type meta: dict
+        """
+        self.close_trial_log()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._log = TrialLog(self.directory / self.log_pattern.format(meta['block']), meta)
+
+    def log_trial(self, trial, values):
+        """ Durably write the values of a finished trial to the log of the running block. Ignored if there's none. """
+        if self._log:
+            self._log.append(trial, values)
+
+    def close_trial_log(self):
+        """ Stop logging trials. The log is removed, because either its block was added to the journal in full,
+        or the block was cancelled.
+        """
+        if self._log:
+            self._log.close(remove=True)
+            self._log = None
+
+    def load(self):
+        """ Read what's left from an interrupted session.
+
+        :return: Data sets from the journal and (meta data, trial numbers, values) of each partially finished block.
+        :rtype: tuple[list[dict], list[tuple[dict, numpy.ndarray, numpy.ndarray]]]
+        """
+        data_sets = list()
+        if self.journal_path.exists():
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        data_sets.append(load_record(line))
+                    except ValueError:
+                        # Last line was only partially written.
+                        break
+        blocks = list()
+        for path in self._get_log_paths():
+            try:
+                meta, trials, values = TrialLog.read(path)
+            except (ValueError, KeyError, OSError):
+                continue
+            if len(trials):
+                blocks.append((meta, trials, values))
+        return data_sets, blocks
+
+    def clear(self):
+        """ Remove journal and all trial logs. """
+        self.close_trial_log()
+        for path in [self.journal_path] + self._get_log_paths():
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
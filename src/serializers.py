@@ -0,0 +1,169 @@
+""" Serializers for the tabular data sets handed to the DataManager.
+
+A serializer turns a 2D numpy array plus its column names into bytes for keeping in memory, and renders those bytes
+as CSV text whenever a file or an upload actually needs text.
+"""
+import io
+import json
+import struct
+
+import numpy as np
+
+
+class CSVSerializer:
+    """ Keeps data sets as comma separated values. This is what the server and the local files expect. """
+    name = 'csv'
+
+    def dumps(self, columns, data, fmt='%s'):
+        """ Takes numpy array and returns it as CSV bytes.
+
+        :param columns: Column names for the header.
+        :type columns: list[str]
+        :param data: 2D array of data.
+        :type data: numpy.ndarray
+        :param fmt: Format to use for values.
+        :type fmt: str
+        :rtype: bytes
+        """
+        header = ','.join(columns)
+        with io.BytesIO() as bio:
+            if header:
+                np.savetxt(bio, data, delimiter=',', fmt=fmt, encoding='utf-8', header=header, comments='')
+            else:
+                np.savetxt(bio, data, delimiter=',', fmt=fmt, encoding='utf-8')
+            b = bio.getvalue()
+        return b
+
+    def to_csv(self, payload):
+        """ Payload already is CSV. """
+        return payload
+
+    def iter_csv(self, payload, chunk_size=64 * 1024):
+        """ Yield CSV bytes in chunks of chunk_size. """
+        for start in range(0, len(payload), chunk_size):
+            yield payload[start:start + chunk_size]
+
+
+class NpySerializer:
+    """ Compact binary container for data sets.
+
+    Layout (little-endian):
+
+    - 4 bytes magic b'NPSY', 1 byte version, 4 bytes unsigned length of the JSON header.
+    - JSON header with columns and format string for CSV rendering, optionally further meta data.
+    - The array in numpy's .npy format, which carries shape and dtype.
+    """
+    name = 'npy'
+    magic = b'NPSY'
+    version = 1
+    _prefix = struct.Struct('<4sBI')
+
+    def dumps(self, columns, data, fmt='%s', meta=None):
+        """ Takes numpy array and returns it as binary container.
+
+        :param columns: Column names.
+        :type columns: list[str]
+        :param data: 2D array of data.
+        :type data: numpy.ndarray
+        :param fmt: Format to use when rendering as CSV.
+        :type fmt: str
+        :param meta: Additional JSON serializable descriptors to store in the header.
+        :type meta: dict
+        :rtype: bytes
+        """
+        data = np.asarray(data)
+        # We don't want to rely on pickle for object arrays. Strings are all we put in there anyway.
+        if data.dtype == object:
+            data = data.astype(str)
+        header = {'columns': list(columns), 'fmt': fmt}
+        if meta:
+            header['meta'] = meta
+        header = json.dumps(header).encode('utf-8')
+        with io.BytesIO() as bio:
+            bio.write(self._prefix.pack(self.magic, self.version, len(header)))
+            bio.write(header)
+            np.save(bio, data, allow_pickle=False)
+            b = bio.getvalue()
+        return b
+
+    def read_header(self, payload):
+        """ Return the JSON header and the offset at which the .npy part starts.
+
+        :type payload: bytes
+        :rtype: tuple[dict, int]
+        """
+        magic, version, size = self._prefix.unpack_from(payload)
+        if magic != self.magic:
+            raise ValueError("Not a binary data container.")
+        if version > self.version:
+            raise ValueError(f"Unsupported container version {version}.")
+        start = self._prefix.size
+        header = json.loads(bytes(payload[start:start + size]).decode('utf-8'))
+        return header, start + size
+
+    def read_file_header(self, f):
+        """ Like read_header, but only reads the container's header from an open binary file.
+
+        :type f: io.BufferedReader
+        :rtype: tuple[dict, int]
+        """
+        prefix = f.read(self._prefix.size)
+        if len(prefix) < self._prefix.size:
+            raise ValueError("Not a binary data container.")
+        return self.read_header(prefix + f.read(self._prefix.unpack(prefix)[2]))
+
+    def loads(self, payload):
+        """ Returns columns, data and format string from binary container.
+
+        :type payload: bytes
+        :rtype: tuple[list[str], numpy.ndarray, str]
+        """
+        header, offset = self.read_header(payload)
+        return header['columns'], self._array_from_buffer(payload, offset), header['fmt']
+
+    @staticmethod
+    def _array_from_buffer(payload, offset):
+        """ Returns a read-only view of the .npy data inside payload without copying it. """
+        with io.BytesIO(payload) as bio:
+            bio.seek(offset)
+            version = np.lib.format.read_magic(bio)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(bio)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(bio)
+            start = bio.tell()
+        count = int(np.prod(shape))
+        data = np.frombuffer(payload, dtype=dtype, count=count, offset=start)
+        return data.reshape(shape, order='F' if fortran_order else 'C')
+
+    def to_csv(self, payload):
+        """ Render binary container as CSV bytes. """
+        columns, data, fmt = self.loads(payload)
+        return CSVSerializer().dumps(columns, data, fmt=fmt)
+
+    def iter_csv(self, payload, rows=256):
+        """ Render binary container as CSV bytes, yielding chunks of the given number of rows. """
+        columns, data, fmt = self.loads(payload)
+        csv = CSVSerializer()
+        # The first chunk carries the header.
+        yield csv.dumps(columns, data[:rows], fmt=fmt)
+        for start in range(rows, len(data), rows):
+            yield csv.dumps([], data[start:start + rows], fmt=fmt)
+
+
+SERIALIZERS = {CSVSerializer.name: CSVSerializer,
+               NpySerializer.name: NpySerializer,
+               }
+
+
+def get_serializer(name):
+    """ Return serializer instance for name.
+
+    :param name: One of SERIALIZERS' keys.
+    :type name: str
+    :raises ValueError: if there's no serializer by that name.
+    """
+    try:
+        return SERIALIZERS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown serializer '{name}'. Expected one of {', '.join(SERIALIZERS)}.")
@@ -20,10 +20,14 @@ class SettingsContainer(Widget):
     # Data Collection.
     is_local_storage_enabled = ConfigParserProperty('0', 'DataCollection', 'is_local_storage_enabled', 'app',
                                                     val_type=int)  # Converts string to int.
+    local_storage_format = ConfigParserProperty('csv', 'DataCollection', 'local_storage_format', 'app', val_type=str)
     is_upload_enabled = ConfigParserProperty('1', 'DataCollection', 'is_upload_enabled', 'app', val_type=int)
     server_uri = ConfigParserProperty(get_app_details()['webserver'], 'DataCollection', 'webserver', 'app',
                                       val_type=str)
     is_email_enabled = ConfigParserProperty('0', 'DataCollection', 'is_email_enabled', 'app', val_type=int)
+    upload_mode = ConfigParserProperty('json', 'DataCollection', 'upload_mode', 'app', val_type=str)
+    upload_compression = ConfigParserProperty('auto', 'DataCollection', 'upload_compression', 'app', val_type=str)
+    upload_trajectories = ConfigParserProperty('0', 'DataCollection', 'upload_trajectories', 'app', val_type=int)
     
     # Properties that change over the course of all tasks and are not set by config.
     current_trial = NumericProperty(0)
@@ -113,8 +117,11 @@ class SettingsCircleTask(Widget):
                                           verify=lambda x: x > 0.0, errorvalue=1.0)
     cool_down = ConfigParserProperty('0.5', 'CircleTask', 'cool_down_time', 'app', val_type=float,
                                      verify=lambda x: x > 0.0, errorvalue=0.5)
+    trajectory_rate = ConfigParserProperty('0', 'CircleTask', 'trajectory_rate', 'app', val_type=int,
+                                           verify=lambda x: x >= 0, errorvalue=0)
     email_recipient = ConfigParserProperty('', 'CircleTask', 'email_recipient', 'app', val_type=str)
     researcher = ConfigParserProperty('', 'CircleTask', 'researcher', 'app', val_type=str)
+    frame_trace = ConfigParserProperty('off', 'CircleTask', 'frame_trace', 'app', val_type=str)
     
     def __init__(self, **kwargs):
         super(SettingsCircleTask, self).__init__(**kwargs)
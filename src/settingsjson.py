@@ -34,6 +34,13 @@ def get_settings_general_json():
          'desc': _('Save data locally on device.'),
          'section': 'DataCollection',
          'key': 'is_local_storage_enabled'},
+        {'type': 'options',
+         'title': _('Local Storage Format'),
+         'desc': _('Save a CSV or binary (npy) file per table and block, or all data of a user in a single '
+                   'database file (sqlite).'),
+         'section': 'DataCollection',
+         'key': 'local_storage_format',
+         'options': ['csv', 'npy', 'sqlite']},
         {'type': 'bool',
          'title': _('Upload Data'),
          'desc': _('Offer to send collected data to server.'),
@@ -44,6 +51,25 @@ def get_settings_general_json():
          'desc': _('Target server address to upload data to.'),
          'section': 'DataCollection',
          'key': 'webserver'},
+        {'type': 'options',
+         'title': _('Upload Mode'),
+         'desc': _('Send all data in one request (json), or one data set at a time (stream), which needs less '
+                   'memory. Streaming needs a server that accepts chunked transfer encoding.'),
+         'section': 'DataCollection',
+         'key': 'upload_mode',
+         'options': ['json', 'stream']},
+        {'type': 'options',
+         'title': _('Upload Compression'),
+         'desc': _('Compress uploads with gzip only for servers that support it (auto), try it for any server '
+                   '(always), or never.'),
+         'section': 'DataCollection',
+         'key': 'upload_compression',
+         'options': ['auto', 'always', 'never']},
+        {'type': 'bool',
+         'title': _('Upload Trajectories'),
+         'desc': _('Also upload the recorded slider movements. Only enable this if the server accepts them.'),
+         'section': 'DataCollection',
+         'key': 'upload_trajectories'},
         {'type': 'bool',
          'title': _('Send E-Mail'),
          'desc': _('Offer to send collected data via e-mail.'),
@@ -92,6 +118,19 @@ def get_settings_circle_task_json():
          'desc': _('Pause after each trial, in seconds.'),
          'section': 'CircleTask',
          'key': 'cool_down_time'},
+        {'type': 'numeric',
+         'title': _('Trajectory Sampling Rate'),
+         'desc': _('Additionally record slider positions at a fixed rate, in Hz. '
+                   'With 0 they are only recorded when the sliders move.'),
+         'section': 'CircleTask',
+         'key': 'trajectory_rate'},
+        {'type': 'options',
+         'title': _('Frame Timing'),
+         'desc': _('Record frame times and trial events of each block to a trace file (trace), '
+                   'and optionally show frame rate and jitter during the task (overlay).'),
+         'section': 'CircleTask',
+         'key': 'frame_trace',
+         'options': ['off', 'trace', 'overlay']},
         {'type': 'string',
          'title': _('E-Mail Recipient'),
          'desc': _('E-mail address to send data to.'),
@@ -0,0 +1,113 @@
+""" Timing of trial events.
+
+All trial events are measured with one monotonic high-resolution clock. It doesn't jump when the wall-clock gets
+adjusted. Kivy stamps touch events with wall-clock time, so those timestamps get mapped onto the monotonic clock.
+"""
+import time
+
+
+class TrialClock:
+    """ Monotonic clock in seconds with sub-millisecond resolution. """
+    def __init__(self):
+        self._offset = 0.0  # Wall-clock time minus monotonic time.
+        self.calibrate()
+
+    @staticmethod
+    def now():
+        """ Current monotonic time in seconds.
+
+        :rtype: float
+        """
+        return time.perf_counter_ns() * 1e-9
+
+    def calibrate(self, n_samples=5):
+        """ Determine offset between wall-clock and monotonic clock.
+        Call this regularly, e.g. at each trial onset, so wall-clock adjustments don't affect mapped timestamps.
+
+        :param n_samples: Use the most precise of this many measurements.
+        :type n_samples: int
+        """
+        best_gap = None
+        for _ in range(n_samples):
+            before = time.perf_counter_ns()
+            wall = time.time()
+            after = time.perf_counter_ns()
+            # The shorter the time between both monotonic readings, the more exact the pairing.
+            gap = after - before
+            if best_gap is None or gap < best_gap:
+                best_gap = gap
+                self._offset = wall - (before + after) * 0.5e-9
+
+    def from_wall(self, t):
+        """ Map a wall-clock timestamp, e.g. of a touch event, to the monotonic clock.
+
+        :param t: Seconds since epoch as returned by time.time().
+        :type t: float
+        :rtype: float
+        """
+        return t - self._offset
+
+
+class TrialScheduler:
+    """ Timeline of a block's phases with absolute deadlines on a monotonic clock.
+    All deadlines are computed in advance from the block's start, so delays of single events don't add up over trials.
+    """
+    GET_READY = 'get_ready'  # Warm-up before a trial.
+    ONSET = 'onset'
+    TRIAL_END = 'trial_end'  # Followed by cool-down.
+    BLOCK_END = 'block_end'
+
+    def __init__(self, n_trials, warm_up, trial_duration, cool_down, clock=None):
+        """
+        :param n_trials: Number of trials in block.
+        :type n_trials: int
+        :param warm_up: Seconds between getting ready and trial onset.
+        :type warm_up: float
+        :param trial_duration: Seconds between trial onset and end.
+        :type trial_duration: float
+        :param cool_down: Seconds after the end of a trial until getting ready for the next one.
+        :type cool_down: float
+        :param clock: Clock to check deadlines against.
+        :type clock: TrialClock
+        """
+        self.clock = clock or TrialClock()
+        iti = warm_up + trial_duration + cool_down
+        # Events are (seconds after start, phase, trial number). The first trial starts after one inter-trial-interval.
+        self.timeline = list()
+        for trial in range(1, n_trials + 1):
+            t = trial * iti
+            self.timeline.append((t, self.GET_READY, trial))
+            self.timeline.append((t + warm_up, self.ONSET, trial))
+            self.timeline.append((t + warm_up + trial_duration, self.TRIAL_END, trial))
+        self.timeline.append(((n_trials + 1) * iti, self.BLOCK_END, n_trials))
+        self.start_time = None
+        self._next = 0
+
+    @property
+    def is_running(self):
+        return self.start_time is not None and self._next < len(self.timeline)
+
+    def start(self, now=None):
+        """ Set the block's start and thereby all deadlines. """
+        self.start_time = self.clock.now() if now is None else now
+        self._next = 0
+
+    def poll(self, now=None):
+        """ Return all events whose deadline has passed since the last poll, in order.
+
+        :return: List of (phase, trial, deadline) with deadline on the clock's time scale.
+        :rtype: list[tuple[str, int, float]]
+        """
+        if self.start_time is None:
+            return []
+        if now is None:
+            now = self.clock.now()
+        due = list()
+        while self._next < len(self.timeline):
+            t, phase, trial = self.timeline[self._next]
+            deadline = self.start_time + t
+            if deadline > now:
+                break
+            due.append((phase, trial, deadline))
+            self._next += 1
+        return due
@@ -0,0 +1,145 @@
+""" Record the course of slider movements during trials. All memory is allocated up front, so recording a sample
+during a trial doesn't allocate arrays or grow lists.
+"""
+import math
+
+import numpy as np
+
+
+class RingBuffer:
+    """ 2D buffer with fixed capacity that overwrites its oldest rows when full. """
+    def __init__(self, capacity, n_columns, dtype=np.float64):
+        self._buffer = np.full((capacity, n_columns), np.nan, dtype=dtype)
+        self.capacity = capacity
+        self._next = 0  # Index of row to write next.
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def is_full(self):
+        return self._size == self.capacity
+
+    def append(self, values):
+        """ Write values into next row.
+
+        :param values: One value per column.
+        :type values: tuple
+        """
+        self._buffer[self._next] = values
+        self._next = (self._next + 1) % self.capacity
+        if self._size < self.capacity:
+            self._size += 1
+
+    def clear(self):
+        self._next = 0
+        self._size = 0
+
+    def copy_to(self, out):
+        """ Copy rows in chronological order into out, which must have at least len(self) rows.
+
+        :type out: numpy.ndarray
+        :return: Number of rows copied.
+        :rtype: int
+        """
+        if self._size < self.capacity:
+            out[:self._size] = self._buffer[:self._size]
+        else:
+            n_old = self.capacity - self._next
+            out[:n_old] = self._buffer[self._next:]
+            out[n_old:self._size] = self._buffer[:self._next]
+        return self._size
+
+    def tail(self, n):
+        """ Copy of the last n rows in chronological order.
+
+        :type n: int
+        :rtype: numpy.ndarray
+        """
+        n = min(n, self._size)
+        start = self._next - n
+        if start >= 0:
+            return self._buffer[start:self._next].copy()
+        return np.concatenate((self._buffer[start:], self._buffer[:self._next]))
+
+
+class TrajectoryRecorder:
+    """ Collects time and positions of both sliders for each trial of a block. """
+    columns = ['trial', 'time', 'df1', 'df2']
+
+    def __init__(self, n_trials, trial_duration, touch_rate=240, fixed_rate=0):
+        """
+        :param n_trials: Number of trials in block.
+        :type n_trials: int
+        :param trial_duration: Duration of a trial in seconds.
+        :type trial_duration: float
+        :param touch_rate: Highest expected number of touch move events per second and slider.
+        :type touch_rate: int
+        :param fixed_rate: Number of samples per second taken at a fixed rate in addition to touch events, 0 for none.
+        :type fixed_rate: int
+        """
+        # Touch move events of 2 fingers plus fixed-rate samples, a sample at start and stop of each trial,
+        # and some margin for trials that take longer than planned. Both sources feed the same buffer.
+        capacity = int(math.ceil(trial_duration * (touch_rate * 2 + fixed_rate) * 1.25)) + 2
+        self._trial = RingBuffer(capacity, len(self.columns) - 1)
+        self._block = np.full((n_trials * capacity, len(self.columns)), np.nan)
+        self._n_rows = 0
+        self._trial_number = 0
+        self._onset = 0.0
+        self.is_recording = False
+        self.n_dropped = 0  # Samples that were lost, because a trial exceeded the buffer's capacity.
+        self.truncated_trials = list()  # Numbers of trials that lost samples.
+
+    def start_trial(self, trial, onset):
+        """ Begin recording a new trial.
+
+        :param trial: Number of trial.
+        :type trial: int
+        :param onset: Time of trial onset. Sample times are relative to this.
+        :type onset: float
+        """
+        self._trial.clear()
+        self._trial_number = trial
+        self._onset = onset
+        self.is_recording = True
+
+    def sample(self, t, df1, df2):
+        """ Record slider values at time t. Ignored when not recording. """
+        if not self.is_recording:
+            return
+        if self._trial.is_full:
+            self.n_dropped += 1
+            self._mark_truncated()
+        self._trial.append((t - self._onset, df1, df2))
+
+    def _mark_truncated(self):
+        if not self.truncated_trials or self.truncated_trials[-1] != self._trial_number:
+            self.truncated_trials.append(self._trial_number)
+
+    def finish_trial(self):
+        """ Stop recording and move the trial's samples to the block's data.
+        If the block has no room left for all of them, e.g. when trials were repeated, only the latest samples are
+        kept.
+        """
+        if not self.is_recording:
+            return
+        self.is_recording = False
+        rows = self._block[self._n_rows:]
+        # Don't overrun the preallocated space of the block.
+        if len(rows) < len(self._trial):
+            self.n_dropped += len(self._trial) - len(rows)
+            self._mark_truncated()
+            n = len(rows)
+            rows[:, 1:] = self._trial.tail(n)
+        else:
+            n = self._trial.copy_to(rows[:, 1:])
+        rows[:n, 0] = self._trial_number
+        self._n_rows += n
+
+    def get_data(self):
+        """ Return recorded samples of all finished trials.
+
+        :rtype: numpy.ndarray
+        """
+        return self._block[:self._n_rows]
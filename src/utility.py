@@ -1,15 +1,15 @@
 from configparser import ConfigParser
+from functools import lru_cache
 from hashlib import md5
 import re
 from typing import List, Callable
 from uuid import uuid4
 
 from kivy import platform
-from kivy.core.window import Window
 
 from plyer import uniqueid
 
-from .i18n import _, change_language_to
+from .i18n import _, change_language_to, current_language
 from . import __version__ as app_version
 
 # Conditional imports
@@ -40,6 +40,8 @@ if platform == 'win':
         return screensize
 else:
     def get_screensize():
+        # Imported here, so importing this module doesn't create a window, e.g. in headless benchmarks.
+        from kivy.core.window import Window
         return Window.width, Window.height
 
 
@@ -58,14 +60,15 @@ def is_window_landscape():
     
     
 def switch_language(lang='en'):
-    """ Change displayed translation. """
-    try:
-        # Popups and settings could be simplified by using change_language_to_translated() instead,
-        # but since language name is written in its own language there could be UTF-8 issues when saving to config file.
-        change_language_to(lang)
-    except ReferenceError:
-        # I spent hours trying to fix it. Now I just don't care anymore.
-        print(f"WARNING: Couldn't translate everything. Possible weakref popups that don't exist anymore.")
+    """ Change displayed translation.
+
+    :return: Number of translated texts that were updated.
+    :rtype: int
+    """
+    # Popups and settings could be simplified by using change_language_to_translated() instead,
+    # but since language name is written in its own language there could be UTF-8 issues when saving to config file.
+    # Texts of widgets that don't exist anymore are skipped and forgotten.
+    return change_language_to(lang)
 
 
 def create_device_identifier(**kwargs):
@@ -115,17 +118,26 @@ def ask_permission(permission, callback=_on_permission_result):
     return True
 
 
-def get_app_details():
-    """ Get app's name, author and contact information. """
+@lru_cache(maxsize=1)
+def _read_app_details_file():
+    """ Parse android.txt once. Returns None if it doesn't exist. """
     try:
         with open('android.txt') as f:
             file_content = '[dummy_section]\n' + f.read()
     except IOError:
+        return None
+    config_parser = ConfigParser()
+    config_parser.read_string(file_content)
+    return config_parser
+
+
+def get_app_details():
+    """ Get app's name, author and contact information. """
+    config_parser = _read_app_details_file()
+    if config_parser is None:
         print("WARNING: android.txt wasn't found! Setting app details to " + _("UNKNOWN."))
         return {'appname': _("UNKNOWN."), 'author': _("UNKNOWN."), 'contact': _("UNKNOWN.")}
     
-    config_parser = ConfigParser()
-    config_parser.read_string(file_content)
     details = {'appname': config_parser.get('dummy_section', 'title', fallback=_("UNKNOWN.")),
                'author': config_parser.get('dummy_section', 'author', fallback=_("UNKNOWN.")),
                'contact': config_parser.get('dummy_section', 'contact', fallback=_("UNKNOWN.")),
@@ -139,120 +151,80 @@ def get_app_details():
 
 # Code based on https://gist.github.com/sma/1513929
 # and https://github.com/evandrocoan/MarkdownToBBCode/blob/master/MarkdownToBBCode.py
+# All inline elements are matched by one precompiled pattern. At each position the alternatives are tried in order,
+# so URLs, links and German gender asterisks are consumed before they could be mistaken for emphasis.
+_md_inline = re.compile(r"""
+    (?P<url><(?P<url_target>https?:\S+)>)
+    |(?P<link>\[(?P<link_text>.*?)\]\((?P<link_target>.*?)\))
+    |(?P<gender>\w+\*[^.\s]*\w+)
+    |\*\*(?P<bold>[^ \n][^*]+?[^ \n])\*\*
+    |\*(?P<italic>[^ \n][^*]+?[^ \n])\*
+    |__(?P<bold2>[^ \n][^_]+?[^ \n])__
+    |_(?P<italic2>[^ \n][^_]+?[^ \n])_
+    |~~(?P<strike>[^ \n][\s\S]+?[^ \n])~~
+    """, re.VERBOSE)
+_md_emphasis = {'bold': 'b', 'italic': 'i', 'bold2': 'b', 'italic2': 'i', 'strike': 's'}
+_md_block = re.compile(r"^(?:(?P<level>#{1,4})[ \t]+(?P<header>.*?)[ \t]*|> (?P<quote>.*))$", re.MULTILINE)
+_md_headers = {1: "[size=24dp][b]{}[/b][/size]",
+               2: "[size=20dp][b]{}[/b][/size]",
+               3: "[b]{}[/b]",
+               4: "[i][b]{}[/b][/i]",
+               }
+_bbcode_cache = dict()
+
+
+def _convert_inline(match):
+    kind = match.lastgroup
+    if kind == 'url':
+        return '[color=0000ff][ref="{0}"]{0}[/ref][/color]'.format(match['url_target'])
+    if kind == 'link':
+        return '[color=0000ff][ref="{}"]{}[/ref][/color]'.format(match['link_target'], match['link_text'])
+    if kind == 'gender':
+        return match[0]
+    # Emphasis may contain further inline elements.
+    tag = _md_emphasis[kind]
+    return f"[{tag}]{_md_inline.sub(_convert_inline, match[kind])}[/{tag}]"
+
+
+def _convert_block(match):
+    if match['level']:
+        return _md_headers[len(match['level'])].format(match['header'])
+    return f"[color=A9A9A9]{match['quote']}[/color]"
+
+
 def markdown_to_bbcode(s):
-    """ Convert markdown tags to kivy style bbcode tags.
+    """ Convert markdown tags to kivy style bbcode tags in one pass over the text for inline elements and one pass
+    over its lines for headers and quotes.
     Does not always work reliably. Best to not mix URLs and tags on the same line in markdown.
     
     :type s: str
     """
+    return _md_block.sub(_convert_block, _md_inline.sub(_convert_inline, s))
+
+
+def render_markdown(content_md, details=None):
+    """ Convert markdown to bbcode and fill in app details. Results are kept per language, text and details,
+    so showing the same long text again, e.g. the terms, is just a lookup.
     
-    def tags_in_excepted_portion(text, start_index, end_index, exception_regex):
-        """ Valid entrances are:
-            _start without space between the _ and the first and last word.
-            multilines are allowed. But one empty line gets out the italic mode._
-            No effect inside URLs.
-        """
-        
-        matches_iterator = re.finditer(exception_regex, text)
-        
-        for match in matches_iterator:
-            match_start = match.start(0)
-            match_end = match.end(0)
-            
-            if ((match_start <= start_index) and (start_index <= match_end)) \
-                    or ((match_start <= end_index) and (end_index <= match_end)):
-                return True
-        return False
-    
-    def single_tag_context_parser(text, regex_expression, bb_code_tag, replacement_size=1):
-        """ Valid entrances are:
-            _start without space between the _ and the first and last word.
-            multilines are allowed. But one empty line get out the italic mode._
-            No effect inside URLs.
-        """
-    
-        # Used to count how many iterations are necessary on the worst case scenario.
-        matches_iterator = re.finditer(regex_expression, text)
-    
-        # The exclusion pattern to remove wrong blocks from being parsed.
-        next_search_position = 0
-    
-        # Iterate until all the initial matches list to finish.
-        for element in matches_iterator:
-        
-            # To perform a new search on the new updated string.
-            match = re.search(regex_expression, text[next_search_position:])
-        
-            # Exit the parsing iteration when not more matches are found.
-            if match is None:
-                break
-        
-            start_index = match.start(0)
-            end_index = match.end(0)
-        
-            start_index = start_index + next_search_position
-            end_index = end_index + next_search_position
-        
-            next_search_position = start_index + replacement_size
-            
-            # Exclude from URLs.
-            if tags_in_excepted_portion(text, start_index, end_index,
-                                        # Also exclude gender asterisk in German.
-                                        r"(<(https?:\S+)>)|(\[(.*?)\]\((.*?)\))|\w+\*([^.\s\n]*\w+)"):
-                continue
-        
-            if end_index + replacement_size > len(text):
-            
-                text = text[0: start_index] \
-                       + "[{0}]".format(bb_code_tag) \
-                       + text[start_index + replacement_size: end_index] \
-                       + "[/{0}]".format(bb_code_tag)
-        
-            else:
-            
-                text = text[0: start_index] \
-                       + "[{0}]".format(bb_code_tag) \
-                       + text[start_index + replacement_size: end_index] \
-                       + "[/{0}]".format(bb_code_tag) \
-                       + text[end_index + replacement_size:]
-        return text
-
-    def translate(formatting_rule="%s", target_group=1):
-        def inline(match_object):
-            """ Recursive function called by the `re.sub` for every non-overlapping occurrence of the pattern.
-                
-                :param match_object: An `sre.SRE_Match object` match object.
-            """
-            s = match_object.group(target_group)
-            # Headers
-            s = re.sub(r"^#\s+(.*?)\s*$", "[size=24dp][b]\\1[/b][/size]", s)  # Header first level
-            s = re.sub(r"^##\s+(.*?)\s*$", "[size=20dp][b]\\1[/b][/size]", s)  # Header second level
-            s = re.sub(r"^###\s+(.*?)\s*$", "[b]\\1[/b]", s)  # Header third level
-            s = re.sub(r"^####\s+(.*?)\s*$", "[i][b]\\1[/b][/i]", s)  # Header fourth level
-            
-            # > Quote
-            s = re.sub(r"^> (.*)$", "[color=A9A9A9]\\1[/color]", s)
-            return formatting_rule % s
-        
-        return inline
-    
-    # Bold and italic.
-    # It re-uses several expressions, needs to be parsed before everything else,
-    # because it needs several hacks (?<=\s), as `_` symbol is often used in URLs.
-    s = single_tag_context_parser(s, r"\*\*[^ \n]([^\*]+?)[^ \n](?=\*\*)", "b", 2)  # **Bold**
-    s = single_tag_context_parser(s, r"{0}[^ \n]([^{0}]+?)[^ \n](?={0})".format("\*"), "i")  # *Italic*
-    s = single_tag_context_parser(s, r"__[^ \n]([^_]+?)[^ \n](?=__)", "b", 2)  # __Bold__
-    s = single_tag_context_parser(s, r"{0}[^ \n]([^{0}]+?)[^ \n](?={0})".format("_"), "i")  # _Italic_
-    s = single_tag_context_parser(s, r"~~[^ \n]([\s\S]+?)[^ \n](?=~~)", "s", 2)  # ~Strikethrough~
-    
-    # URLs. Kivy Label style.
-    s = re.sub(r"<(https?:\S+)>", "[color=0000ff][ref=\"\\1\"]\\1[/ref][/color]", s)
-    s = re.sub(r"\[(.*?)\]\((.*?)\)", "[color=0000ff][ref=\"\\2\"]\\1[/ref][/color]", s)
-    
-    s = re.sub(r"(?m)^((?!~).*)$", translate(), s)
-    s = re.sub(r"\[/quote]\n\[quote]", "\n", s)
-    
-    return s
+    :param content_md: Markdown with placeholders for app details, e.g. {appname}.
+    :type content_md: str
+    :param details: App details as returned by get_app_details(). Looked up if not given.
+    :type details: dict
+    :rtype: str
+    """
+    if details is None:
+        details = get_app_details()
+    key = (current_language(), md5(content_md.encode('utf-8')).digest(), tuple(sorted(details.items())))
+    try:
+        return _bbcode_cache[key]
+    except KeyError:
+        pass
+    text = markdown_to_bbcode(content_md).format(appname=details['appname'],
+                                                 author=details['author'],
+                                                 contact=details['contact'],
+                                                 source=details['source'])
+    _bbcode_cache[key] = text
+    return text
 
 
 def create_markdown_file(path, content_md):
@@ -79,6 +79,8 @@ class UiManager(ScreenManager):
         Clock.schedule_once(lambda dt: self.bind_sidebar_callbacks(), 1)
         if self.is_first_run:
             Clock.schedule_once(lambda dt: self.show_popup_language(), 1)  # Doesn't open otherwise.
+        elif self.app.data_mgr.recovered_session:
+            Clock.schedule_once(lambda dt: self.show_popup_recovery(), 1)
     
     def bind_sidebar_callbacks(self):
         """ Handle events in navigation drawer. """
@@ -310,6 +312,24 @@ class UiManager(ScreenManager):
         popup.bind(on_confirm=lambda instance, *largs: self.app.data_mgr.add_user_data(*largs))
         popup.open()
         
+    def show_popup_recovery(self):
+        """ Offer to finish a session that was interrupted, e.g. because the app was closed by the system. """
+        popup = ConfirmPopup(title=_("Recover interrupted session?"),
+                             text=_("Your last session was interrupted. Do you want to recover its data so you can "
+                                    "store and upload it? Otherwise it will be discarded when you start a new "
+                                    "session."))
+        popup.bind(on_confirm=lambda instance: self.restore_session())
+        popup.open()
+    
+    def restore_session(self):
+        """ Continue with the outro of the interrupted session. """
+        task = self.app.data_mgr.restore_recovered_session()
+        if not task:
+            return
+        self.settings.current_task = task
+        self.transition.direction = 'up'
+        self.current = 'Outro'
+        
     def show_popup_exit(self):
         popup = ConfirmPopup(title=_("Do you want to quit?"))
         popup.bind(on_confirm=self.quit)
@@ -19,7 +19,8 @@ from ..i18n import (_,
                     list_translated_languages,
                     translation_to_language_code,
                     DEFAULT_LANGUAGE)
-from ..utility import create_user_identifier, switch_language, get_app_details, markdown_to_bbcode
+from ..policybundle import get_policy_text
+from ..utility import create_user_identifier, switch_language, get_app_details
 from privacypolicy import get_policy
 from terms import get_terms
 
@@ -666,7 +667,7 @@ class PolicyPopup(SimplePopup):
             size_hint_x=0.9,
         )
         if 'content_cls' not in kwargs:
-            content = RecycleLabel(text=self._get_text(get_policy()), halign='justify')
+            content = RecycleLabel(text=self._get_text('privacypolicy', get_policy), halign='justify')
             content.bind(on_ref_press=lambda instance, value: self.open_link(value))
             default_kwargs.update(content_cls=content)
             
@@ -678,17 +679,13 @@ class PolicyPopup(SimplePopup):
         self.ids.container.size_hint_y = 0.9
         self.ids.container.padding = ('8dp', '8dp', '8dp', '0dp')  # left, top, right, bottom
         
-    def _get_text(self, content_md):
-        details = get_app_details()
-        text = markdown_to_bbcode(content_md).format(appname=details['appname'],
-                                                     author=details['author'],
-                                                     contact=details['contact'],
-                                                     source=details['source'])
-        return text
+    def _get_text(self, name, get_document):
+        # Texts are converted at build time and looked up once per language, so opening the popup again is cheap.
+        return get_policy_text(name, get_document)
 
     def on_pre_open(self):
         # In case the language changed, reload the policy text.
-        self.content_cls.text = self._get_text(get_policy())
+        self.content_cls.text = self._get_text('privacypolicy', get_policy)
         self.content_cls.ids.rv.scroll_y = 1
         
 
@@ -711,9 +708,9 @@ class TermsPopup(PolicyPopup):
         )
         # Show Terms and Privacy Policy together on first run.
         if self.is_first_run:
-            text = self._get_text(get_terms()) + "\n\n" + self._get_text(get_policy())
+            text = self._get_text('terms', get_terms) + "\n\n" + self._get_text('privacypolicy', get_policy)
         else:
-            text = self._get_text(get_terms())
+            text = self._get_text('terms', get_terms)
             
         content = RecycleLabel(text=text, halign='justify')
         content.bind(on_ref_press=lambda instance, value: self.open_link(value))
@@ -735,7 +732,7 @@ class TermsPopup(PolicyPopup):
     def on_pre_open(self):
         # When the terms are dismissed the first time, it means they were accepted.
         if not self.is_first_run:
-            self.content_cls.text = self._get_text(get_terms())
+            self.content_cls.text = self._get_text('terms', get_terms)
             self.ids.button_box.remove_widget(self.__reject_btn)
             self.__accept_btn.text = _("CLOSE")
         self.content_cls.ids.rv.scroll_y = 1
@@ -4,8 +4,8 @@ from hashlib import md5
 
 from kivy.app import App
 from kivy.properties import ObjectProperty, StringProperty, BooleanProperty, NumericProperty
-from kivy.core.audio import SoundLoader
 from kivy.clock import Clock
+from kivy.logger import Logger
 
 from kivymd.uix.behaviors import BackgroundColorBehavior
 
@@ -13,7 +13,10 @@ import numpy as np
 import plyer
 
 from . import BaseScreen, DifficultyRatingPopup
+from ..frametrace import FrameTrace
 from ..i18n import _
+from ..timing import TrialClock, TrialScheduler
+from ..trajectory import TrajectoryRecorder
 from ..utility import time_fmt, create_device_identifier
 
 
@@ -26,11 +29,15 @@ class ScreenCircleTask(BackgroundColorBehavior, BaseScreen):
     constraint = NumericProperty(0)  # 0 = no constraint, 1 = single constraint, 2 = both constrained
     target2_switch = BooleanProperty(False)  # Which slider is controlling the second target.
     is_practice = BooleanProperty(True)
+    # Columns of the trials data.
+    columns = ['df1', 'df2', 'df1_grab', 'df1_release', 'df2_grab', 'df2_release', 'onset_latency', 'onset_jitter',
+               'cue_latency']
     
     def __init__(self, **kwargs):
         # Procedure related.
         self.register_event_type('on_task_stopped')
         self.schedule = None
+        self.scheduler = None
         self.max_trials = 0
         self.max_blocks = 0
         # Control related.
@@ -39,19 +46,24 @@ class ScreenCircleTask(BackgroundColorBehavior, BaseScreen):
         # Save defaults in order to check if sliders have been used at all. Set in on_kv_post.
         self.df1_default = 0.0
         self.df2_default = 0.0
-        # Feedback related.
-        self.sound_start = None
-        self.sound_stop = None
+        # Feedback related. Sounds are cached app-wide.
+        self.is_sound_enabled = False
         # Data collection related.
+        self.clock = TrialClock()  # Single time source for all trial events.
         self.clear_times()
         self.data = None  # For numerical data.
         self.meta_data = dict()  # For context of numerical data acquisition, e.g. treatment/condition.
         self.session_data = list()  # For description of a block if numerical data.
+        self.trajectory = None  # Records slider movements during trials.
+        self.trajectory_schedule = None
+        # Optional instrumentation of frame timing.
+        self.frame_trace = None
+        self.overlay_schedule = None
         super(ScreenCircleTask, self).__init__(**kwargs)
     
     def on_kv_post(self, base_widget):
         """ Bind events. """
-        self.count_down.bind(on_count_down_finished=lambda instance: self.trial_finished())
+        # The count down is only the visual indicator. The end of trials is timed by the scheduler.
         # Release slider when we leave handle position too much.
         # We don't want extra degrees of freedom that we don't measure.
         self.ids.df1.bind(on_grab=self.slider_grab,
@@ -110,11 +122,16 @@ class ScreenCircleTask(BackgroundColorBehavior, BaseScreen):
             n_trials = self.settings.circle_task.n_practice_trials
         else:
             n_trials = self.settings.circle_task.n_trials
-        self.data = np.zeros((n_trials, 6))  # Data for df1, df2, df1_grab, df1_release, df2_grab, df2_release
-        # FixMe: Not loading sound files on Windows. (Unable to find a loader)
-        if self.settings.is_sound_enabled:
-            self.sound_start = SoundLoader.load('res/start.ogg')
-            self.sound_stop = SoundLoader.load('res/stop.ogg')
+        self.data = np.zeros((n_trials, len(self.columns)))
+        self.trajectory = TrajectoryRecorder(n_trials, self.settings.circle_task.trial_duration,
+                                             fixed_rate=self.settings.circle_task.trajectory_rate)
+        self.is_sound_enabled = bool(self.settings.is_sound_enabled)
+        if self.is_sound_enabled:
+            # Usually they're already in memory. Make sure they are before the first trial.
+            App.get_running_app().audio_cues.load()
+        if not self.is_practice:
+            self.open_trial_log()
+        self.setup_frame_trace()
         self.count_down.start_count = self.settings.circle_task.trial_duration
         self.count_down.set_label(_("PREPARE"))
         self.start_task()
@@ -124,35 +141,39 @@ class ScreenCircleTask(BackgroundColorBehavior, BaseScreen):
         """ Set reference to touch event for sliders. """
         if instance == self.ids.df1 and not self.ids.df1.disabled:
             self.df1_touch = touch
-            self.df1_grab_dt = self.df1_touch.time_start - self.onset
+            self.df1_grab_dt = self.clock.from_wall(self.df1_touch.time_start) - self.onset
+            self.mark_event('grab', 1, self.clock.from_wall(touch.time_start))
             self.ids.df1_warning.opacity = 0.0
         elif instance == self.ids.df2 and not self.ids.df2.disabled:
             self.df2_touch = touch
-            self.df2_grab_dt = self.df2_touch.time_start - self.onset
+            self.df2_grab_dt = self.clock.from_wall(self.df2_touch.time_start) - self.onset
+            self.mark_event('grab', 2, self.clock.from_wall(touch.time_start))
             self.ids.df2_warning.opacity = 0.0
     
     def slider_ungrab(self, instance, touch):
         """ Disable sliders when they're let go. """
         if touch.time_end == -1:
-            t = time.time()
+            t = self.clock.now()
         else:
-            t = touch.time_end
+            t = self.clock.from_wall(touch.time_end)
         if (instance == self.ids.df1) and touch is self.df1_touch:
             self.ids.df1.disabled = True
             self.df1_touch.ungrab(self.ids.df1)
             self.df1_release_dt = t - self.onset
             self.df1_touch = None
+            self.mark_event('ungrab', 1, t)
         elif (instance == self.ids.df2) and touch is self.df2_touch:
             self.ids.df2.disabled = True
             self.df2_touch.ungrab(self.ids.df2)
             self.df2_release_dt = t - self.onset
             self.df2_touch = None
+            self.mark_event('ungrab', 2, t)
     
     def disable_sliders(self):
         """ Disable sliders regardless of whether they have touch or not. """
         self.ids.df2.disabled = True
         self.ids.df1.disabled = True
-        t = time.time()
+        t = self.clock.now()
         # Release slider grabs, if any.
         if self.df1_touch:
             self.df1_touch.ungrab(self.ids.df1)
@@ -163,6 +184,37 @@ class ScreenCircleTask(BackgroundColorBehavior, BaseScreen):
             self.df2_release_dt = t - self.onset
             self.df2_touch = None
     
+    def on_touch_move(self, touch):
+        """ Record slider positions on each movement. """
+        handled = super(ScreenCircleTask, self).on_touch_move(touch)
+        self.sample_trajectory()
+        return handled
+    
+    def sample_trajectory(self, *args):
+        """ Record current positions of sliders, if a trial is running. """
+        if self.trajectory:
+            self.trajectory.sample(self.clock.now(), self.ids.df1.value, self.ids.df2.value)
+    
+    def start_trajectory(self):
+        """ Start recording slider movement for the current trial. """
+        if not self.trajectory:
+            return
+        self.trajectory.start_trial(self.settings.current_trial, self.onset)
+        self.sample_trajectory()
+        # Optionally also sample at a fixed rate, so we get data points when the sliders don't move.
+        rate = self.settings.circle_task.trajectory_rate
+        if rate > 0:
+            self.trajectory_schedule = Clock.schedule_interval(self.sample_trajectory, 1.0 / rate)
+    
+    def stop_trajectory(self):
+        """ Stop recording slider movement. """
+        if self.trajectory_schedule:
+            self.trajectory_schedule.cancel()
+            self.trajectory_schedule = None
+        if self.trajectory:
+            self.sample_trajectory()
+            self.trajectory.finish_trial()
+    
     def enable_sliders(self):
         self.ids.df2.disabled = False
         self.ids.df1.disabled = False
@@ -180,24 +232,38 @@ class ScreenCircleTask(BackgroundColorBehavior, BaseScreen):
         return progress
     
     def start_task(self):
-        """ Start the time interval for the repetition of trials. """
+        """ Plan the timeline of all trials in this block and start checking it each frame. """
         self.disable_sliders()
-        # Repeatedly start trials each inter-trial-interval.
-        iti = self.settings.circle_task.warm_up + self.settings.circle_task.trial_duration \
-              + self.settings.circle_task.cool_down
         self.progress = self.get_progress()
-        self.schedule = Clock.schedule_interval(self.get_ready, iti)
+        self.scheduler = TrialScheduler(self.max_trials,
+                                        self.settings.circle_task.warm_up,
+                                        self.settings.circle_task.trial_duration,
+                                        self.settings.circle_task.cool_down,
+                                        clock=self.clock)
+        self.scheduler.start()
+        self.schedule = Clock.schedule_interval(self.check_schedule, 0)
+        if self.frame_trace:
+            self.frame_trace.start()
+    
+    def check_schedule(self, dt):
+        """ Called each frame. Start all phases whose deadline has passed. """
+        for phase, trial, deadline in self.scheduler.poll():
+            if phase == TrialScheduler.GET_READY:
+                self.get_ready()
+            elif phase == TrialScheduler.ONSET:
+                self.start_trial(deadline)
+            elif phase == TrialScheduler.TRIAL_END:
+                self.trial_finished()
+            elif phase == TrialScheduler.BLOCK_END:
+                self.stop_task()
+                break
     
     def get_ready(self, *args):
-        """ Prepare the next trial or stop if the total amount of trials are reached. """
-        if self.settings.current_trial == self.max_trials:
-            self.stop_task()
-        else:
-            self.settings.current_trial += 1
-            self.progress = self.get_progress()
-            self.reset_sliders()
-            self.count_down.set_label(_("GET READY"))
-            Clock.schedule_once(lambda dt: self.start_trial(), self.settings.circle_task.warm_up)
+        """ Prepare the next trial. """
+        self.settings.current_trial += 1
+        self.progress = self.get_progress()
+        self.reset_sliders()
+        self.count_down.set_label(_("GET READY"))
     
     def vibrate(self, t=0.1):
         if self.settings.is_vibrate_enabled:
@@ -208,38 +274,99 @@ class ScreenCircleTask(BackgroundColorBehavior, BaseScreen):
                 pass
     
     def clear_times(self):
-        self.onset = np.NaN
-        self.df1_grab_dt = np.NaN
-        self.df1_release_dt = np.NaN
-        self.df2_grab_dt = np.NaN
-        self.df2_release_dt = np.NaN
+        self.onset = np.nan
+        self.onset_latency = np.nan
+        self.onset_jitter = np.nan
+        self.cue_latency = np.nan
+        self.df1_grab_dt = np.nan
+        self.df1_release_dt = np.nan
+        self.df2_grab_dt = np.nan
+        self.df2_release_dt = np.nan
         
-    def start_trial(self):
-        """ Start the trial. """
-        if self.sound_start:
-            self.sound_start.play()
+    def start_trial(self, deadline=None):
+        """ Start the trial.
+        
+        :param deadline: Planned time of onset.
+        :type deadline: float
+        """
+        cue_time = self.play_cue('start')
         self.enable_sliders()
         self.vibrate()
         self.count_down.start()
-        self.onset = time.time()
+        self.clock.calibrate()
+        self.onset = self.clock.now()
+        if cue_time is not None:
+            self.cue_latency = self.onset - cue_time
+        if deadline is not None:
+            self.onset_jitter = self.onset - deadline
+        self.mark_event('start_trial', self.settings.current_trial, self.onset)
+        # Measure how long it takes until the next frame shows the started trial.
+        Clock.schedule_once(self.measure_onset_latency, 0)
+        self.start_trajectory()
+    
+    def measure_onset_latency(self, dt):
+        """ Called at the beginning of the first frame after the trial's onset. """
+        self.onset_latency = self.clock.now() - self.onset
     
     def trial_finished(self):
         """ Callback for when a trial ends. Collect data. """
-        if self.sound_stop:
-            self.sound_stop.play()
+        self.mark_event('trial_finished', self.settings.current_trial)
+        self.play_cue('stop')
         self.disable_sliders()
+        self.stop_trajectory()
         self.count_down.set_label(_("FINISHED"))
         # Record data for current trial.
         try:
             self.data[self.settings.current_trial - 1, :] = (self.ids.df1.value_normalized,
                                                              self.ids.df2.value_normalized,
                                                              self.df1_grab_dt, self.df1_release_dt,
-                                                             self.df2_grab_dt, self.df2_release_dt)
+                                                             self.df2_grab_dt, self.df2_release_dt,
+                                                             self.onset_latency, self.onset_jitter,
+                                                             self.cue_latency)
             self.check_slider_use()
+            self.log_trial()
         except TypeError:
             # Trial was aborted and data set to None by self.clea_data().
             pass
         self.clear_times()
+    
+    def open_trial_log(self):
+        """ Log each finished trial of this block to disk, so it can be recovered if the app gets killed. """
+        meta_data = dict()
+        meta_data['table'] = 'trials'
+        meta_data['device'] = create_device_identifier()
+        meta_data['user'] = self.settings.current_user
+        meta_data['task'] = self.settings.current_task
+        meta_data['block'] = self.get_block_number()
+        meta_data['treatment'] = self.get_treatment()
+        meta_data['time_iso'] = self.get_current_time_iso(time_fmt)
+        meta_data['time'] = time.time()
+        meta_data['warm_up'] = self.settings.circle_task.warm_up
+        meta_data['trial_duration'] = self.settings.circle_task.trial_duration
+        meta_data['cool_down'] = self.settings.circle_task.cool_down
+        meta_data['columns'] = self.columns
+        App.get_running_app().data_mgr.open_trial_log(meta_data)
+    
+    def log_trial(self):
+        """ Write current trial's data to the trial log, the way it's going to be stored, and analyze it. """
+        if self.is_practice:
+            return
+        values = self.data[self.settings.current_trial - 1].copy()
+        values[:2] *= 100
+        values = np.around(values, decimals=5)
+        data_mgr = App.get_running_app().data_mgr
+        data_mgr.log_trial(self.settings.current_trial, values)
+        # Analyze as we go, so results are ready at the end of the session.
+        data_mgr.analysis.add_trial(self.get_block_number(), self.get_treatment(), values[0], values[1])
+    
+    def close_trial_log(self):
+        """ Stop logging trials of this block. """
+        App.get_running_app().data_mgr.close_trial_log()
+    
+    def discard_block(self):
+        """ Stop logging trials of this block and remove them from the analysis, because they won't be stored. """
+        self.close_trial_log()
+        App.get_running_app().data_mgr.analysis.discard_block(self.get_block_number())
         
     def check_slider_use(self):
         """ Checks if the slider values are still at their defaults and displays warning where appropriate."""
@@ -251,7 +378,7 @@ class ScreenCircleTask(BackgroundColorBehavior, BaseScreen):
             self.ids.df2_warning.opacity = 1.0
         else:
             self.ids.df2_warning.opacity = 0.0
-        if np.isnan(self.data[self.settings.current_trial - 1, 2:]).any() \
+        if np.isnan(self.data[self.settings.current_trial - 1, 2:6]).any() \
                 or np.greater_equal(*self.data[self.settings.current_trial - 1, [2, 5]]) \
                 or np.greater_equal(*self.data[self.settings.current_trial - 1, [4, 3]]):
             self.ids.concurrency_warning.opacity = 1.0
@@ -266,14 +393,20 @@ class ScreenCircleTask(BackgroundColorBehavior, BaseScreen):
         if self.schedule:
             self.schedule.cancel()
             self.schedule = None
+        self.scheduler = None
+        self.stop_trajectory()
         self.reset_sliders()
-        self.release_audio()
+        self.stop_audio()
+        self.stop_frame_trace()
         if interrupt:
+            self.frame_trace = None
+            self.discard_block()
             self.clear_data()
             return
         
         # Check if task was properly done, i.e. sliders were not used at all.
         if (np.isnan(self.data[:, 2]).all()) or (np.isnan(self.data[:, 4]).all()):
+            self.discard_block()
             self.clear_data()
             # Feedback and reset/abort.
             msg = _("Please read instructions again carefully and perform task accordingly.\nAborting Session...")
@@ -313,16 +446,60 @@ class ScreenCircleTask(BackgroundColorBehavior, BaseScreen):
         if was_last_block:
             self.clear_data()
     
-    def release_audio(self):
-        """ Unload audio sources from memory. """
-        if self.sound_start:
-            self.sound_start.stop()
-            self.sound_start.unload()
-            self.sound_start = None
-        if self.sound_stop:
-            self.sound_stop.stop()
-            self.sound_stop.unload()
-            self.sound_stop = None
+    def play_cue(self, name):
+        """ Play sound cue if sounds are enabled.
+        
+        :return: Time just before playback started or None if no sound was played.
+        :rtype: float
+        """
+        if not self.is_sound_enabled:
+            return None
+        t = App.get_running_app().audio_cues.play(name)
+        if t is not None:
+            self.mark_event(f'cue_{name}', self.settings.current_trial, t)
+        return t
+    
+    def setup_frame_trace(self):
+        """ Record frame timing of this block, if enabled in the settings. """
+        mode = self.settings.circle_task.frame_trace
+        self.frame_trace = FrameTrace(clock=self.clock) if mode in ('trace', 'overlay') else None
+        self.ids.frame_overlay.opacity = 1.0 if mode == 'overlay' else 0.0
+        self.ids.frame_overlay.text = ''
+        if mode == 'overlay':
+            self.overlay_schedule = Clock.schedule_interval(self.update_frame_overlay, 0.5)
+    
+    def mark_event(self, name, value=0, t=None):
+        """ Add a task event to the frame trace, if there is one. """
+        if self.frame_trace:
+            self.frame_trace.mark(name, value, t)
+    
+    def update_frame_overlay(self, dt):
+        """ Show timing of the most recent frames. """
+        stats = self.frame_trace.get_stats(last=120) if self.frame_trace else {'n_frames': 0}
+        if not stats['n_frames']:
+            return
+        self.ids.frame_overlay.text = _("{:.0f} fps, p99 {:.1f} ms, jitter {:.1f} ms, hitches {}").format(
+            stats['frame_rate'], stats['frame_p99_ms'], stats['jitter_ms'], stats['n_hitches'])
+    
+    def stop_frame_trace(self):
+        """ Stop recording frames. The recording is kept until the block's data are collected. """
+        if self.overlay_schedule:
+            self.overlay_schedule.cancel()
+            self.overlay_schedule = None
+        self.ids.frame_overlay.opacity = 0.0
+        if self.frame_trace:
+            self.frame_trace.stop()
+    
+    def save_frame_trace(self):
+        """ Store the block's frame trace as a file, if local storage is enabled. Its summary is in the meta data. """
+        if not self.frame_trace:
+            return
+        App.get_running_app().data_mgr.save_trace(self.frame_trace.to_chrome_trace(self.meta_data), self.meta_data)
+        self.frame_trace = None
+    
+    def stop_audio(self):
+        """ Stop any playing cues. They stay in memory for the next block. """
+        App.get_running_app().audio_cues.stop()
     
     def get_current_time_iso(self, fmt=None):
         """ Returns the current datetime as string.
@@ -351,49 +528,74 @@ class ScreenCircleTask(BackgroundColorBehavior, BaseScreen):
         self.collect_meta_data()
         self.add_block_to_session()
         self.add_data_to_manager()
+        self.add_trajectories_to_manager()
+        self.save_frame_trace()
+        # The block is in the data collection now.
+        self.close_trial_log()
     
-    def collect_meta_data(self):
-        """ Collect information about context of data acquisition. """
+    def get_treatment(self):
+        """ Which degrees of freedom are constrained in this block. """
         if self.is_constrained and (self.constraint == 1):
             constrained_df = 'df2' if self.target2_switch else 'df1'
         elif self.is_constrained and (self.constraint == 2):
             constrained_df = 'df1|df2'  # Can't use comma as it is the separator in CSV (comma separated values).
         else:
             constrained_df = ''
-        
+        return constrained_df
+    
+    def get_block_number(self):
+        """ Number of this block. Practice blocks don't count. Make them zero. """
+        if self.is_practice:
+            return 0
+        return self.settings.current_block - (bool(self.settings.circle_task.n_practice_trials) * 2)
+    
+    def collect_meta_data(self):
+        """ Collect information about context of data acquisition. """
         self.meta_data['table'] = 'trials'
         self.meta_data['device'] = create_device_identifier()
         self.meta_data['user'] = self.settings.current_user
         self.meta_data['task'] = self.settings.current_task
-        # Practice blocks don't count. Make them zero.
-        if self.is_practice:
-            self.meta_data['block'] = 0
-        else:
-            self.meta_data['block'] = self.settings.current_block \
-                                      - (bool(self.settings.circle_task.n_practice_trials) * 2)
-        self.meta_data['treatment'] = constrained_df
+        self.meta_data['block'] = self.get_block_number()
+        self.meta_data['treatment'] = self.get_treatment()
         self.meta_data['time_iso'] = self.get_current_time_iso(time_fmt)
         self.meta_data['time'] = time.time()
         self.meta_data['hash'] = md5(self.data).hexdigest()
-        self.meta_data['columns'] = ['df1', 'df2', 'df1_grab', 'df1_release', 'df2_grab', 'df2_release']
+        self.meta_data['warm_up'] = self.settings.circle_task.warm_up
+        self.meta_data['trial_duration'] = self.settings.circle_task.trial_duration
+        self.meta_data['cool_down'] = self.settings.circle_task.cool_down
+        self.meta_data['columns'] = self.columns
+        # Timing quality of the block.
+        if self.frame_trace:
+            self.meta_data['frame_timing'] = self.frame_trace.get_stats()
+        else:
+            self.meta_data.pop('frame_timing', None)
     
     def add_data_to_manager(self):
         """ Add trials data to be written or uploaded to data manager. """
         app = App.get_running_app()
         app.data_mgr.add_data(self.meta_data['columns'], self.data, self.meta_data.copy())
     
+    def add_trajectories_to_manager(self):
+        """ Add the slider movements of this block to data manager. """
+        data = np.around(self.trajectory.get_data(), decimals=5)
+        meta_data = self.meta_data.copy()
+        meta_data['table'] = 'trajectories'
+        meta_data['trials_hash'] = meta_data['hash']  # Links the trajectories to the block of trials.
+        meta_data['hash'] = md5(data).hexdigest()
+        meta_data['columns'] = self.trajectory.columns
+        # Samples that didn't fit into the recording buffers.
+        meta_data['n_dropped'] = self.trajectory.n_dropped
+        meta_data['truncated_trials'] = list(self.trajectory.truncated_trials)
+        if self.trajectory.n_dropped:
+            Logger.warning(f"CircleTask: {self.trajectory.n_dropped} trajectory samples of block "
+                           f"{meta_data['block']} were dropped in trials {self.trajectory.truncated_trials}.")
+        app = App.get_running_app()
+        app.data_mgr.add_data(meta_data['columns'], data, meta_data, fmt='%.5f')
+    
     def add_block_to_session(self):
         """ Collects meta data about the current block. """
-        data = [self.meta_data['task'],
-                self.meta_data['time'],
-                self.meta_data['time_iso'],
-                self.meta_data['block'],
-                self.meta_data['treatment'],
-                self.meta_data['hash'],
-                self.settings.circle_task.warm_up,
-                self.settings.circle_task.trial_duration,
-                self.settings.circle_task.cool_down,
-                self.meta_data['rating']]
+        app = App.get_running_app()
+        data = [self.meta_data[column] for column in app.data_mgr.session_columns]
         self.session_data.append(data)
     
     def add_session_data_to_manager(self):
@@ -405,13 +607,12 @@ class ScreenCircleTask(BackgroundColorBehavior, BaseScreen):
         meta_data['time_iso'] = self.get_current_time_iso(time_fmt)
         meta_data['task'] = self.settings.current_task
         meta_data['user'] = self.settings.current_user
-        columns = ['task', 'time', 'time_iso', 'block', 'treatment', 'hash', 'warm_up', 'trial_duration', 'cool_down',
-                   'rating']
         app = App.get_running_app()
-        app.data_mgr.add_data(columns, data, meta_data)
+        app.data_mgr.add_data(app.data_mgr.session_columns, data, meta_data)
     
     def clear_data(self):
         """ Clear data for the next session. """
         self.session_data.clear()
         self.meta_data.clear()
         self.data = None
+        self.trajectory = None
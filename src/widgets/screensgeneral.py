@@ -1,9 +1,12 @@
+import math
+
 from kivy.app import App
 from kivy.properties import (ObjectProperty,
                              StringProperty,
                              BooleanProperty,
                              )
 from kivy.clock import Clock
+from kivymd.uix.button import MDRectangleFlatButton
 
 from . import BaseScreen
 from . import BlockingPopup
@@ -45,11 +48,15 @@ class ScreenOutro(BaseScreen):
     upload_btn_enabled = BooleanProperty(True)
     popup_block = ObjectProperty(None, allownone=True)
     
+    def on_kv_post(self, base_widget):
+        # Files are written in the background. Update the message once they're stored.
+        App.get_running_app().data_mgr.bind(on_data_saved=lambda instance, success: self._set_msg())
+    
     def on_pre_enter(self, *args):
         # Local storage.
         app = App.get_running_app()
         if app.settings.is_local_storage_enabled and not app.data_mgr.is_data_saved:
-            app.data_mgr.write_data_to_files()
+            app.data_mgr.save_data()
         # Upload.
         self.upload_btn_enabled = app.settings.is_upload_enabled and (not app.data_mgr.is_invalid)
         self._set_msg()
@@ -63,22 +70,84 @@ class ScreenOutro(BaseScreen):
                           "By uploading the data you are making an important contribution to scientific research."
                           "Unless stated otherwise in the study's description we'd appreciate if you only upload "
                           "your data the first time you participated in this study. Thank you.\n")
+        self.msg += self._get_analysis_msg()
         # Local storage.
         app = App.get_running_app()
         dest = app.data_mgr.get_storage_path()
-        if app.data_mgr.is_data_saved:
+        if app.data_mgr.save_job:
+            self.msg += _("Saving files to [i]{}[/i]...\n").format(dest)
+        elif app.data_mgr.is_data_saved:
             self.msg += _("Files were{} saved to [i]{}[/i].\n").format('' if dest.exists() else _(' [b]not[/b]'), dest)
         else:
             self.msg += _("Research data were [b]not[/b] locally stored as files. "
                           "You can enable storing research data on the device in the settings. This, however, is only "
                           "useful to researchers in a laboratory setting with access to the files.\n")
         
+    def _get_analysis_msg(self):
+        """ Instant feedback on the session's results. """
+        app = App.get_running_app()
+        if app.data_mgr.is_invalid or not len(app.data_mgr.analysis):
+            return ""
+        msg = _("[b]Your results[/b]: The higher the synergy index, the more you compensated the variability of one "
+                "slider with the other to keep their sum on target.") + "\n"
+        for res in app.data_mgr.analysis.get_block_results():
+            msg += _("Block {}: synergy index {}").format(res['block'], self._format_dvz(res['dvz'])) + "\n"
+        treatments = app.data_mgr.analysis.get_treatment_results()
+        if len(treatments) > 1:
+            msg += _("[b]By condition[/b]:") + "\n"
+            for treatment, res in sorted(treatments.items()):
+                msg += _("{}: synergy index {}").format(self._get_treatment_name(treatment),
+                                                        self._format_dvz(res['dvz']))
+                if treatment and math.isfinite(res['dvz_diff']):
+                    msg += _(", {:+.2f} compared to no constraint").format(res['dvz_diff'])
+                msg += "\n"
+        return msg + "\n"
+    
+    @staticmethod
+    def _format_dvz(dvz):
+        """ Synergy index for display. It can't be computed for blocks with too few valid trials or without any
+        variability that changed the sum.
+        """
+        if math.isfinite(dvz):
+            return "{:.2f}".format(dvz)
+        return _("not available")
+    
+    @staticmethod
+    def _get_treatment_name(treatment):
+        """ Readable name of the constrained degrees of freedom. """
+        names = {'': _("No constraint"),
+                 'df1': _("Slider 1 constrained"),
+                 'df2': _("Slider 2 constrained"),
+                 'df1|df2': _("Both sliders constrained"),
+                 }
+        return names.get(treatment, treatment)
+        
     def on_upload(self):
+        app = App.get_running_app()
+        # The upload runs in the background. The popup gets dismissed when the response arrives.
+        if not app.data_mgr.upload_data(app.get_upload_route()):
+            # Nothing was sent, e.g. for lack of permission, so there's no response to wait for.
+            return
         # Show we're busy. Heroku dyno sleeps so it can take some time for the response.
         if not self.popup_block:
-            self.popup_block = BlockingPopup(title=_("Uploading..."), text=_("Waking up server.\nPlease be patient."))
+            self.popup_block = BlockingPopup(title=_("Uploading..."),
+                                             text=_("Waking up server.\nPlease be patient."),
+                                             buttons=[MDRectangleFlatButton(text=_("CANCEL"),
+                                                                            on_release=lambda instance:
+                                                                            self.cancel_upload())],
+                                             )
+            app.data_mgr.bind(on_upload_progress=lambda instance, fraction, msg: self.update_upload_progress(msg),
+                              on_data_upload=lambda instance, status, msg: self.popup_block.dismiss())
+        # Don't show the progress of a previous upload.
+        self.popup_block.text = _("Waking up server.\nPlease be patient.")
         self.popup_block.open()
+    
+    def update_upload_progress(self, msg):
+        """ Show what the upload is currently doing. """
+        if self.popup_block and msg:
+            self.popup_block.text = msg
+    
+    def cancel_upload(self):
         app = App.get_running_app()
-        # Workaround to make info popup show up.
-        Clock.schedule_once(lambda dt: app.data_mgr.upload_data(app.get_upload_route()), 0)
+        app.data_mgr.cancel_upload()
         self.popup_block.dismiss()
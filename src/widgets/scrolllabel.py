@@ -21,6 +21,8 @@ THE SOFTWARE.
 """
 # Based on: https://github.com/noembryo/garden.scrolllabel
 
+from collections import OrderedDict
+from math import ceil
 import re
 
 from kivy.core.text import Label as CoreLabel
@@ -38,6 +40,10 @@ from kivy.graphics import Color, Rectangle  # Used in debug marking ref zones.
 
 from ..i18n import _
 
+# Line breaks of laid out paragraphs, shared by all RecycleLabels. Rotating back or reopening a popup reuses them.
+_layout_cache = OrderedDict()
+LAYOUT_CACHE_SIZE = 4096  # Number of paragraphs at a specific width and font.
+
 
 class ScrollText(MDBoxLayout):
     text = StringProperty(_('Loading...'))
@@ -76,15 +82,171 @@ class TextLine(MDLabel):
                                     box[3] - box[1]))
 
 
+# Styles that markup tags open and close. Tags that aren't listed are tracked as 'unknown'.
+MARKUP_STYLES = {'b': ('bold',),
+                 'i': ('italic',),
+                 'u': ('underline',),
+                 's': ('strikethrough',),
+                 'size': ('font_size',),
+                 'color': ('color',),
+                 'font': ('font_name',),
+                 'font_family': ('font_family',),
+                 'font_context': ('font_context',),
+                 'font_features': ('font_features',),
+                 'text_language': ('text_language',),
+                 'sub': ('font_size', 'script'),
+                 'sup': ('font_size', 'script'),
+                 'ref': ('_ref',),
+                 'anchor': (),  # Has no closing tag.
+                 }
+_markup_tag = re.compile(r"\[(/?)([a-z_]+)(?:=[^\]]*)?\]")
+_partial_tag = re.compile(r"\[/?[a-z_]*(?:=[^\]]*)?$")  # Start of a tag at the end of a row.
+
+
+def get_separators(paragraph, rows):
+    """ What preceded each row of a wrapped paragraph in its text. The label drops the whitespace it wraps at.
+    
+    :param paragraph: Text that was wrapped.
+    :type paragraph: str
+    :param rows: Rows of the wrapped text.
+    :type rows: Iterable[str]
+    :return: For each row, the whitespace it was wrapped at, or an empty string where a word was cut.
+        For the first row it's the paragraph's leading whitespace.
+    :rtype: list[str]
+    """
+    separators = list()
+    pos = 0
+    for row in rows:
+        start = paragraph.find(row, pos)
+        if start < 0 or paragraph[pos:start].strip():
+            # The label changed the text, we can't tell what was there.
+            separators.append(' ' if separators else '')
+            pos += len(row)
+            continue
+        separators.append(paragraph[pos:start])
+        pos = start + len(row)
+    return separators
+
+
+def wrap_paragraph(paragraph, width, **options):
+    """ Lay out a paragraph with a core label. Markup tags stay in the text.
+    
+    :param paragraph: Text without line breaks.
+    :type paragraph: str
+    :param width: Width to wrap the paragraph at.
+    :type width: int
+    :param options: Options of the core label, e.g. font_size.
+    :return: Rows with what preceded them in the paragraph, see get_separators, and the height of a row,
+        which is 0 for empty paragraphs.
+    :rtype: tuple[tuple[tuple[str, str]], float]
+    """
+    if not paragraph.strip():
+        return ((paragraph, ""),), 0
+    label = CoreLabel(text=paragraph, text_size=(width, None), **options)
+    label.resolve_font_name()
+    label.render()  # Generates label._cached_lines.
+    rows = [line.words[0].text if len(line.words) else "" for line in label._cached_lines] or [""]
+    return tuple(zip(get_separators(paragraph, rows), rows)), label._cached_lines[0].h if label._cached_lines else 0
+
+
+class MarkupBalancer:
+    """ Merges rows of marked up text into lines, so that every style opened in a line is closed in the same line.
+    Rows can be fed in several batches. Only the new rows are scanned for tags.
+    """
+    def __init__(self):
+        self.lines = list()
+        self.n_rows = list()  # Number of rows merged into each line.
+        self._separators = list()  # What preceded each line in the text.
+        self._open = dict()  # Style -> how many times it's open.
+        self._depth = 0
+        self._partial = ''  # Start of a tag that was cut where the row was wrapped.
+    
+    def clear(self):
+        self.lines.clear()
+        self.n_rows.clear()
+        self._separators.clear()
+        self._open.clear()
+        self._depth = 0
+        self._partial = ''
+    
+    def get_text(self):
+        """ The text that was fed, put back together. Only whitespace at the end of paragraphs is missing, which the
+        label drops when it lays them out.
+        """
+        return ''.join(separator + line for separator, line in zip(self._separators, self.lines))
+    
+    def _scan(self, row):
+        """ Update open styles with the tags in row. """
+        open_styles = self._open
+        row = self._partial + row
+        partial = _partial_tag.search(row)
+        self._partial = partial[0] if partial else ''
+        for match in _markup_tag.finditer(row):
+            is_closing, tag = match.groups()
+            for style in MARKUP_STYLES.get(tag, ('unknown',)):
+                count = open_styles.get(style, 0)
+                if is_closing:
+                    # Closing tags that weren't opened are ignored.
+                    if count:
+                        open_styles[style] = count - 1
+                        self._depth -= 1
+                else:
+                    open_styles[style] = count + 1
+                    self._depth += 1
+    
+    def feed(self, rows):
+        """ Add rows, merging them with the previous line while styles are open.
+        
+        :param rows: Rows of text with what preceded them in the text, i.e. a line break at the start of a
+            paragraph, the whitespace a paragraph was wrapped at, or nothing where a word was cut.
+        :type rows: Iterable[tuple[str, str]]
+        """
+        for separator, row in rows:
+            if (self._depth or self._partial) and self.lines:
+                self.lines[-1] += separator + row
+                self.n_rows[-1] += 1
+            else:
+                self.lines.append(row)
+                self.n_rows.append(1)
+                self._separators.append(separator)
+            self._scan(row)
+
+
+def group_paragraphs(paragraphs):
+    """ Split paragraphs into runs that can be balanced on their own, because no style is open and no tag is cut
+    between them. Only tags are scanned, nothing is laid out.
+    
+    :param paragraphs: Lines of a text.
+    :type paragraphs: list[str]
+    :return: Index of the first paragraph of each run, followed by the number of paragraphs.
+    :rtype: list[int]
+    """
+    scanner = MarkupBalancer()
+    starts = list()
+    for i, paragraph in enumerate(paragraphs):
+        if not (scanner._depth or scanner._partial):
+            starts.append(i)
+        scanner._scan(paragraph)
+    starts.append(len(paragraphs))
+    return starts
+
+
 class RecycleLabel(Widget):
     """ Scrollable label with support for long texts.
     When kivy labels hold too much text they exceed the maximum texture size the GPU can handle.
     This uses the RecycleView to try to overcome this limitation.
     
+    Only paragraphs in and around the visible part of the view are laid out, the others are laid out when they're
+    scrolled to. Until then, their height is estimated from their length. Line breaks are cached per paragraph, width
+    and font.
+    
+    Lines in which a style isn't closed are merged with the following ones. Paragraphs that are merged this way are
+    laid out together.
+    
     Issues:
-        - Can remove spaces in marked up text.
         - halign 'justify' isn't working.
     """
+    char_width = 0.5  # Average width of a character relative to the font size, to estimate heights.
     text = StringProperty()
     font_size = NumericProperty(sp(14))
     font_name = StringProperty("Roboto")
@@ -98,8 +260,14 @@ class RecycleLabel(Widget):
     def __init__(self, **kwargs):
         super(RecycleLabel, self).__init__(**kwargs)
         self.register_event_type('on_ref_press')
-        self._style_stack = {}
+        self._paragraphs = list()
+        self._group_starts = [0]  # First paragraph of each group of paragraphs that are balanced together.
+        self._group_heights = list()  # Estimated until the group is laid out.
+        self._group_entries = list()  # Number of entries of each group in the view's data.
+        self._is_laid_out = list()
+        self._line_height = 0
         self._trigger_refresh_label = Clock.create_trigger(self.refresh_label)
+        self._trigger_layout_visible = Clock.create_trigger(self._layout_visible)
         self.bind(text=self._trigger_refresh_label,
                   font_size=self._trigger_refresh_label,
                   font_name=self._trigger_refresh_label,
@@ -108,162 +276,117 @@ class RecycleLabel(Widget):
                   markup=self._trigger_refresh_label,
                   outline_width=self._trigger_refresh_label,
                   )
+        self.ids.rv.bind(scroll_y=self._trigger_layout_visible,
+                         height=self._trigger_layout_visible,
+                         )
         self._trigger_refresh_label()
-
-    def get_markup_elements(self, text):
-        """ Return the text with all the markup splitted into elements. """
-        s = re.split('(\[.*?\])', text)
-        s = [x for x in s if x != '']
-        return s
     
-    def get_lines(self, cached_lines):
-        """ Returns text in cached lines as strings. """
-        lines = [line.words[0].text if len(line.words) else "" for line in cached_lines]
-        return lines
+    def _layout_paragraph(self, paragraph, width):
+        """ Line breaks of a paragraph at the given width with the current font.
         
-    def _push_style(self, k):
-        if k not in self._style_stack:
-            self._style_stack[k] = 0
-        self._style_stack[k] += 1
-
-    def _pop_style(self, k):
-        if k not in self._style_stack or not self._style_stack[k]:
-            #Logger.warning(f"Label: style {k} was not pushed to stack. Unable to pop.")
-            return
-        self._style_stack[k] -= 1
-        
-    def is_style_stack_empty(self):
-        """ Returns whether all opening tags havve matching closing tags. """
-        return not bool(sum(self._style_stack.values()))
-    
-    def on_lines(self, instance, lines):
-        """ When a line is changed process the contained style tags. """
+        :return: Rows with what preceded them and their height, see wrap_paragraph.
+        :rtype: tuple[tuple[tuple[str, str]], float]
+        """
+        key = (paragraph, width, self.font_name, self.font_size, self.halign, self.markup, self.outline_width)
         try:
-            self._style_push_pop(lines[-1])
-        except IndexError:
+            layout = _layout_cache[key]
+            _layout_cache.move_to_end(key)
+            return layout
+        except KeyError:
             pass
+        layout = wrap_paragraph(paragraph, width,
+                                halign=self.halign,
+                                font_size=self.font_size,
+                                font_name=self.font_name,
+                                markup=self.markup,
+                                outline_width=self.outline_width,
+                                )
+        _layout_cache[key] = layout
+        if len(_layout_cache) > LAYOUT_CACHE_SIZE:
+            _layout_cache.popitem(last=False)
+        return layout
+    
+    def _get_entry(self, line, height):
+        return {"text": line,
+                "font_name": self.font_name,
+                "font_size": self.font_size,
+                "height": height,
+                "size_hint_y": None,
+                "halign": self.halign,
+                "markup": self.markup,
+                "color": self.color,
+                "outline_width": self.outline_width,
+                }
+    
+    def _estimate_height(self, group):
+        """ Height of a group of paragraphs that wasn't laid out yet, from the length of its text. """
+        line_height = self._line_height or self.font_size * 1.2
+        row_length = max(self.width / (self.font_size * self.char_width), 1)
+        paragraphs = self._paragraphs[self._group_starts[group]:self._group_starts[group + 1]]
+        return line_height * sum(max(ceil(len(_markup_tag.sub('', paragraph)) / row_length), 1)
+                                 for paragraph in paragraphs)
     
-    def _concat_style_tags(self, lines):
-        """ When opening and closing style tags are not in balance, merge the lines. """
-        for line in lines:
-            if not self.is_style_stack_empty():
-                # Concatenate lines and check again.
-                self._style_stack.clear()
-                try:
-                    self.lines[-1] += line  # ToDo: Missing spaces after concatenation. Because of stripped lines?
-                except IndexError:
-                    self.lines.append(line)
-            else:
-                self.lines.append(line)
-            
-    def _style_push_pop(self, line):
-        """ Check the given line for any opening and closing style tags.
-        Used to match style tags to one-another.
-        """
-        spush = self._push_style
-        spop = self._pop_style
-        markup = self.get_markup_elements(line)
-        for item in markup:
-            if item == '[b]':
-                spush('bold')
-            elif item == '[/b]':
-                spop('bold')
-            elif item == '[i]':
-                spush('italic')
-            elif item == '[/i]':
-                spop('italic')
-            elif item == '[u]':
-                spush('underline')
-            elif item == '[/u]':
-                spop('underline')
-            elif item == '[s]':
-                spush('strikethrough')
-            elif item == '[/s]':
-                spop('strikethrough')
-            elif item[:6] == '[size=':
-                spush('font_size')
-            elif item == '[/size]':
-                spop('font_size')
-            elif item[:7] == '[color=':
-                spush('color')
-            elif item == '[/color]':
-                spop('color')
-            elif item[:6] == '[font=':
-                spush('font_name')
-            elif item == '[/font]':
-                spop('font_name')
-            elif item[:13] == '[font_family=':
-                spush('font_family')
-            elif item == '[/font_family]':
-                spop('font_family')
-            elif item[:14] == '[font_context=':
-                spush('font_context')
-            elif item == '[/font_context]':
-                spop('font_context')
-            elif item[:15] == '[font_features=':
-                spush('font_features')
-            elif item == '[/font_features]':
-                spop('font_features')
-            elif item[:15] == '[text_language=':
-                spush('text_language')
-            elif item == '[/text_language]':
-                spop('text_language')
-            elif item[:5] == '[sub]':
-                spush('font_size')
-                spush('script')
-            elif item == '[/sub]':
-                spop('font_size')
-                spop('script')
-            elif item[:5] == '[sup]':
-                spush('font_size')
-                spush('script')
-            elif item == '[/sup]':
-                spop('font_size')
-                spop('script')
-            elif item[:5] == '[ref=':
-                spush('_ref')
-            elif item == '[/ref]':
-                spop('_ref')
-            elif '[/' in item:
-                spop('unknown')
-            elif '[' in item:
-                spush('unknown')
-
     def refresh_label(self, *args):
-        lcls = CoreLabel
-        label = lcls(text=self.text,
-                     text_size=(self.width, None),
-                     halign=self.halign,
-                     font_size=self.font_size,
-                     font_name=self.font_name,
-                     markup=self.markup,
-                     outline_width=self.outline_width,
-                     )
-        label.resolve_font_name()
-        label.render()  # Generates label._cached_lines.
+        """ Estimate the height of the text and lay out the visible part. """
+        self._paragraphs = self.text.split('\n')
+        self._group_starts = group_paragraphs(self._paragraphs)
+        n_groups = len(self._group_starts) - 1
+        self._line_height = 0
+        self._group_heights = [self._estimate_height(group) for group in range(n_groups)]
+        self._group_entries = [1] * n_groups
+        self._is_laid_out = [False] * n_groups
+        self.lines = [""] * n_groups
+        self.ids.rv.data = [self._get_entry("", height) for height in self._group_heights]
+        self._layout_visible()
+    
+    def _layout_group(self, group, width):
+        """ Lay out and balance a group of paragraphs.
         
-        lines = self.get_lines(label._cached_lines)
-        self.lines.clear()
-        self._concat_style_tags(lines)
-
-        # get lines
-        font_name = self.font_name
-        font_size = self.font_size
-        halign = self.halign
-        markup = self.markup
-        color = self.color
-        outline_width = self.outline_width
-        data = ({"text": line,
-                 "font_name": font_name,
-                 "font_size": font_size,
-                 "height": label._cached_lines[0].h,  # line.h,  # ToDo: proper line height
-                 "size_hint_y": None,
-                 "halign": halign,
-                 "markup": markup,
-                 "color": color,
-                 "outline_width": outline_width,
-                 } for line in self.lines)
-        self.ids.rv.data = data
+        :return: Lines and the number of rows in each line.
+        :rtype: tuple[list[str], list[int]]
+        """
+        balancer = MarkupBalancer()
+        for i in range(self._group_starts[group], self._group_starts[group + 1]):
+            rows, height = self._layout_paragraph(self._paragraphs[i], width)
+            if i:
+                # Paragraphs were separated by a line break.
+                rows = (('\n' + rows[0][0], rows[0][1]),) + rows[1:]
+            balancer.feed(rows)
+            self._line_height = self._line_height or height
+        return balancer.lines, balancer.n_rows
+    
+    def _layout_visible(self, *args):
+        """ Lay out the groups of paragraphs in and around the visible part of the view, which weren't yet. """
+        rv = self.ids.rv
+        heights = self._group_heights
+        margin = rv.height / 2
+        top = (1 - rv.scroll_y) * max(sum(heights) - rv.height, 0)  # Scroll distance from the top.
+        width = int(self.width)
+        data = rv.data
+        offset = 0  # Distance of the group from the top.
+        index = 0  # Position of the group's first entry in the view's data.
+        shift = 0  # Change in height above the visible part.
+        for group, is_laid_out in enumerate(self._is_laid_out):
+            if offset > top + rv.height + margin:
+                break
+            height = heights[group]
+            if not is_laid_out and offset + height > top - margin:
+                lines, n_rows = self._layout_group(group, width)
+                line_height = self._line_height or self.font_size * 1.2
+                entries = [self._get_entry(line, line_height * n) for line, n in zip(lines, n_rows)]
+                data[index:index + self._group_entries[group]] = entries
+                self.lines[index:index + self._group_entries[group]] = lines
+                self._group_entries[group] = len(entries)
+                self._is_laid_out[group] = True
+                heights[group] = line_height * sum(n_rows)
+                if offset + height <= top:
+                    shift += heights[group] - height
+                height = heights[group]
+            offset += height
+            index += self._group_entries[group]
+        if shift:
+            # Keep what's shown in place.
+            rv.scroll_y = min(max(1 - (top + shift) / max(sum(heights) - rv.height, 1), 0), 1)
 
     def on_ref_press(self, ref):
         pass
@@ -0,0 +1,137 @@
+""" Run blocking work like network requests or file I/O off the main thread.
+
+Results, progress and errors are handed back to the Kivy main loop through the Clock, so callbacks may safely touch
+widgets and dispatch events.
+"""
+import queue
+import threading
+
+from kivy.clock import Clock
+from kivy.logger import Logger
+
+
+class JobCancelled(Exception):
+    """ Raised inside a job's function when it notices it was cancelled. """
+    pass
+
+
+class Job:
+    """ A unit of work for a BackgroundWorker.
+
+    The function receives the job itself as first argument, so it can report progress and check for cancellation.
+    """
+    def __init__(self, func, *args, on_done=None, on_progress=None, on_error=None, **kwargs):
+        """
+        :param func: Callable to execute in the worker thread, called as func(job, *args, **kwargs).
+        :param on_done: Called on the main thread with the return value of func.
+        :param on_progress: Called on the main thread with a fraction between 0 and 1 and a message.
+        :param on_error: Called on the main thread with the exception raised by func.
+        """
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.on_done = on_done
+        self.on_progress = on_progress
+        self.on_error = on_error
+        self._cancelled = threading.Event()
+        self._finished = threading.Event()
+
+    @property
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def is_finished(self):
+        return self._finished.is_set()
+
+    def cancel(self):
+        """ Request cancellation. A job that's already running stops at its next call of check_cancelled. """
+        self._cancelled.set()
+
+    def detach(self):
+        """ Drop the callbacks, but let the job run to completion. For jobs whose work still needs to be done, but
+        whose result nobody is waiting for anymore.
+        """
+        self.on_done = None
+        self.on_progress = None
+        self.on_error = None
+
+    def _schedule_callback(self, name, *args):
+        """ Call one of the callbacks on the main thread, unless the job got cancelled or detached by then. """
+        def callback(dt):
+            func = getattr(self, name)
+            if func and not self.is_cancelled:
+                func(*args)
+        Clock.schedule_once(callback)
+
+    def check_cancelled(self):
+        """ Raise JobCancelled if cancellation was requested. Call this between steps of the job's function. """
+        if self.is_cancelled:
+            raise JobCancelled()
+
+    def report_progress(self, fraction, msg=''):
+        """ Inform the main thread about the progress of this job. """
+        if self.on_progress and not self.is_cancelled:
+            self._schedule_callback('on_progress', fraction, msg)
+
+    def wait(self, timeout=None):
+        """ Block until the job finished or timeout in seconds is reached. Returns whether it finished. """
+        return self._finished.wait(timeout)
+
+    def run(self):
+        """ Execute the job in the current thread and schedule callbacks on the main thread. """
+        try:
+            self.check_cancelled()
+            result = self.func(self, *self.args, **self.kwargs)
+        except JobCancelled:
+            pass
+        except Exception as e:
+            Logger.exception(f"Worker: Job {self.func.__name__} failed.")
+            if self.on_error and not self.is_cancelled:
+                self._schedule_callback('on_error', e)
+        else:
+            if self.on_done and not self.is_cancelled:
+                self._schedule_callback('on_done', result)
+        finally:
+            self._finished.set()
+
+
+class BackgroundWorker:
+    """ A single daemon thread that processes submitted jobs one after another. """
+    def __init__(self, name='worker'):
+        self.name = name
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.current_job = None
+
+    def _ensure_thread(self):
+        """ Start the thread on first use. """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def submit(self, job):
+        """ Queue job for execution.
+
+        :type job: Job
+        :rtype: Job
+        """
+        self._ensure_thread()
+        self._queue.put(job)
+        return job
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            self.current_job = job
+            job.run()
+            self.current_job = None
+
+    def stop(self):
+        """ Let the thread exit after the already queued jobs. """
+        if self._thread and self._thread.is_alive():
+            self._queue.put(None)
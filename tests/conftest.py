@@ -0,0 +1,96 @@
+""" Shared fixtures. The tests run without a window, like the benchmarks. """
+import ast
+import gettext
+import os
+from pathlib import Path
+import shutil
+import struct
+import sys
+import tempfile
+
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+os.environ.setdefault('KIVY_NO_CONSOLELOG', '1')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pytest
+
+from benchmarks.headless import HeadlessApp
+
+LOCALE_DIR = Path(__file__).resolve().parent.parent / 'locales'
+
+
+def read_po(path):
+    """ Messages of a .po file without plural forms or contexts, like the app's. """
+    messages = dict()
+    msgid = msgstr = None
+    current = None
+    for line in path.read_text(encoding='utf-8').splitlines() + ['']:
+        line = line.strip()
+        if line.startswith('msgid '):
+            if msgid is not None:
+                messages[msgid] = msgstr
+            msgid, msgstr = ast.literal_eval(line[6:]), ''
+            current = 'msgid'
+        elif line.startswith('msgstr '):
+            msgstr = ast.literal_eval(line[7:])
+            current = 'msgstr'
+        elif line.startswith('"') and current == 'msgid':
+            msgid += ast.literal_eval(line)
+        elif line.startswith('"') and current == 'msgstr':
+            msgstr += ast.literal_eval(line)
+        elif not line or line.startswith('#'):
+            current = None
+    if msgid is not None:
+        messages[msgid] = msgstr
+    return {k: v for k, v in messages.items() if v or not k}
+
+
+def write_mo(messages, path):
+    """ Compile messages into the GNU .mo format that gettext reads. """
+    ids = sorted(messages)
+    keys = [k.encode('utf-8') for k in ids]
+    values = [messages[k].encode('utf-8') for k in ids]
+    key_start = 7 * 4 + 16 * len(ids)
+    value_start = key_start + sum(len(k) + 1 for k in keys)
+    offsets = list()
+    for k in keys:
+        offsets.append((len(k), key_start))
+        key_start += len(k) + 1
+    for v in values:
+        offsets.append((len(v), value_start))
+        value_start += len(v) + 1
+    header = struct.pack('Iiiiiii', 0x950412de, 0, len(ids), 7 * 4, 7 * 4 + 8 * len(ids), 0, 0)
+    table = b''.join(struct.pack('ii', length, offset) for length, offset in offsets)
+    path.write_bytes(header + table + b'\0'.join(keys) + b'\0' + b'\0'.join(values) + b'\0')
+
+
+def pytest_configure(config):
+    """ Translations are compiled when the app is built. Compile them outside the source tree for the tests. """
+    config.mo_dir = Path(tempfile.mkdtemp(prefix='locales-'))
+    for po_path in LOCALE_DIR.glob('*/LC_MESSAGES/*.po'):
+        mo_path = config.mo_dir / po_path.relative_to(LOCALE_DIR).with_suffix('.mo')
+        mo_path.parent.mkdir(parents=True, exist_ok=True)
+        write_mo(read_po(po_path), mo_path)
+    translation = gettext.translation
+
+    def compiled_translation(domain, localedir=None, *args, **kwargs):
+        if localedir is not None and Path(localedir) == LOCALE_DIR:
+            localedir = config.mo_dir
+        return translation(domain, localedir, *args, **kwargs)
+
+    config.monkeypatch = pytest.MonkeyPatch()
+    config.monkeypatch.setattr(gettext, 'translation', compiled_translation)
+
+
+def pytest_unconfigure(config):
+    if hasattr(config, 'monkeypatch'):
+        config.monkeypatch.undo()
+        shutil.rmtree(config.mo_dir, ignore_errors=True)
+
+
+@pytest.fixture
+def app(tmp_path):
+    from kivy.app import App
+    App._running_app = HeadlessApp(tmp_path, user='test')
+    yield App._running_app
+    App._running_app = None
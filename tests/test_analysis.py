@@ -0,0 +1,20 @@
+import math
+
+import numpy as np
+
+from src.analysis import SessionAnalysis
+
+
+def test_treatment_results_skip_non_finite_blocks():
+    analysis = SessionAnalysis()
+    analysis.add_block(1, '', np.array([[50.0, 50.0], [40.0, 60.0], [55.0, 44.0]]))
+    analysis.add_block(2, 'df1', np.array([[50.0, 50.0], [45.0, 55.0]]))  # No variance orthogonal to the UCM.
+    analysis.add_block(3, 'df1', np.array([[50.0, 50.0], [48.0, 53.0], [52.0, 46.0]]))
+    analysis.add_block(4, 'df2', np.array([[50.0, 50.0]]))  # Too few trials.
+    blocks = analysis.get_block_results()
+    assert math.isinf(blocks[1]['dvz']) and math.isnan(blocks[3]['dvz'])
+    treatments = analysis.get_treatment_results()
+    assert treatments['df1']['n_blocks'] == 2
+    assert treatments['df1']['dvz'] == blocks[2]['dvz']
+    assert math.isclose(treatments['df1']['dvz_diff'], blocks[2]['dvz'] - blocks[0]['dvz'])
+    assert math.isnan(treatments['df2']['dvz'])
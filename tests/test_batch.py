@@ -0,0 +1,56 @@
+import numpy as np
+
+from src.batch import find_files, process_user
+from src.datastore import DataStore
+from src.serializers import CSVSerializer, NpySerializer
+
+TRIAL_COLUMNS = ['df1', 'df2', 'sum']
+SESSION_COLUMNS = ['task', 'time_iso', 'block', 'treatment', 'rating']
+
+
+def make_trials(seed):
+    rng = np.random.default_rng(seed)
+    df1 = rng.uniform(0, 100, 10)
+    df2 = 100 - df1 + rng.normal(0, 1, 10)
+    return np.column_stack((df1, df2, df1 + df2))
+
+
+def make_session(time_iso, treatment):
+    return np.array([['Circle Task', time_iso, '1', treatment, '3']], dtype=object)
+
+
+def test_reads_all_storage_formats(tmp_path):
+    csv_ser = CSVSerializer()
+    npy_ser = NpySerializer()
+    # CSV files.
+    folder = tmp_path / 'circle_task' / 'csv_user'
+    folder.mkdir(parents=True)
+    (folder / 'trials-2024_01_01-Block_1.csv').write_bytes(csv_ser.dumps(TRIAL_COLUMNS, make_trials(1), fmt='%.5f'))
+    (folder / 'session-2024_01_01.csv').write_bytes(csv_ser.dumps(SESSION_COLUMNS, make_session('2024_01_01', '')))
+    # Binary files.
+    folder = tmp_path / 'circle_task' / 'npy_user'
+    folder.mkdir(parents=True)
+    (folder / 'trials-2024_01_02-Block_1.npsy').write_bytes(npy_ser.dumps(TRIAL_COLUMNS, make_trials(2)))
+    (folder / 'session-2024_01_02.npsy').write_bytes(npy_ser.dumps(SESSION_COLUMNS,
+                                                                  make_session('2024_01_02', 'df1')))
+    # Single-file store with data sets in both formats.
+    folder = tmp_path / 'circle_task' / 'store_user'
+    folder.mkdir(parents=True)
+    meta = {'task': 'Circle Task', 'user': 'store_user', 'time_iso': '2024_01_03'}
+    with DataStore(folder / DataStore.file_name) as store:
+        store.add([dict(meta, table='session', format='csv',
+                        data=csv_ser.dumps(SESSION_COLUMNS, make_session('2024_01_03', 'df2'))),
+                   dict(meta, table='trials', block=1, format='npy', data=npy_ser.dumps(TRIAL_COLUMNS, make_trials(3))),
+                   ])
+
+    users = find_files(tmp_path)
+    assert sorted(user for _, user in users) == ['csv_user', 'npy_user', 'store_user']
+    for (folder, user), files in users.items():
+        task, trials, blocks = process_user(folder, user, files)
+        assert task == 'Circle Task'
+        assert len(trials) == 1
+        assert trials[0][2] == TRIAL_COLUMNS
+        assert len(blocks) == 1
+        assert blocks[0]['n_trials'] == 10
+        assert blocks[0]['treatment'] == {'csv_user': '', 'npy_user': 'df1', 'store_user': 'df2'}[user]
+        assert blocks[0]['rating'] == '3'
@@ -0,0 +1,91 @@
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip('kivy')
+
+from src.datamanager import DataManager
+from src.workers import Job
+
+
+def wait_for_io(data_mgr):
+    """ Wait until the file writes queued so far are done. """
+    assert data_mgr._io_worker.submit(Job(lambda job: None)).wait(5)
+
+
+def test_clear_keeps_queued_save(app, tmp_path):
+    data_mgr = DataManager()
+    meta_data = {'table': 'trials', 'task': 'Circle Task', 'user': 'user1', 'time_iso': '2020_01_01_12_00_00',
+                 'block': 1}
+    data_mgr.add_data(['trial', 'df1', 'df2'], np.array([[1, 50.0, 50.0], [2, 40.0, 60.0]]), meta_data)
+    # Hold the I/O thread, so the save is still waiting in the queue when the collection gets cleared.
+    release = threading.Event()
+    data_mgr._io_worker.submit(Job(lambda job: release.wait(5)))
+    save_job = data_mgr.save_data()
+    data_mgr.clear_data_collection()
+    release.set()
+    assert save_job.wait(5)
+    assert (tmp_path / 'Circle_Task' / 'user1' / 'trials-2020_01_01_12_00_00-Block_1.csv').exists()
+    # The old collection's result doesn't count for the new one.
+    assert not data_mgr.is_data_saved
+    assert save_job.on_done is None
+
+
+def test_no_trace_without_local_storage(app, tmp_path):
+    data_mgr = DataManager()
+    meta_data = {'task': 'Circle Task', 'user': 'user1', 'time_iso': '2020_01_01_12_00_00', 'block': 1}
+    app.settings.is_local_storage_enabled = 0
+    assert data_mgr.save_trace({'traceEvents': []}, meta_data) is None
+    app.settings.is_local_storage_enabled = 1
+    assert data_mgr.save_trace({'traceEvents': []}, meta_data).wait(5)
+    assert (tmp_path / 'Circle_Task' / 'user1' / 'trace-2020_01_01_12_00_00-Block_1.json').exists()
+
+
+def test_cancelled_upload_is_recorded(app, monkeypatch):
+    from kivy.clock import Clock
+    data_mgr = DataManager()
+    data_mgr.journal.start()
+    meta_data = {'table': 'trials', 'task': 'Circle Task', 'user': 'user1', 'time_iso': '2020_01_01_12_00_00',
+                 'block': 1, 'hash': 'abc'}
+    data_mgr.add_data(['trial', 'df1', 'df2'], np.array([[1, 50.0, 50.0]]), meta_data)
+    wait_for_io(data_mgr)
+    assert data_mgr.journal.has_session()
+    sent = threading.Event()
+    release = threading.Event()
+
+    def post_data_sets(job, route, data_sets):
+        sent.set()
+        release.wait(5)
+        return True, "ok"
+
+    monkeypatch.setattr(data_mgr, '_post_data_sets', post_data_sets)
+    reports = list()
+    data_mgr.bind(on_data_upload=lambda instance, status, msg: reports.append(status))
+    job = data_mgr.upload_data('http://127.0.0.1:5000/upload')
+    assert sent.wait(5)
+    # The request is out when the user gives up waiting.
+    data_mgr.cancel_upload()
+    release.set()
+    assert job.wait(5)
+    Clock.tick()
+    wait_for_io(data_mgr)
+    assert data_mgr.is_data_sent
+    assert not data_mgr.journal.has_session()
+    assert not reports
+
+
+def test_journal_is_written_in_background(app):
+    data_mgr = DataManager()
+    data_mgr.journal.start()
+    release = threading.Event()
+    data_mgr._io_worker.submit(Job(lambda job: release.wait(5)))
+    meta_data = {'table': 'trials', 'task': 'Circle Task', 'user': 'user1', 'time_iso': '2020_01_01_12_00_00',
+                 'block': 1}
+    data_mgr.add_data(['trial', 'df1', 'df2'], np.array([[1, 50.0, 50.0]]), meta_data)
+    # Adding data doesn't wait for the disk.
+    assert not data_mgr.journal.journal_path.exists()
+    release.set()
+    wait_for_io(data_mgr)
+    data_sets, blocks = data_mgr.journal.load()
+    assert [d['table'] for d in data_sets] == ['trials']
@@ -0,0 +1,26 @@
+import pytest
+
+pytest.importorskip('kivy')
+
+from src import policybundle
+from src.i18n import change_language_to, list_languages
+from src.utility import render_markdown
+
+
+@pytest.mark.parametrize('language', list_languages())
+def test_bundles_are_up_to_date(language):
+    """ The shipped bundles must be rebuilt when the policies, their translations or the app details change. """
+    change_language_to(language)
+    try:
+        for name, get_document in policybundle.get_documents().items():
+            bundle = policybundle.load_bundle(name)
+            assert bundle, f"Bundle of {name} in {language} is missing or outdated. Run python -m src.policybundle"
+            assert bundle['text'] == render_markdown(get_document())
+    finally:
+        change_language_to('en')
+
+
+def test_bundle_doesnt_translate_document():
+    def get_document():
+        raise AssertionError("The document shouldn't be translated when there's a bundle.")
+    assert policybundle.get_policy_text('terms', get_document)
@@ -0,0 +1,64 @@
+import pytest
+
+pytest.importorskip('kivymd')
+
+from src.widgets.scrolllabel import MarkupBalancer, _markup_tag, get_separators, group_paragraphs, wrap_paragraph
+
+TEXT = ("[b]Terms of Use[/b]\n"
+        "\n"
+        "By using the app you agree to these [i]terms, which continue\n"
+        "  across paragraphs[/i] and contain averyveryveryveryverylongwordthatdoesntfitintoarow.\n"
+        "[ref=https://example.com][color=#0000ff]A link that is long enough to be wrapped[/color][/ref] at the end.")
+
+
+def get_rows(text, width):
+    """ Rows of text with what preceded them, paragraph by paragraph like RecycleLabel lays them out. """
+    all_rows = list()
+    for i, paragraph in enumerate(text.split('\n')):
+        rows, height = wrap_paragraph(paragraph, width, font_size=14, markup=True)
+        if i:
+            rows = (('\n' + rows[0][0], rows[0][1]),) + rows[1:]
+        all_rows.extend(rows)
+    return all_rows
+
+
+@pytest.mark.parametrize('width', [80, 150, 400])
+def test_balanced_lines_restore_text(width):
+    balancer = MarkupBalancer()
+    balancer.feed(get_rows(TEXT, width))
+    assert balancer.get_text() == TEXT
+    for line in balancer.lines:
+        closing = [match[1] for match in _markup_tag.finditer(line)]
+        assert closing.count('/') * 2 == len(closing)
+
+
+def test_feed_in_batches():
+    rows = get_rows(TEXT, 80)
+    whole = MarkupBalancer()
+    whole.feed(rows)
+    batched = MarkupBalancer()
+    for i in range(0, len(rows), 2):
+        batched.feed(rows[i:i + 2])
+    assert batched.lines == whole.lines
+    assert batched.n_rows == whole.n_rows
+    assert sum(whole.n_rows) == len(rows)
+
+
+def test_separators():
+    assert get_separators("one two  three", ["one", "two", "three"]) == ['', ' ', '  ']
+    assert get_separators("averylongword", ["averylo", "ngword"]) == ['', '']
+    assert get_separators("  indented", ["indented"]) == ['  ']
+
+
+def test_groups_balance_like_whole_text():
+    paragraphs = TEXT.split('\n')
+    starts = group_paragraphs(paragraphs)
+    assert starts == [0, 1, 2, 4, 5]
+    whole = MarkupBalancer()
+    whole.feed(get_rows(TEXT, 80))
+    lines = list()
+    for start, end in zip(starts, starts[1:]):
+        balancer = MarkupBalancer()
+        balancer.feed(get_rows('\n'.join(paragraphs[start:end]), 80))
+        lines.extend(balancer.lines)
+    assert lines == whole.lines
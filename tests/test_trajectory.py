@@ -0,0 +1,30 @@
+import numpy as np
+
+from src.trajectory import TrajectoryRecorder
+
+
+def test_touch_and_fixed_rate_samples_fit():
+    recorder = TrajectoryRecorder(n_trials=1, trial_duration=1.0, touch_rate=240, fixed_rate=120)
+    recorder.start_trial(1, 0.0)
+    # Both fingers move at the highest touch rate while the fixed-rate sampler runs.
+    for t in np.linspace(0, 1, 240 * 2 + 120):
+        recorder.sample(t, 50.0, 50.0)
+    recorder.finish_trial()
+    assert recorder.n_dropped == 0
+    assert len(recorder.get_data()) == 240 * 2 + 120
+
+
+def test_dropped_samples_are_reported():
+    recorder = TrajectoryRecorder(n_trials=2, trial_duration=0.01, touch_rate=100)  # Room for 5 samples per trial.
+    for trial, n_samples in ((1, 7), (2, 1), (3, 5)):
+        recorder.start_trial(trial, 0.0)
+        for i in range(n_samples):
+            recorder.sample(i, 50.0, 50.0)
+        recorder.finish_trial()
+    data = recorder.get_data()
+    # The first trial overflows its buffer. The last one doesn't fit into the block, only its latest samples are kept.
+    assert data[:, 0].tolist() == [1] * 5 + [2] + [3] * 4
+    assert data[:5, 1].tolist() == [2, 3, 4, 5, 6]
+    assert data[6:, 1].tolist() == [1, 2, 3, 4]
+    assert recorder.n_dropped == 2 + 1
+    assert recorder.truncated_trials == [1, 3]